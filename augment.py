@@ -0,0 +1,234 @@
+# Batched versions of the torchvision training augmentations
+# The dataset only decodes images to uint8 tensors; the random crop-resize,
+# flip, color jitter, grayscale and normalization run on whole collated
+# batches in the main process (on the GPU when there is one).
+
+from __future__ import print_function
+import math
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torchvision import transforms
+
+
+def _grayscale(images):
+    """ITU-R 601-2 luma of [n, 3, H, W] images, shape [n, 1, H, W]"""
+    r, g, b = images.unbind(1)
+    return (0.299 * r + 0.587 * g + 0.114 * b).unsqueeze(1)
+
+
+def _blend(images, other, factor):
+    return (factor * images + (1 - factor) * other).clamp_(0, 1)
+
+
+def _rgb_to_hsv(images):
+    r, g, b = images.unbind(1)
+    maxc = images.max(1)[0]
+    minc = images.min(1)[0]
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return torch.stack((h, s, maxc), dim=1)
+
+
+def _hsv_to_rgb(images):
+    h, s, v = images.unbind(1)
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.long() % 6
+    p = (v * (1.0 - s)).clamp_(0, 1)
+    q = (v * (1.0 - s * f)).clamp_(0, 1)
+    t = (v * (1.0 - s * (1.0 - f))).clamp_(0, 1)
+    # one of six channel orders per pixel, picked by the hue sector
+    candidates = torch.stack((
+        torch.stack((v, q, p, p, t, v), dim=1),
+        torch.stack((t, v, v, q, p, p), dim=1),
+        torch.stack((p, p, t, v, v, q), dim=1)), dim=1)
+    index = i.unsqueeze(1).unsqueeze(1).expand(-1, 3, 1, -1, -1)
+    return candidates.gather(2, index).squeeze(2)
+
+
+def _adjust_brightness(images, factor):
+    return (images * factor).clamp_(0, 1)
+
+
+def _adjust_contrast(images, factor):
+    mean = _grayscale(images).mean(dim=(1, 2, 3), keepdim=True)
+    return _blend(images, mean, factor)
+
+
+def _adjust_saturation(images, factor):
+    return _blend(images, _grayscale(images), factor)
+
+
+def _adjust_hue(images, factor):
+    hsv = _rgb_to_hsv(images)
+    h = torch.remainder(hsv[:, 0] + factor.view(-1, 1, 1), 1.0)
+    return _hsv_to_rgb(torch.stack((h, hsv[:, 1], hsv[:, 2]), dim=1))
+
+
+class BatchAugment(nn.Module):
+    """RandomResizedCrop, RandomHorizontalFlip, RandomApply(ColorJitter),
+    RandomGrayscale, ToTensor and Normalize on a uint8 [B, C, H, W] batch,
+    with independent random parameters for every sample.
+
+    Crop, resize and flip are one affine `grid_sample`. Color jitter keeps
+    torchvision's per-sample random order of the four adjustments; each
+    adjustment only touches the samples it is due for at that step.
+    """
+
+    def __init__(self, size, mean, std, scale=(0.08, 1.),
+                 ratio=(3. / 4., 4. / 3.), jitter=(0.4, 0.4, 0.4, 0.1),
+                 jitter_p=0.8, grayscale_p=0.2):
+        super(BatchAugment, self).__init__()
+        self.size = size
+        self.scale = scale
+        self.log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+        self.jitter = jitter
+        self.jitter_p = jitter_p
+        self.grayscale_p = grayscale_p
+        self.mean = mean
+        self.std = std
+
+    def crop_params(self, n, height, width, device):
+        """Per-sample crop boxes (top, left, h, w) drawn as in
+        `transforms.RandomResizedCrop.get_params`: the first of 10 attempts
+        that fits, otherwise a central crop at the clamped aspect ratio."""
+        area = height * width
+        target_area = area * torch.empty(n, 10, device=device).uniform_(
+            *self.scale)
+        aspect = torch.exp(torch.empty(n, 10, device=device).uniform_(
+            *self.log_ratio))
+        w = torch.round(torch.sqrt(target_area * aspect))
+        h = torch.round(torch.sqrt(target_area / aspect))
+        fits = (w > 0) & (w <= width) & (h > 0) & (h <= height)
+        attempt = fits.float().argmax(1, keepdim=True)
+        w = w.gather(1, attempt).squeeze(1)
+        h = h.gather(1, attempt).squeeze(1)
+
+        in_ratio = width / height
+        ratio = (math.exp(self.log_ratio[0]), math.exp(self.log_ratio[1]))
+        if in_ratio < ratio[0]:
+            fallback = (round(width / ratio[0]), width)
+        elif in_ratio > ratio[1]:
+            fallback = (height, round(height * ratio[1]))
+        else:
+            fallback = (height, width)
+        found = fits.any(1)
+        h = torch.where(found, h, torch.full_like(h, fallback[0]))
+        w = torch.where(found, w, torch.full_like(w, fallback[1]))
+
+        top = torch.floor(torch.rand(n, device=device) * (height - h + 1))
+        left = torch.floor(torch.rand(n, device=device) * (width - w + 1))
+        top = torch.where(found, top, (height - h) // 2)
+        left = torch.where(found, left, (width - w) // 2)
+        return top, left, h, w
+
+    def resized_crop_flip(self, images):
+        n, _, height, width = images.shape
+        top, left, h, w = self.crop_params(n, height, width, images.device)
+        flip = torch.where(torch.rand(n, device=images.device) < 0.5,
+                           -1., 1.)
+
+        # output [-1, 1] -> crop box in the input's normalized coordinates
+        theta = torch.zeros(n, 2, 3, device=images.device)
+        theta[:, 0, 0] = w / width * flip
+        theta[:, 0, 2] = (2 * left + w) / width - 1
+        theta[:, 1, 1] = h / height
+        theta[:, 1, 2] = (2 * top + h) / height - 1
+        grid = F.affine_grid(theta, (n, images.shape[1], self.size, self.size),
+                             align_corners=False)
+        return F.grid_sample(images, grid, mode='bilinear',
+                             padding_mode='border', align_corners=False)
+
+    def color_jitter(self, images):
+        n, device = images.shape[0], images.device
+        brightness, contrast, saturation, hue = self.jitter
+        factors = [
+            torch.empty(n, 1, 1, 1, device=device).uniform_(
+                max(0., 1 - brightness), 1 + brightness),
+            torch.empty(n, 1, 1, 1, device=device).uniform_(
+                max(0., 1 - contrast), 1 + contrast),
+            torch.empty(n, 1, 1, 1, device=device).uniform_(
+                max(0., 1 - saturation), 1 + saturation),
+            torch.empty(n, device=device).uniform_(-hue, hue),
+        ]
+        adjust = [_adjust_brightness, _adjust_contrast, _adjust_saturation,
+                  _adjust_hue]
+
+        apply = torch.rand(n, device=device) < self.jitter_p
+        order = torch.rand(n, 4, device=device).argsort(1)
+        for step in range(4):
+            for fn_id in range(4):
+                index = torch.nonzero(
+                    apply & (order[:, step] == fn_id)).squeeze(1)
+                if index.numel() > 0:
+                    images[index] = adjust[fn_id](images[index],
+                                                  factors[fn_id][index])
+        return images
+
+    @torch.no_grad()
+    def forward(self, images):
+        """Args:
+            images: uint8 batch of shape [B, C, H, W].
+        Returns:
+            Normalized float batch of shape [B, C, size, size].
+        """
+        images = images.float().div_(255)
+        images = self.resized_crop_flip(images)
+        if images.shape[1] == 3:
+            if self.jitter_p > 0:
+                images = self.color_jitter(images)
+            if self.grayscale_p > 0:
+                gray = torch.rand(images.shape[0], device=images.device) \
+                    < self.grayscale_p
+                images[gray] = _grayscale(images[gray]).expand(-1, 3, -1, -1)
+        mean = images.new_tensor(self.mean).view(1, -1, 1, 1)
+        std = images.new_tensor(self.std).view(1, -1, 1, 1)
+        return images.sub_(mean).div_(std)
+
+
+def decode_transform(size=None):
+    """Dataset-side transform for `BatchAugment`: the image as a uint8
+    [C, H, W] tensor. Datasets with images of varying size (ImageFolder)
+    are resized and center-cropped to `size` so that samples collate."""
+    if size is None:
+        return transforms.PILToTensor()
+    return transforms.Compose([
+        transforms.Resize(size),
+        transforms.CenterCrop(size),
+        transforms.PILToTensor(),
+    ])
+
+
+class AugmentLoader(object):
+    """Iterates over `loader` and applies the batch `transform` to every
+    image batch after moving it to `device`. With a `MultiCropTransform`
+    of `BatchAugment`s the images come out as a list of views, as with the
+    per-sample transforms."""
+
+    def __init__(self, loader, transform, device=None):
+        if device is None:
+            device = torch.device('cuda' if torch.cuda.is_available()
+                                  else 'cpu')
+        self.loader = loader
+        self.transform = transform
+        self.device = device
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for images, labels in self.loader:
+            images = images.to(self.device, non_blocking=True)
+            yield self.transform(images), labels
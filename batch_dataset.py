@@ -0,0 +1,70 @@
+# Batch-level fetching for datasets that are held in memory as arrays
+# torchvision's CIFAR10/100 and MNIST keep all images in `dataset.data`.
+# Instead of one __getitem__, PIL conversion and collate per sample, the
+# loader below gathers a whole batch from that array with one index vector.
+
+from __future__ import print_function
+
+import torch
+import torch.utils.data as data
+from torch.utils.data.dataloader import default_collate
+from PIL import Image
+
+from util import make_loader
+
+
+class BatchArrayDataset(data.Dataset):
+    """Serves whole batches of an in-memory torchvision dataset.
+
+    `__getitem__` takes a list of indices. Without a `transform` it returns
+    the images as one uint8 tensor [n, C, H, W], ready for `BatchAugment`.
+    With a per-sample `transform` (e.g. the usual PIL pipeline, possibly
+    wrapped in `TwoCropTransform`) every sample is transformed and the
+    results are stacked, as the default collate would.
+    """
+
+    def __init__(self, dataset, transform=None):
+        images = dataset.data
+        if not torch.is_tensor(images):
+            images = torch.from_numpy(images)
+        if images.dim() == 3:
+            # single-channel datasets are stored as [N, H, W]
+            images = images.unsqueeze(-1)
+        # [N, H, W, C] as stored by torchvision
+        self.images = images
+        self.targets = torch.as_tensor(dataset.targets, dtype=torch.long)
+        self.transform = transform
+
+    def __len__(self):
+        return self.images.shape[0]
+
+    def __getitem__(self, indices):
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        images = self.images[indices]
+        labels = self.targets[indices]
+        if self.transform is None:
+            return images.permute(0, 3, 1, 2).contiguous(), labels
+
+        samples = []
+        for image in images.numpy():
+            if image.shape[2] == 1:
+                image = Image.fromarray(image[..., 0], mode='L')
+            else:
+                image = Image.fromarray(image)
+            samples.append(self.transform(image))
+        return default_collate(samples), labels
+
+
+def batch_loader(dataset, opt, transform=None, shuffle=True,
+                 drop_last=False, batch_sampler=None):
+    """`make_loader` over `BatchArrayDataset(dataset, transform)` whose
+    sampler yields index lists of `opt.batch_size` (or the lists of
+    `batch_sampler`), so that each worker call builds one batch"""
+    dataset = BatchArrayDataset(dataset, transform)
+    if batch_sampler is None:
+        if shuffle:
+            sampler = data.RandomSampler(dataset)
+        else:
+            sampler = data.SequentialSampler(dataset)
+        batch_sampler = data.BatchSampler(sampler, opt.batch_size, drop_last)
+    return make_loader(dataset, opt, batch_size=None, sampler=batch_sampler)
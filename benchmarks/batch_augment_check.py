@@ -0,0 +1,137 @@
+# Statistical equivalence of BatchAugment and the torchvision pipeline
+# Augments the same synthetic images many times with both pipelines and runs
+# a two-sample Kolmogorov-Smirnov test on per-image statistics of the output
+# (channel means, contrast, saturation, left/right asymmetry). Exits with
+# status 1 if any statistic differs at the given significance level, and
+# reports the throughput of both pipelines.
+
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import math
+import time
+
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from torchvision import transforms
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from augment import BatchAugment  # noqa: E402
+
+
+MEAN = (0.4914, 0.4822, 0.4465)
+STD = (0.2023, 0.1994, 0.2010)
+
+
+def parse_option():
+    parser = argparse.ArgumentParser('argument for equivalence check')
+
+    parser.add_argument('--n_images', type=int, default=64,
+                        help='number of distinct source images')
+    parser.add_argument('--repeats', type=int, default=32,
+                        help='augmentations drawn per image and pipeline')
+    parser.add_argument('--size', type=int, default=32,
+                        help='output crop size')
+    parser.add_argument('--src_size', type=int, default=32,
+                        help='source image size')
+    parser.add_argument('--alpha', type=float, default=0.001,
+                        help='significance level of each KS test')
+
+    return parser.parse_args()
+
+
+def make_images(n, size):
+    """Smooth random uint8 images [n, 3, size, size] with a left/right
+    gradient, so that crops, flips and color changes all move the
+    statistics"""
+    torch.manual_seed(0)
+    low = torch.rand(n, 3, 4, 4)
+    images = F.interpolate(low, size=(size, size), mode='bilinear',
+                           align_corners=False)
+    ramp = torch.linspace(0, 0.5, size).view(1, 1, 1, -1)
+    images = (images * 0.5 + ramp * torch.rand(n, 3, 1, 1)).clamp(0, 1)
+    return (images * 255).round().to(torch.uint8)
+
+
+def statistics(views):
+    """Per-image statistics of normalized views [n, 3, H, W]"""
+    mean = torch.tensor(MEAN).view(1, -1, 1, 1)
+    std = torch.tensor(STD).view(1, -1, 1, 1)
+    images = views * std + mean
+    half = images.shape[-1] // 2
+    return {
+        'mean_r': images[:, 0].mean(dim=(1, 2)),
+        'mean_g': images[:, 1].mean(dim=(1, 2)),
+        'mean_b': images[:, 2].mean(dim=(1, 2)),
+        'contrast': images.mean(1).flatten(1).std(1),
+        'saturation': (images.max(1)[0] - images.min(1)[0]).mean(dim=(1, 2)),
+        'asymmetry': images[..., :half].mean(dim=(1, 2, 3))
+        - images[..., -half:].mean(dim=(1, 2, 3)),
+    }
+
+
+def ks_statistic(a, b):
+    """Two-sample Kolmogorov-Smirnov statistic"""
+    a, _ = torch.sort(a.double())
+    b, _ = torch.sort(b.double())
+    values = torch.cat([a, b])
+    cdf_a = torch.searchsorted(a, values, right=True).double() / len(a)
+    cdf_b = torch.searchsorted(b, values, right=True).double() / len(b)
+    return (cdf_a - cdf_b).abs().max().item()
+
+
+def main():
+    opt = parse_option()
+    images = make_images(opt.n_images, opt.src_size)
+
+    reference = transforms.Compose([
+        transforms.RandomResizedCrop(size=opt.size, scale=(0.2, 1.)),
+        transforms.RandomHorizontalFlip(),
+        transforms.RandomApply([
+            transforms.ColorJitter(0.4, 0.4, 0.4, 0.1)
+        ], p=0.8),
+        transforms.RandomGrayscale(p=0.2),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=MEAN, std=STD),
+    ])
+    batch_augment = BatchAugment(opt.size, MEAN, STD, scale=(0.2, 1.))
+
+    pil_images = [Image.fromarray(image.permute(1, 2, 0).numpy())
+                  for image in images]
+    start = time.perf_counter()
+    ref_views = torch.stack([reference(image) for _ in range(opt.repeats)
+                             for image in pil_images])
+    ref_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch_views = torch.cat([batch_augment(images)
+                             for _ in range(opt.repeats)])
+    batch_time = time.perf_counter() - start
+
+    n = opt.n_images * opt.repeats
+    print('torchvision: {:.0f} images/s, BatchAugment: {:.0f} images/s'
+          .format(n / ref_time, n / batch_time))
+
+    # critical value of the two-sample KS test with equal sample sizes
+    critical = math.sqrt(-math.log(opt.alpha / 2) / 2) * math.sqrt(2. / n)
+    ref_stats = statistics(ref_views)
+    batch_stats = statistics(batch_views)
+    failed = False
+    print('statistic\ttorchvision\tbatch\t\tKS\t(critical {:.4f})'
+          .format(critical))
+    for key in ref_stats:
+        d = ks_statistic(ref_stats[key], batch_stats[key])
+        failed = failed or d > critical
+        print('{:<10}\t{:.4f}\t\t{:.4f}\t\t{:.4f}{}'.format(
+            key, ref_stats[key].mean().item(), batch_stats[key].mean().item(),
+            d, '\tFAIL' if d > critical else ''))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,168 @@
+# Peak memory and step time of SupConResNet with activation checkpointing
+# One training step (forward of 2 x bsz views, SupConLoss, backward) per
+# setting of model, batch size and checkpoint segments per stage, each in a
+# fresh forked child so that peak memory is not shared between settings.
+# Peak memory is the CUDA allocator peak on GPU and, on CPU, the peak RSS
+# above the RSS once torch, the model and the inputs are loaded, as in
+# loss_suite.py.
+# For every checkpointed setting, the BatchNorm running statistics and
+# num_batches_tracked after one step are also checked against the same model
+# without checkpointing; the script exits non-zero if they differ.
+# Results are written to a JSON file.
+
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from resnet import SupConResNet  # noqa: E402
+from losses import SupConLoss  # noqa: E402
+
+
+def parse_option():
+    parser = argparse.ArgumentParser('argument for benchmark')
+
+    parser.add_argument('--models', type=str, default='resnet18,resnet50')
+    parser.add_argument('--batch_sizes', type=str, default='64,128,256',
+                        help='comma-separated batch sizes, two views each')
+    parser.add_argument('--segments', type=str, default='0,1,2,100',
+                        help='comma-separated segments per stage, 0 '
+                        'disables, values above the block count checkpoint '
+                        'every block')
+    parser.add_argument('--size', type=int, default=32,
+                        help='image size')
+    parser.add_argument('--steps', type=int, default=5,
+                        help='timed steps')
+    parser.add_argument('--tol', type=float, default=1e-5,
+                        help='max abs error of the BatchNorm running stats')
+    parser.add_argument('--output', type=str, default='checkpoint_bench.json')
+
+    return parser.parse_args()
+
+
+def current_rss():
+    """resident set size of this process in bytes"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def check_batch_norm(setting, opt):
+    """Max abs difference of the BatchNorm running stats, and whether
+    num_batches_tracked agrees, after one step with and without
+    checkpointing from the same weights"""
+    name, batch_size, segments = setting
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    model = SupConResNet(name=name,
+                         checkpoint_segments=[segments] * 4).to(device)
+    reference = SupConResNet(name=name).to(device)
+    reference.load_state_dict(model.state_dict())
+    criterion = SupConLoss()
+    images = torch.randn(2 * batch_size, 3, opt.size, opt.size, device=device)
+    labels = torch.randint(10, (batch_size,), device=device)
+
+    for net in (model, reference):
+        features = net(images).view(2, batch_size, -1).transpose(0, 1)
+        criterion(features, labels).backward()
+
+    stats_err, tracked_match = 0., True
+    for (key, buf), ref in zip(model.named_buffers(), reference.buffers()):
+        if key.endswith('num_batches_tracked'):
+            tracked_match &= bool(torch.equal(buf, ref))
+        else:
+            stats_err = max(stats_err, (buf - ref).abs().max().item())
+    return stats_err, tracked_match
+
+
+def run_setting(setting, opt):
+    name, batch_size, segments = setting
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = SupConResNet(name=name,
+                         checkpoint_segments=[segments] * 4).to(device)
+    criterion = SupConLoss()
+    images = torch.randn(2 * batch_size, 3, opt.size, opt.size, device=device)
+    labels = torch.randint(10, (batch_size,), device=device)
+
+    def step():
+        features = model(images).view(2, batch_size, -1).transpose(0, 1)
+        criterion(features, labels).backward()
+        model.zero_grad(set_to_none=True)
+
+    rss_before = current_rss()
+    step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    start = time.perf_counter()
+    for _ in range(opt.steps):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() / 2 ** 20
+    else:
+        # ru_maxrss is in KB on Linux
+        peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+                   - rss_before, 0) / 2 ** 20
+    return {'model': name, 'batch_size': batch_size, 'segments': segments,
+            'device': device.type, 'step_ms':
+            (time.perf_counter() - start) / opt.steps * 1e3,
+            'peak_mb': peak}
+
+
+def main():
+    opt = parse_option()
+    settings = [(name, int(batch_size), int(segments))
+                for name in opt.models.split(',')
+                for batch_size in opt.batch_sizes.split(',')
+                for segments in opt.segments.split(',')]
+
+    # fork before CUDA is initialized, one fresh child per setting
+    ctx = multiprocessing.get_context('fork')
+    results = []
+    failed = False
+    print('model\t\tbsz\tsegments\tstep ms\tpeak MB\tBN stats err')
+    with ctx.Pool(1, maxtasksperchild=1) as pool:
+        for setting in settings:
+            result = pool.apply(run_setting, (setting, opt))
+            bn = '-'
+            if setting[2] > 0:
+                stats_err, tracked_match = pool.apply(check_batch_norm,
+                                                      (setting, opt))
+                result.update(bn_stats_err=stats_err,
+                              bn_tracked_match=tracked_match)
+                failed |= stats_err > opt.tol or not tracked_match
+                bn = '{:.2e}'.format(stats_err)
+                if not tracked_match:
+                    bn += ' (num_batches_tracked differs)'
+            results.append(result)
+            print('{model:<10}\t{batch_size}\t{segments}\t\t{step_ms:.1f}\t'
+                  '{peak_mb:.1f}\t{bn}'.format(bn=bn, **result))
+            sys.stdout.flush()
+
+    with open(opt.output, 'w') as f:
+        json.dump({
+            'torch': torch.__version__,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'num_threads': torch.get_num_threads(),
+            'steps': opt.steps,
+            'results': results,
+        }, f, indent=2)
+    print('==> results written to {}'.format(opt.output))
+
+    if failed:
+        print('FAILED: checkpointing changes the BatchNorm running stats')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
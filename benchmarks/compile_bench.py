@@ -0,0 +1,85 @@
+# Images/sec of the SupConResNet encoders per execution mode
+# Eager, channels_last, torch.compile and both together, as set up by
+# util.compile_model, for inference (forward under no_grad) and training
+# (forward + backward) steps. Compilation happens in the warm-up steps and
+# is not timed; rerun to see the effect of the inductor cache on startup.
+
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util import compile_model  # noqa: E402
+from resnet import SupConResNet  # noqa: E402
+
+
+MODES = [('eager', False, False), ('channels_last', False, True),
+         ('compile', True, False), ('compile+cl', True, True)]
+
+
+def parse_option():
+    parser = argparse.ArgumentParser('argument for benchmark')
+
+    parser.add_argument('--models', type=str, default='resnet18,resnet50')
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help='batch_size')
+    parser.add_argument('--size', type=int, default=32,
+                        help='image size')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--warmup', type=int, default=3,
+                        help='untimed steps, including compilation')
+    parser.add_argument('--steps', type=int, default=10,
+                        help='timed steps')
+
+    return parser.parse_args()
+
+
+def sync(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def measure(model, images, device, train, warmup, steps):
+    model.train(train)
+    for step in range(warmup + steps):
+        if step == warmup:
+            sync(device)
+            start = time.perf_counter()
+        if train:
+            model.zero_grad(set_to_none=True)
+            model(images).pow(2).mean().backward()
+        else:
+            with torch.no_grad():
+                model(images)
+    sync(device)
+    return steps * images.shape[0] / (time.perf_counter() - start)
+
+
+def main():
+    opt = parse_option()
+    device = torch.device(opt.device)
+    images = torch.randn(opt.batch_size, 3, opt.size, opt.size, device=device)
+    print('device: {}, batch: {}x3x{}x{}, threads: {}'.format(
+        device, opt.batch_size, opt.size, opt.size, torch.get_num_threads()))
+    print('model\t\tmode\t\tforward img/s\tforward+backward img/s')
+    for name in opt.models.split(','):
+        for mode, compiled, channels_last in MODES:
+            model = compile_model(
+                SupConResNet(name=name).to(device),
+                argparse.Namespace(compile=compiled,
+                                   channels_last=channels_last))
+            forward = measure(model, images, device, False, opt.warmup,
+                              opt.steps)
+            backward = measure(model, images, device, True, opt.warmup,
+                               opt.steps)
+            print('{:<10}\t{:<14}\t{:.1f}\t\t{:.1f}'.format(
+                name, mode, forward, backward))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+# Correctness of the SupConLoss feature queue
+# First, a loss with an empty queue (queue_size > 0, first batch) must match
+# the dense queue_size=0 loss in value and gradient. Then a stream of
+# batches is fed through the queued loss, and every step is compared with a
+# reference that concatenates the previously seen features and labels (the
+# last queue_size of them) to the contrast set. Runs in float64, for both
+# contrast modes, with labels and unsupervised. Exits non-zero when any step
+# disagrees.
+
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from losses import SupConLoss  # noqa: E402
+
+
+def parse_option():
+    parser = argparse.ArgumentParser('argument for equivalence check')
+
+    parser.add_argument('--batch_size', type=int, default=16,
+                        help='batch_size')
+    parser.add_argument('--n_views', type=int, default=2,
+                        help='number of views per sample')
+    parser.add_argument('--feat_dim', type=int, default=32,
+                        help='feature dimension')
+    parser.add_argument('--n_cls', type=int, default=5,
+                        help='number of classes drawn for the labels')
+    parser.add_argument('--queue_size', type=int, default=100,
+                        help='queue size, not a multiple of the batch so '
+                        'that the ring buffer wraps mid-batch')
+    parser.add_argument('--steps', type=int, default=8,
+                        help='batches fed through the queue')
+    parser.add_argument('--temp', type=float, default=0.1,
+                        help='temperature')
+    parser.add_argument('--tol', type=float, default=1e-10,
+                        help='max abs error of loss and gradient in float64')
+
+    return parser.parse_args()
+
+
+def reference_loss(features, labels, queue_features, queue_labels, temp,
+                   contrast_mode):
+    """SupCon loss with the queue concatenated to the contrast set, written
+    out directly; queue_labels of -1 are never positives"""
+    batch_size, n_views = features.shape[:2]
+    if labels is None:
+        labels = torch.arange(batch_size)
+    contrast_feature = features.transpose(0, 1).reshape(-1, features.shape[-1])
+    if contrast_mode == 'one':
+        anchor_feature, anchor_count = features[:, 0], 1
+    else:
+        anchor_feature, anchor_count = contrast_feature, n_views
+    anchor_labels = labels.repeat(anchor_count)
+    all_feature = torch.cat([contrast_feature, queue_features])
+    all_labels = torch.cat([labels.repeat(n_views), queue_labels])
+
+    logits = torch.matmul(anchor_feature, all_feature.T) / temp
+    n_anchor = anchor_feature.shape[0]
+    is_self = torch.zeros_like(logits, dtype=torch.bool)
+    is_self[torch.arange(n_anchor), torch.arange(n_anchor)] = True
+    logits = logits.masked_fill(is_self, float('-inf'))
+    log_prob = logits - torch.logsumexp(logits, dim=1, keepdim=True)
+    pos = torch.eq(anchor_labels.view(-1, 1), all_labels.view(1, -1)) \
+        & ~is_self
+    mean_log_prob_pos = log_prob.masked_fill(~pos, 0).sum(1) / pos.sum(1)
+    return -mean_log_prob_pos.mean()
+
+
+def loss_and_grad(criterion, features, labels):
+    features = features.detach().clone().requires_grad_()
+    loss = criterion(features, labels)
+    grad, = torch.autograd.grad(loss, features)
+    return loss.detach(), grad
+
+
+def errors(a, b):
+    return (a[0] - b[0]).abs().item(), (a[1] - b[1]).abs().max().item()
+
+
+def make_batch(opt, supervised):
+    features = F.normalize(torch.randn(
+        opt.batch_size, opt.n_views, opt.feat_dim, dtype=torch.float64),
+        dim=-1)
+    labels = torch.randint(opt.n_cls, (opt.batch_size,)) if supervised \
+        else None
+    return features, labels
+
+
+def main():
+    opt = parse_option()
+    torch.manual_seed(0)
+    failed = False
+    print('mode\tcase\t\tstep\tqueued\tloss err\tgrad err')
+    for contrast_mode in ('all', 'one'):
+        for supervised in (True, False):
+            case = 'labels' if supervised else 'unsupervised'
+            kwargs = dict(temperature=opt.temp, base_temperature=opt.temp,
+                          contrast_mode=contrast_mode)
+
+            # an empty queue is the dense loss
+            features, labels = make_batch(opt, supervised)
+            loss_err, grad_err = errors(
+                loss_and_grad(SupConLoss(queue_size=opt.queue_size, **kwargs),
+                              features, labels),
+                loss_and_grad(SupConLoss(**kwargs), features, labels))
+            failed |= loss_err > opt.tol or grad_err > opt.tol
+            print('{}\t{:<12}\tempty\t0\t{:.2e}\t{:.2e}'.format(
+                contrast_mode, case, loss_err, grad_err))
+
+            # a filled queue is the loss over the concatenated contrast set
+            criterion = SupConLoss(queue_size=opt.queue_size, **kwargs)
+            seen_features, seen_labels = [], []
+            for step in range(opt.steps):
+                features, labels = make_batch(opt, supervised)
+                queued = loss_and_grad(criterion, features, labels)
+                if seen_features:
+                    queue_features = torch.cat(seen_features)[-opt.queue_size:]
+                    queue_labels = torch.cat(seen_labels)[-opt.queue_size:]
+                else:
+                    queue_features = features.new_empty(0, opt.feat_dim)
+                    queue_labels = torch.empty(0, dtype=torch.long)
+                reference = loss_and_grad(
+                    lambda x, y: reference_loss(x, y, queue_features,
+                                                queue_labels, opt.temp,
+                                                contrast_mode),
+                    features, labels)
+                loss_err, grad_err = errors(queued, reference)
+                failed |= loss_err > opt.tol or grad_err > opt.tol
+                print('{}\t{:<12}\t{}\t{}\t{:.2e}\t{:.2e}'.format(
+                    contrast_mode, case, step, queue_features.shape[0],
+                    loss_err, grad_err))
+
+                seen_features.append(features.transpose(0, 1).reshape(
+                    -1, opt.feat_dim))
+                seen_labels.append(
+                    torch.full((opt.n_views * opt.batch_size,), -1)
+                    if labels is None else labels.repeat(opt.n_views))
+
+    if failed:
+        print('FAILED: the queued loss differs from the reference')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+# Equivalence and CPU speed of the BN-folded inference encoder
+# The encoder returned by resnet.optimize_for_inference is compared with the
+# eval-mode encoder it was built from, after the BatchNorm statistics and
+# affine parameters are randomized so that folding has something to fold.
+# Then single-image latency and batch throughput of both are timed on CPU.
+# Exits non-zero when the outputs disagree.
+
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from resnet import SupConResNet, optimize_for_inference  # noqa: E402
+
+
+def parse_option():
+    parser = argparse.ArgumentParser('argument for benchmark')
+
+    parser.add_argument('--models', type=str, default='resnet18,resnet50')
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help='batch size of the throughput runs')
+    parser.add_argument('--size', type=int, default=32,
+                        help='image size')
+    parser.add_argument('--steps', type=int, default=20,
+                        help='timed steps per measurement')
+    parser.add_argument('--tol', type=float, default=1e-4,
+                        help='max error relative to the output scale')
+
+    return parser.parse_args()
+
+
+def randomize_bn(model):
+    for m in model.modules():
+        if isinstance(m, nn.BatchNorm2d):
+            m.running_mean.normal_(0, 0.1)
+            m.running_var.uniform_(0.5, 2.)
+            m.weight.data.uniform_(0.5, 1.5)
+            m.bias.data.normal_(0, 0.1)
+
+
+def seconds_per_step(encoder, images, steps):
+    with torch.inference_mode():
+        for _ in range(3):
+            encoder(images)
+        start = time.perf_counter()
+        for _ in range(steps):
+            encoder(images)
+    return (time.perf_counter() - start) / steps
+
+
+def main():
+    opt = parse_option()
+    torch.manual_seed(0)
+    failed = False
+    print('threads: {}'.format(torch.get_num_threads()))
+    print('model\t\tmax rel err\tencoder\t\tlatency ms\timg/s')
+    for name in opt.models.split(','):
+        model = SupConResNet(name=name)
+        randomize_bn(model)
+        model.eval()
+        folded = optimize_for_inference(model)
+
+        images = torch.randn(opt.batch_size, 3, opt.size, opt.size)
+        with torch.no_grad():
+            reference = model.encoder(images)
+            output = folded(images)
+        err = ((output - reference).abs().max()
+               / reference.abs().max()).item()
+        failed |= err > opt.tol
+
+        for label, encoder in (('unfused', model.encoder),
+                               ('folded', folded)):
+            latency = seconds_per_step(encoder, images[:1], opt.steps)
+            batch = seconds_per_step(encoder, images, opt.steps)
+            print('{:<10}\t{:.2e}\t{:<8}\t{:.2f}\t\t{:.1f}'.format(
+                name, err, label, latency * 1e3, opt.batch_size / batch))
+
+    if failed:
+        print('FAILED: folded encoder differs by more than {}'.format(opt.tol))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+# Correctness of the closed-form SupConFunction backward
+# For both contrast modes and for labels, an explicit (asymmetric) mask and
+# the unsupervised case, the analytic gradient of SupConFunction is checked
+# with torch.autograd.gradcheck in float64, and the loss and gradient of
+# FusedSupConLoss are compared with the autograd SupConLoss on the same
+# features. Exits non-zero when any case disagrees.
+
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from losses import SupConLoss, FusedSupConLoss, SupConFunction  # noqa: E402
+
+
+def parse_option():
+    parser = argparse.ArgumentParser('argument for equivalence check')
+
+    parser.add_argument('--batch_size', type=int, default=32,
+                        help='batch size of the SupConLoss comparison')
+    parser.add_argument('--n_views', type=int, default=2,
+                        help='number of views per sample')
+    parser.add_argument('--feat_dim', type=int, default=64,
+                        help='feature dimension')
+    parser.add_argument('--n_cls', type=int, default=5,
+                        help='number of classes drawn for the labels')
+    parser.add_argument('--temp', type=float, default=0.1,
+                        help='temperature')
+    parser.add_argument('--tol', type=float, default=1e-10,
+                        help='max abs error of loss and gradient in float64')
+
+    return parser.parse_args()
+
+
+def make_targets(kind, batch_size, n_cls):
+    """(labels, mask) of one supervision case"""
+    if kind == 'labels':
+        return torch.randint(n_cls, (batch_size,)), None
+    if kind == 'mask':
+        # asymmetric, every sample stays a positive of itself so that each
+        # anchor keeps at least its other views as positives
+        mask = (torch.rand(batch_size, batch_size) < 0.3).double()
+        mask.fill_diagonal_(1)
+        return None, mask
+    return None, None
+
+
+def loss_and_grad(criterion, features, labels, mask):
+    features = features.detach().clone().requires_grad_()
+    loss = criterion(features, labels=labels, mask=mask)
+    grad, = torch.autograd.grad(loss, features)
+    return loss.detach(), grad
+
+
+def main():
+    opt = parse_option()
+    torch.manual_seed(0)
+    failed = False
+    print('mode\tcase\tgradcheck\tloss err\tgrad err')
+    for contrast_mode in ('all', 'one'):
+        for kind in ('labels', 'mask', 'unsupervised'):
+            # small problem for the finite differences of gradcheck
+            labels, mask = make_targets(kind, 6, 3)
+            if labels is not None:
+                labels = labels.view(-1, 1)
+            features = F.normalize(torch.randn(
+                6, opt.n_views, 8, dtype=torch.float64), dim=-1)
+            passed = torch.autograd.gradcheck(
+                lambda x: SupConFunction.apply(x, labels, mask, opt.temp,
+                                               opt.temp, contrast_mode),
+                (features.requires_grad_(),), raise_exception=False)
+
+            labels, mask = make_targets(kind, opt.batch_size, opt.n_cls)
+            features = F.normalize(torch.randn(
+                opt.batch_size, opt.n_views, opt.feat_dim,
+                dtype=torch.float64), dim=-1)
+            reference = loss_and_grad(
+                SupConLoss(temperature=opt.temp, base_temperature=opt.temp,
+                           contrast_mode=contrast_mode),
+                features, labels, mask)
+            fused = loss_and_grad(
+                FusedSupConLoss(temperature=opt.temp,
+                                base_temperature=opt.temp,
+                                contrast_mode=contrast_mode),
+                features, labels, mask)
+            loss_err = (fused[0] - reference[0]).abs().item()
+            grad_err = (fused[1] - reference[1]).abs().max().item()
+
+            failed |= not passed or loss_err > opt.tol or grad_err > opt.tol
+            print('{}\t{:<8}\t{}\t\t{:.2e}\t{:.2e}'.format(
+                contrast_mode, kind, 'ok' if passed else 'FAILED',
+                loss_err, grad_err))
+
+    if failed:
+        print('FAILED: FusedSupConLoss differs from SupConLoss')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+# Microbenchmark suite for every loss used by the training scripts
+# Sweeps batch size, n_views, feat_dim, contrast_mode and label cardinality,
+# measures forward and backward wall time, peak memory and throughput, and
+# writes one JSON record per setting. Every setting runs in a forked child so
+# that the peak RSS of one setting does not leak into the next.
+# With --baseline, settings that got slower than the tolerance are reported
+# and the script exits with status 1.
+
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import itertools
+import json
+import multiprocessing
+import platform
+import resource
+import time
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from losses import SupConLoss, FusedSupConLoss  # noqa: E402
+from losses import TripletLoss, PairLoss, NTXentLoss, NPairLoss  # noqa: E402
+
+
+SUPCON_LOSSES = ['supcon', 'supcon_chunked', 'supcon_sparse', 'supcon_fused']
+NATIVE_LOSSES = ['triplet', 'pair', 'ntxent', 'npair']
+PML_LOSSES = ['pml_triplet', 'pml_pair', 'pml_ntxent', 'pml_npair']
+
+
+def parse_option():
+    parser = argparse.ArgumentParser('argument for benchmark')
+
+    parser.add_argument('--losses', type=str,
+                        default=','.join(SUPCON_LOSSES + NATIVE_LOSSES
+                                         + PML_LOSSES),
+                        help='losses to run, can be a list')
+    parser.add_argument('--batch_size', type=str, default='128,512',
+                        help='batch sizes, can be a list')
+    parser.add_argument('--n_views', type=str, default='2',
+                        help='views per sample, can be a list')
+    parser.add_argument('--feat_dim', type=str, default='128,256,2048',
+                        help='feature dimensions, can be a list')
+    parser.add_argument('--contrast_mode', type=str, default='all,one',
+                        help='SupConLoss contrast modes, can be a list')
+    parser.add_argument('--n_cls', type=str, default='10,1000',
+                        help='label cardinalities, can be a list')
+    parser.add_argument('--chunk_size', type=int, default=256,
+                        help='tile size of supcon_chunked')
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='timed iterations per setting')
+    parser.add_argument('--output', type=str, default='loss_bench.json',
+                        help='where to write the JSON results')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='JSON results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative slowdown against --baseline')
+
+    opt = parser.parse_args()
+    opt.losses = opt.losses.split(',')
+    for key in ['batch_size', 'n_views', 'feat_dim', 'n_cls']:
+        setattr(opt, key, [int(v) for v in getattr(opt, key).split(',')])
+    opt.contrast_mode = opt.contrast_mode.split(',')
+    return opt
+
+
+def build_loss(name, contrast_mode, chunk_size):
+    """Callable (features [bsz, n_views, D], labels) -> loss scalar"""
+    if name == 'supcon':
+        return SupConLoss(temperature=0.1, contrast_mode=contrast_mode)
+    elif name == 'supcon_chunked':
+        return SupConLoss(temperature=0.1, contrast_mode=contrast_mode,
+                          chunk_size=chunk_size)
+    elif name == 'supcon_sparse':
+        return SupConLoss(temperature=0.1, contrast_mode=contrast_mode,
+                          positive_mode='sparse')
+    elif name == 'supcon_fused':
+        return FusedSupConLoss(temperature=0.1, contrast_mode=contrast_mode)
+    elif name == 'triplet':
+        return TripletLoss(margin=0.2, miner='semihard')
+    elif name == 'pair':
+        return PairLoss(pos_margin=0.8, neg_margin=0.2)
+    elif name == 'ntxent':
+        return NTXentLoss(temperature=0.1)
+    elif name == 'npair':
+        return NPairLoss()
+    elif name in PML_LOSSES:
+        return build_pml_loss(name)
+    raise ValueError('loss not supported: {}'.format(name))
+
+
+def build_pml_loss(name):
+    """pytorch_metric_learning setups of the original scripts, one miner and
+    loss call per view"""
+    from pytorch_metric_learning import losses, miners
+    from pytorch_metric_learning.distances import CosineSimilarity
+    from pytorch_metric_learning.reducers import ThresholdReducer
+
+    distance = CosineSimilarity()
+    reducer = ThresholdReducer(low=0)
+    mining_func = None
+    if name == 'pml_triplet':
+        criterion = losses.TripletMarginLoss(
+            margin=0.2, distance=distance, reducer=reducer)
+        mining_func = miners.TripletMarginMiner(
+            margin=0.2, distance=distance, type_of_triplets='semihard')
+    elif name == 'pml_pair':
+        criterion = losses.ContrastiveLoss(
+            pos_margin=0.8, neg_margin=0.2, distance=distance, reducer=reducer)
+        mining_func = miners.PairMarginMiner(
+            pos_margin=0.8, neg_margin=0.2, distance=distance)
+    elif name == 'pml_ntxent':
+        criterion = losses.NTXentLoss(
+            temperature=0.1, distance=distance, reducer=reducer)
+    else:
+        criterion = losses.NPairsLoss(distance=distance, reducer=reducer)
+
+    def loss_fn(features, labels):
+        loss = 0
+        for view in torch.unbind(features, dim=1):
+            indices_tuple = None
+            if mining_func is not None:
+                indices_tuple = mining_func(view, labels)
+            loss = loss + criterion(view, labels, indices_tuple)
+        return loss
+    return loss_fn
+
+
+def current_rss():
+    """resident set size of this process in bytes"""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def run_setting(setting, opt):
+    """Time one setting, meant to run in a fresh child process."""
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    torch.manual_seed(0)
+    criterion = build_loss(setting['loss'], setting['contrast_mode'],
+                           opt.chunk_size)
+    features = F.normalize(
+        torch.randn(setting['batch_size'], setting['n_views'],
+                    setting['feat_dim'], device=device), dim=-1)
+    features.requires_grad_()
+    labels = torch.randint(0, setting['n_cls'], (setting['batch_size'],),
+                           device=device)
+
+    rss_before = current_rss()
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+    forward_time, backward_time = 0., 0.
+    # the first iteration is an untimed warm-up
+    for it in range(opt.repeats + 1):
+        features.grad = None
+        synchronize(device)
+        start = time.perf_counter()
+        loss = criterion(features, labels)
+        synchronize(device)
+        middle = time.perf_counter()
+        loss.backward()
+        synchronize(device)
+        end = time.perf_counter()
+        if it > 0:
+            forward_time += middle - start
+            backward_time += end - middle
+
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    result = dict(setting)
+    result.update({
+        'device': device.type,
+        'forward_ms': forward_time / opt.repeats * 1e3,
+        'backward_ms': backward_time / opt.repeats * 1e3,
+        'samples_per_sec': setting['batch_size'] * opt.repeats
+        / (forward_time + backward_time),
+        'peak_rss_mb': max(peak_rss - rss_before, 0) / 2 ** 20,
+        'peak_allocated_mb': torch.cuda.max_memory_allocated() / 2 ** 20
+        if device.type == 'cuda' else None,
+        'loss_value': loss.item(),
+    })
+    return result
+
+
+def settings(opt):
+    for name, bsz, n_views, feat_dim, n_cls in itertools.product(
+            opt.losses, opt.batch_size, opt.n_views, opt.feat_dim, opt.n_cls):
+        # only SupConLoss has a contrast mode, and the per-view losses of
+        # pytorch_metric_learning need a single view batch per call
+        modes = opt.contrast_mode if name in SUPCON_LOSSES else [None]
+        for contrast_mode in modes:
+            yield {'loss': name, 'batch_size': bsz, 'n_views': n_views,
+                   'feat_dim': feat_dim, 'n_cls': n_cls,
+                   'contrast_mode': contrast_mode}
+
+
+def setting_key(result):
+    return tuple(result[k] for k in ('loss', 'batch_size', 'n_views',
+                                     'feat_dim', 'n_cls', 'contrast_mode',
+                                     'device'))
+
+
+def compare(results, baseline_file, tolerance):
+    with open(baseline_file) as f:
+        baseline = {setting_key(r): r for r in json.load(f)['results']}
+    regressions = []
+    for result in results:
+        old = baseline.get(setting_key(result))
+        if old is None:
+            continue
+        old_time = old['forward_ms'] + old['backward_ms']
+        new_time = result['forward_ms'] + result['backward_ms']
+        if new_time > old_time * (1 + tolerance):
+            regressions.append((result, old_time, new_time))
+    for result, old_time, new_time in regressions:
+        print('REGRESSION {}: {:.2f} ms -> {:.2f} ms'.format(
+            setting_key(result), old_time, new_time))
+    return regressions
+
+
+def main():
+    opt = parse_option()
+    if any(name in PML_LOSSES for name in opt.losses):
+        try:
+            import pytorch_metric_learning  # noqa: F401
+        except ImportError:
+            print('pytorch_metric_learning not installed, skipping pml_*')
+            opt.losses = [n for n in opt.losses if n not in PML_LOSSES]
+
+    # fork so that torch is imported once, one fresh child per setting
+    ctx = multiprocessing.get_context('fork')
+    results = []
+    print('loss\t\tbsz\tviews\tdim\tcls\tmode\tfwd ms\tbwd ms\tpeak MB')
+    with ctx.Pool(1, maxtasksperchild=1) as pool:
+        for setting in settings(opt):
+            result = pool.apply(run_setting, (setting, opt))
+            results.append(result)
+            print('{loss:<14}\t{batch_size}\t{n_views}\t{feat_dim}\t{n_cls}\t'
+                  '{contrast_mode}\t{forward_ms:.2f}\t{backward_ms:.2f}\t'
+                  '{peak_rss_mb:.1f}'.format(**result))
+            sys.stdout.flush()
+
+    with open(opt.output, 'w') as f:
+        json.dump({
+            'torch': torch.__version__,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'num_threads': torch.get_num_threads(),
+            'repeats': opt.repeats,
+            'results': results,
+        }, f, indent=2)
+    print('==> results written to {}'.format(opt.output))
+
+    if opt.baseline is not None:
+        if compare(results, opt.baseline, opt.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
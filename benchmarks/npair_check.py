@@ -0,0 +1,120 @@
+# Correctness of NPairLoss
+# The default cross-view loss is compared with a reference that builds the
+# full 2B x 2B cosine similarity matrix of all views and, one anchor at a
+# time, takes the log-sum-exp over the other view minus the mean similarity
+# to the same-label samples of the other view. With --pml, the
+# first_per_label mode is also compared with pytorch_metric_learning's
+# NPairsLoss fed the same pairs. Loss and gradient are compared in float64
+# with unique and with repeated labels. Exits non-zero when any case
+# disagrees.
+
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from losses import NPairLoss  # noqa: E402
+
+
+def parse_option():
+    parser = argparse.ArgumentParser('argument for equivalence check')
+
+    parser.add_argument('--batch_size', type=int, default=64,
+                        help='batch_size')
+    parser.add_argument('--feat_dim', type=int, default=128,
+                        help='feature dimension')
+    parser.add_argument('--n_cls', type=str, default='0,10,100',
+                        help='label cardinalities, 0 for unique labels, can '
+                        'be a list')
+    parser.add_argument('--pml', action='store_true',
+                        help='also check first_per_label against '
+                        'pytorch_metric_learning')
+    parser.add_argument('--tol', type=float, default=1e-10,
+                        help='max abs error of loss and gradient in float64')
+
+    return parser.parse_args()
+
+
+def cross_view_reference(features, labels):
+    """N-pair loss of every anchor of the 2B x 2B matrix against the other
+    view, one anchor at a time"""
+    batch_size = features.shape[0]
+    if labels is None:
+        labels = torch.arange(batch_size)
+    embeddings = F.normalize(
+        torch.cat([features[:, 0], features[:, 1]]), dim=1)
+    all_labels = labels.repeat(2)
+    sim = torch.matmul(embeddings, embeddings.T)
+
+    losses = []
+    for anchor in range(2 * batch_size):
+        other = torch.arange(batch_size) \
+            + (batch_size if anchor < batch_size else 0)
+        pos = other[all_labels[other] == all_labels[anchor]]
+        losses.append(torch.logsumexp(sim[anchor, other], dim=0)
+                      - sim[anchor, pos].mean())
+    losses = torch.stack(losses)
+    return losses.sum() / (losses > 0).sum().clamp(min=1)
+
+
+def pml_reference(features, labels):
+    """pml NPairsLoss on view 0 / view 1 of the first sample of each label"""
+    from pytorch_metric_learning.losses import NPairsLoss
+    from pytorch_metric_learning.distances import CosineSimilarity
+    from pytorch_metric_learning.reducers import ThresholdReducer
+
+    if labels is None:
+        labels = torch.arange(features.shape[0])
+    first = [labels.tolist().index(label)
+             for label in sorted(set(labels.tolist()))]
+    first = torch.tensor(first)
+    embeddings = torch.cat([features[first, 0], features[first, 1]])
+    pair_labels = labels[first].repeat(2)
+    criterion = NPairsLoss(distance=CosineSimilarity(),
+                           reducer=ThresholdReducer(low=0))
+    return criterion(embeddings, pair_labels)
+
+
+def loss_and_grad(criterion, features, labels):
+    features = features.detach().clone().requires_grad_()
+    loss = criterion(features, labels)
+    grad, = torch.autograd.grad(loss, features)
+    return loss.detach(), grad
+
+
+def main():
+    opt = parse_option()
+    torch.manual_seed(0)
+    checks = [('cross_view', NPairLoss(), cross_view_reference)]
+    if opt.pml:
+        checks.append(('first_pml', NPairLoss(first_per_label=True),
+                       pml_reference))
+
+    failed = False
+    print('mode\t\tclasses\tloss\t\tloss err\tgrad err')
+    for n_cls in [int(c) for c in opt.n_cls.split(',')]:
+        features = torch.randn(opt.batch_size, 2, opt.feat_dim,
+                               dtype=torch.float64)
+        labels = torch.randint(n_cls, (opt.batch_size,)) if n_cls > 0 \
+            else None
+        for mode, criterion, reference in checks:
+            loss, grad = loss_and_grad(criterion, features, labels)
+            ref_loss, ref_grad = loss_and_grad(reference, features, labels)
+            loss_err = (loss - ref_loss).abs().item()
+            grad_err = (grad - ref_grad).abs().max().item()
+            failed |= loss_err > opt.tol or grad_err > opt.tol
+            print('{:<10}\t{}\t{:.6f}\t{:.2e}\t{:.2e}'.format(
+                mode, n_cls or 'unique', loss.item(), loss_err, grad_err))
+
+    if failed:
+        print('FAILED: NPairLoss differs from its reference')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# Data-wait fraction of a two-view training step with and without prefetching
+# A synthetic two-view dataset with a tunable per-sample cost feeds a
+# SupConResNet step; the time the loop spends blocked on the loader is
+# reported as a fraction of the epoch, for the plain DataLoader loop (host
+# concat, then .cuda()) and for PrefetchLoader + cat_views.
+
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import time
+
+import torch
+import torch.utils.data as data
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from util import cat_views  # noqa: E402
+from prefetch import PrefetchLoader  # noqa: E402
+from resnet import SupConResNet  # noqa: E402
+
+
+def parse_option():
+    parser = argparse.ArgumentParser('argument for benchmark')
+
+    parser.add_argument('--model', type=str, default='resnet18')
+    parser.add_argument('--batch_size', type=int, default=256,
+                        help='batch_size')
+    parser.add_argument('--size', type=int, default=32,
+                        help='image size')
+    parser.add_argument('--n_batches', type=int, default=20,
+                        help='timed batches per loop')
+    parser.add_argument('--num_workers', type=int, default=2,
+                        help='num of workers to use')
+    parser.add_argument('--sample_cost', type=float, default=1e-4,
+                        help='simulated seconds of transform per sample')
+
+    return parser.parse_args()
+
+
+class TwoViewDataset(data.Dataset):
+    """Random two-view samples that take `cost` seconds each to produce"""
+
+    def __init__(self, n, size, cost):
+        self.n = n
+        self.size = size
+        self.cost = cost
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, index):
+        start = time.perf_counter()
+        views = [torch.randn(3, self.size, self.size) for _ in range(2)]
+        while time.perf_counter() - start < self.cost:
+            pass
+        return views, index % 10
+
+
+def run(loader, model, optimizer, device, prefetch):
+    if prefetch:
+        loader = PrefetchLoader(loader, device)
+    wait, total = 0., time.perf_counter()
+    end = time.perf_counter()
+    for images, labels in loader:
+        wait += time.perf_counter() - end
+        if prefetch:
+            images = cat_views(images)
+        else:
+            images = torch.cat([images[0], images[1]], dim=0)
+            images = images.to(device, non_blocking=True)
+            labels = labels.to(device, non_blocking=True)
+        loss = model(images).pow(2).mean()
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        loss.item()
+        end = time.perf_counter()
+    total = time.perf_counter() - total
+    return wait, total
+
+
+def main():
+    opt = parse_option()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    model = SupConResNet(name=opt.model).to(device)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    dataset = TwoViewDataset(opt.batch_size * opt.n_batches, opt.size,
+                             opt.sample_cost)
+    loader = data.DataLoader(dataset, batch_size=opt.batch_size,
+                             shuffle=True, num_workers=opt.num_workers,
+                             pin_memory=device.type == 'cuda',
+                             persistent_workers=opt.num_workers > 0)
+
+    # warm-up epoch, starts the workers and the cudnn autotuner
+    run(loader, model, optimizer, device, prefetch=False)
+    print('device: {}, workers: {}'.format(device.type, opt.num_workers))
+    print('loop\t\twait s\ttotal s\twait fraction')
+    for name, prefetch in (('DataLoader', False), ('PrefetchLoader', True)):
+        wait, total = run(loader, model, optimizer, device, prefetch)
+        print('{:<14}\t{:.3f}\t{:.3f}\t{:.1%}'.format(
+            name, wait, total, wait / total))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# Time to first batch of every entry script
+# Each script runs in a fresh interpreter, which imports it, parses the
+# options, builds its loaders with set_loader and draws one batch. The
+# import, set_loader and first-batch times are reported separately; the
+# first run also records the dataset-ready manifest and loader tuning that
+# later runs reuse.
+
+from __future__ import print_function
+
+import os
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPTS = ['main_supcon', 'main_ce', 'main_linear', 'main_linear_w_output',
+           'main_triplet', 'main_triplet_pair', 'main_npair', 'main_ntxent',
+           'main_supcon_no_aug']
+
+DRIVER = '''
+import json, sys, time
+start = time.perf_counter()
+module = __import__(sys.argv[1])
+imported = time.perf_counter()
+sys.argv = [sys.argv[1] + '.py'] + sys.argv[2:]
+loader = module.set_loader(module.parse_option())
+if isinstance(loader, tuple):
+    loader = loader[0]
+ready = time.perf_counter()
+next(iter(loader))
+print(json.dumps([imported - start, ready - imported,
+                  time.perf_counter() - ready]))
+'''
+
+
+def parse_option():
+    parser = argparse.ArgumentParser('argument for benchmark')
+
+    parser.add_argument('--scripts', type=str, default=','.join(SCRIPTS),
+                        help='comma-separated entry scripts')
+    parser.add_argument('--args', type=str,
+                        default='--batch_size 64 --num_workers 2',
+                        help='options passed to every script')
+    parser.add_argument('--runs', type=int, default=2,
+                        help='launches per script')
+
+    return parser.parse_args()
+
+
+def main():
+    opt = parse_option()
+    print('script\t\t\trun\tprocess s\timport s\tset_loader s\tbatch s')
+    for script in opt.scripts.split(','):
+        for run in range(opt.runs):
+            start = time.perf_counter()
+            result = subprocess.run(
+                [sys.executable, '-c', DRIVER, script] + opt.args.split(),
+                cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                universal_newlines=True)
+            total = time.perf_counter() - start
+            if result.returncode != 0:
+                print('{:<22}\t{}\tfailed: {}'.format(
+                    script, run, result.stderr.strip().splitlines()[-1]))
+                break
+            times = json.loads(result.stdout.strip().splitlines()[-1])
+            print('{:<22}\t{}\t{:.2f}\t\t{:.2f}\t{:.2f}\t\t{:.2f}'.format(
+                script, run, total, *times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+# Dense vs label-sparse positives in SupConLoss
+# Sweeps the number of classes drawn in a batch and reports forward+backward
+# time of both positive paths, plus the class count where sparse starts to win
+
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from losses import SupConLoss  # noqa: E402
+
+
+def parse_option():
+    parser = argparse.ArgumentParser('argument for benchmark')
+
+    parser.add_argument('--batch_size', type=int, default=1024,
+                        help='batch_size')
+    parser.add_argument('--n_views', type=int, default=2,
+                        help='number of views per sample')
+    parser.add_argument('--feat_dim', type=int, default=128,
+                        help='feature dimension')
+    parser.add_argument('--n_classes', type=str,
+                        default='2,10,100,1000,10000',
+                        help='class counts to sweep, can be a list')
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='timed iterations per setting')
+
+    opt = parser.parse_args()
+    opt.n_classes = [int(c) for c in opt.n_classes.split(',')]
+    return opt
+
+
+def time_loss(criterion, features, labels, repeats):
+    # one untimed step to warm up the allocator
+    criterion(features, labels).backward()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        features.grad = None
+        criterion(features, labels).backward()
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    opt = parse_option()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    dense = SupConLoss(temperature=0.1)
+    sparse = SupConLoss(temperature=0.1, positive_mode='sparse')
+
+    print('classes\tdense (ms)\tsparse (ms)\tspeedup')
+    crossover = None
+    for n_classes in opt.n_classes:
+        features = F.normalize(
+            torch.randn(opt.batch_size, opt.n_views, opt.feat_dim,
+                        device=device), dim=-1).requires_grad_()
+        labels = torch.randint(0, n_classes, (opt.batch_size,), device=device)
+
+        t_dense = time_loss(dense, features, labels, opt.repeats)
+        t_sparse = time_loss(sparse, features, labels, opt.repeats)
+        if crossover is None and t_sparse < t_dense:
+            crossover = n_classes
+        print('{}\t{:.2f}\t\t{:.2f}\t\t{:.2f}x'.format(
+            n_classes, t_dense * 1e3, t_sparse * 1e3, t_dense / t_sparse))
+
+    if crossover is None:
+        print('sparse positives never faster in this sweep')
+    else:
+        print('sparse positives faster from {} classes per {} samples'.format(
+            crossover, opt.batch_size))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+# Per-step loss throughput of the Triplet/Pair training objectives
+# Compares the pytorch_metric_learning path of the original scripts (one miner
+# and one loss call per view, four similarity matrices per step) with the
+# single Gram matrix TripletLoss / PairLoss from losses.py
+# Note the fused losses also contrast the two views against each other, so
+# per step they score about 2x the pairs and 4x the candidate triplets
+
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from losses import TripletLoss, PairLoss  # noqa: E402
+
+
+def parse_option():
+    parser = argparse.ArgumentParser('argument for benchmark')
+
+    parser.add_argument('--batch_size', type=str, default='64,256,512',
+                        help='batch sizes to sweep, can be a list')
+    parser.add_argument('--feat_dim', type=int, default=128,
+                        help='feature dimension')
+    parser.add_argument('--n_cls', type=int, default=10,
+                        help='number of classes drawn in a batch')
+    parser.add_argument('--miner', type=str, default='semihard',
+                        choices=['easy', 'hard', 'semihard', 'batch_hard'],
+                        help='triplet miner')
+    parser.add_argument('--repeats', type=int, default=5,
+                        help='timed iterations per setting')
+
+    opt = parser.parse_args()
+    opt.batch_size = [int(b) for b in opt.batch_size.split(',')]
+    return opt
+
+
+def pml_step(method, miner):
+    """loss of the original scripts, mined and scored per view"""
+    from pytorch_metric_learning.losses import TripletMarginLoss, \
+        ContrastiveLoss
+    from pytorch_metric_learning.distances import CosineSimilarity
+    from pytorch_metric_learning.reducers import ThresholdReducer
+    from pytorch_metric_learning.miners import TripletMarginMiner, \
+        PairMarginMiner, BatchHardMiner
+
+    distance = CosineSimilarity()
+    reducer = ThresholdReducer(low=0)
+    if method == 'Triplet':
+        criterion = TripletMarginLoss(
+            margin=0.2, distance=distance, reducer=reducer)
+        if miner == 'batch_hard':
+            mining_func = BatchHardMiner(distance=distance)
+        else:
+            mining_func = TripletMarginMiner(
+                margin=0.2, distance=distance, type_of_triplets=miner)
+    else:
+        criterion = ContrastiveLoss(
+            pos_margin=0.8, neg_margin=0.2, distance=distance, reducer=reducer)
+        mining_func = PairMarginMiner(
+            pos_margin=0.8, neg_margin=0.2, distance=distance)
+
+    def step(features, labels):
+        f1, f2 = features[:, 0], features[:, 1]
+        return criterion(f1, labels, mining_func(f1, labels)) + \
+            criterion(f2, labels, mining_func(f2, labels))
+    return step
+
+
+def steps_per_sec(step, features, labels, repeats):
+    step(features, labels).backward()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        features.grad = None
+        step(features, labels).backward()
+    return repeats / (time.perf_counter() - start)
+
+
+def main():
+    opt = parse_option()
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    fused = {'Triplet': TripletLoss(margin=0.2, miner=opt.miner),
+             'Pair': PairLoss(pos_margin=0.8, neg_margin=0.2)}
+
+    print('method\tbsz\tpml (step/s)\tfused (step/s)\tspeedup')
+    for method in ('Triplet', 'Pair'):
+        current = pml_step(method, opt.miner)
+        for bsz in opt.batch_size:
+            features = F.normalize(
+                torch.randn(bsz, 2, opt.feat_dim, device=device),
+                dim=-1).requires_grad_()
+            labels = torch.randint(0, opt.n_cls, (bsz,), device=device)
+
+            before = steps_per_sec(current, features, labels, opt.repeats)
+            after = steps_per_sec(fused[method], features, labels,
+                                  opt.repeats)
+            print('{}\t{}\t{:.1f}\t\t{:.1f}\t\t{:.2f}x'.format(
+                method, bsz, before, after, after / before))
+
+
+if __name__ == '__main__':
+    main()
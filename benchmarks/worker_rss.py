@@ -0,0 +1,124 @@
+# Private memory of forked loader workers with and without shared_dataset
+# Workers are forked from a parent holding a CIFAR-like array dataset and an
+# ImageFolder-like list of samples, as the DataLoader does; each touches its
+# share of the samples once. The growth of its private (copied-on-write)
+# memory is reported per worker, for the plain datasets and for the
+# share_dataset wrappers.
+
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import multiprocessing
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shared_dataset import share_dataset  # noqa: E402
+
+
+def parse_option():
+    parser = argparse.ArgumentParser('argument for benchmark')
+
+    parser.add_argument('--num_workers', type=str, default='1,4,16',
+                        help='comma-separated worker counts')
+    parser.add_argument('--n_images', type=int, default=50000,
+                        help='samples of the array dataset')
+    parser.add_argument('--n_paths', type=int, default=1281167,
+                        help='samples of the folder dataset')
+
+    return parser.parse_args()
+
+
+class ArrayDataset(object):
+    """Attributes of torchvision's CIFAR10: uint8 `data` and a list of
+    `targets`"""
+
+    def __init__(self, n):
+        self.data = np.random.randint(0, 256, (n, 32, 32, 3), dtype=np.uint8)
+        self.targets = np.random.randint(0, 10, n).tolist()
+        self.classes = [str(c) for c in range(10)]
+        self.transform = None
+        self.target_transform = None
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, index):
+        return Image.fromarray(self.data[index]), self.targets[index]
+
+
+class FolderDataset(object):
+    """Attributes of torchvision's ImageFolder, with a loader that does not
+    read the disk"""
+
+    def __init__(self, n):
+        self.classes = ['n{:08d}'.format(c) for c in range(1000)]
+        self.class_to_idx = {c: i for i, c in enumerate(self.classes)}
+        self.samples = [
+            ('/data/train/{0}/{0}_{1}.JPEG'.format(self.classes[i % 1000], i),
+             i % 1000) for i in range(n)]
+        self.targets = [s[1] for s in self.samples]
+        self.image = Image.new('RGB', (4, 4))
+        self.loader = lambda path: self.image
+        self.transform = None
+        self.target_transform = None
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, index):
+        path, target = self.samples[index]
+        return self.loader(path), target
+
+
+def private_bytes():
+    """Private_Clean + Private_Dirty of this process"""
+    total = 0
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            if line.startswith(('Private_Clean', 'Private_Dirty')):
+                total += int(line.split()[1]) * 1024
+    return total
+
+
+def worker(dataset, rank, world, results):
+    start = private_bytes()
+    for index in range(rank, len(dataset), world):
+        dataset[index]
+    results.put(private_bytes() - start)
+
+
+def measure(dataset, num_workers):
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    processes = [context.Process(target=worker,
+                                 args=(dataset, rank, num_workers, results))
+                 for rank in range(num_workers)]
+    for p in processes:
+        p.start()
+    growth = [results.get() for _ in processes]
+    for p in processes:
+        p.join()
+    return np.mean(growth) / 2 ** 20
+
+
+def main():
+    opt = parse_option()
+    datasets = [('array', ArrayDataset(opt.n_images)),
+                ('folder', FolderDataset(opt.n_paths))]
+    print('dataset\twrapper\tworkers\tMB per worker\tMB total')
+    for name, dataset in datasets:
+        for wrapper, wrapped in (('plain', dataset),
+                                 ('shared', share_dataset(dataset))):
+            for num_workers in map(int, opt.num_workers.split(',')):
+                growth = measure(wrapped, num_workers)
+                print('{}\t{}\t{}\t{:.1f}\t\t{:.1f}'.format(
+                    name, wrapper, num_workers, growth,
+                    growth * num_workers))
+
+
+if __name__ == '__main__':
+    main()
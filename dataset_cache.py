@@ -0,0 +1,197 @@
+# Decode-once cache for ImageFolder datasets
+# Every image of the folder is decoded (and optionally resized) a single time
+# into one contiguous uint8 file that is memory-mapped by every run and every
+# DataLoader worker. The cache is keyed by the folder and the resize, and a
+# manifest of file names, sizes and modification times invalidates it when
+# the folder changes.
+# Run this file to build the cache ahead of training:
+#   python dataset_cache.py --data_folder ./path --cache_dir ./datasets/cache
+
+from __future__ import print_function
+
+import os
+import argparse
+import hashlib
+import json
+import multiprocessing
+import shutil
+import tempfile
+
+import numpy as np
+import torch.utils.data as data
+from PIL import Image
+from torchvision import transforms, datasets
+from torchvision.datasets.folder import default_loader, find_classes
+from torchvision.datasets.folder import make_dataset, IMG_EXTENSIONS
+
+
+CACHE_VERSION = 1
+
+
+def _manifest_digest(root, samples, size):
+    """Digest of the relative path, label, byte size and mtime of every
+    sample, so that the cache goes stale when any file changes"""
+    digest = hashlib.sha1('{}\t{}\n'.format(CACHE_VERSION, size).encode())
+    for path, label in samples:
+        stat = os.stat(path)
+        digest.update('{}\t{}\t{}\t{}\n'.format(
+            os.path.relpath(path, root), label, stat.st_size,
+            stat.st_mtime_ns).encode())
+    return digest.hexdigest()
+
+
+def _decode(args):
+    path, size = args
+    image = default_loader(path)
+    if size is not None:
+        image = transforms.Resize(size)(image)
+    return np.asarray(image.convert('RGB'), dtype=np.uint8)
+
+
+def cache_folder(root, cache_dir, size=None):
+    """Directory of the cache of `root` resized to `size` inside
+    `cache_dir`, shared by every run with the same folder and size"""
+    key = hashlib.sha1('{}\t{}'.format(
+        os.path.abspath(root), size).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, '{}_{}_{}'.format(
+        os.path.basename(os.path.normpath(root)),
+        'full' if size is None else size, key))
+
+
+def build_cache(root, cache_dir, size=None, num_workers=0):
+    """Decode the ImageFolder at `root` into its cache directory, unless an
+    up-to-date cache is already there. Returns the cache directory.
+
+    Images are resized so that their shorter side is `size` (None keeps the
+    original resolution) and stored row-major as HWC RGB, back to back, in
+    `images.u8`. `index.npy` holds the (offset, height, width) of every
+    image and `labels.npy` its class index.
+    """
+    classes, class_to_idx = find_classes(root)
+    samples = make_dataset(root, class_to_idx, extensions=IMG_EXTENSIONS)
+    digest = _manifest_digest(root, samples, size)
+
+    folder = cache_folder(root, cache_dir, size)
+    manifest_file = os.path.join(folder, 'manifest.json')
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            if json.load(f)['digest'] == digest:
+                return folder
+        print('==> cache of {} is stale, rebuilding'.format(root))
+        shutil.rmtree(folder, ignore_errors=True)
+
+    print('==> decoding {} images of {} into {}'.format(
+        len(samples), root, folder))
+    os.makedirs(cache_dir, exist_ok=True)
+    # build next to the final location and rename it in one step, so that
+    # concurrent runs never see a partial cache
+    tmp_folder = tempfile.mkdtemp(dir=cache_dir)
+    index = np.zeros((len(samples), 3), dtype=np.int64)
+    jobs = [(path, size) for path, _ in samples]
+    pool = multiprocessing.Pool(num_workers) if num_workers > 0 else None
+    try:
+        decoded = pool.imap(_decode, jobs, chunksize=64) if pool \
+            else map(_decode, jobs)
+        offset = 0
+        with open(os.path.join(tmp_folder, 'images.u8'), 'wb') as f:
+            for i, array in enumerate(decoded):
+                index[i] = (offset, array.shape[0], array.shape[1])
+                f.write(array.tobytes())
+                offset += array.size
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    np.save(os.path.join(tmp_folder, 'index.npy'), index)
+    np.save(os.path.join(tmp_folder, 'labels.npy'),
+            np.array([label for _, label in samples], dtype=np.int64))
+    with open(os.path.join(tmp_folder, 'manifest.json'), 'w') as f:
+        json.dump({'digest': digest, 'root': os.path.abspath(root),
+                   'size': size, 'classes': classes}, f)
+    try:
+        os.rename(tmp_folder, folder)
+    except OSError:
+        # another run finished the same cache first
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+    return folder
+
+
+class CachedImageFolder(data.Dataset):
+    """Drop-in replacement for `datasets.ImageFolder` that reads the decoded
+    images from the cache built by `build_cache`.
+
+    The image file is memory-mapped, so every DataLoader worker serves its
+    samples as slices of the same page cache instead of decoding files. The
+    map is opened lazily in each process and never pickled.
+    """
+
+    def __init__(self, root, cache_dir, size=None, transform=None,
+                 target_transform=None, num_workers=0):
+        self.root = root
+        self.transform = transform
+        self.target_transform = target_transform
+        self.folder = build_cache(root, cache_dir, size, num_workers)
+        with open(os.path.join(self.folder, 'manifest.json')) as f:
+            self.classes = json.load(f)['classes']
+        self.class_to_idx = {c: i for i, c in enumerate(self.classes)}
+        self.index = np.load(os.path.join(self.folder, 'index.npy'))
+        # an array rather than a list, see shared_dataset.py
+        self.targets = np.load(os.path.join(self.folder, 'labels.npy'))
+        self.images = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['images'] = None
+        return state
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        if self.images is None:
+            self.images = np.memmap(os.path.join(self.folder, 'images.u8'),
+                                    dtype=np.uint8, mode='r')
+        offset, height, width = self.index[index]
+        array = self.images[offset:offset + height * width * 3].reshape(
+            height, width, 3)
+        image = Image.fromarray(array)
+        target = int(self.targets[index])
+        if self.transform is not None:
+            image = self.transform(image)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return image, target
+
+
+def image_folder(opt, root, transform):
+    """`CachedImageFolder` when the run has a `--cache_dir`, otherwise the
+    plain `datasets.ImageFolder`"""
+    if opt.cache_dir is None:
+        return datasets.ImageFolder(root=root, transform=transform)
+    return CachedImageFolder(root, opt.cache_dir, size=opt.cache_size,
+                             transform=transform,
+                             num_workers=opt.num_workers
+                             if opt.num_workers >= 0 else os.cpu_count())
+
+
+def parse_option():
+    parser = argparse.ArgumentParser('argument for dataset cache')
+
+    parser.add_argument('--data_folder', type=str, required=True,
+                        help='ImageFolder root to decode')
+    parser.add_argument('--cache_dir', type=str, required=True,
+                        help='directory holding the decoded caches')
+    parser.add_argument('--cache_size', type=int, default=None,
+                        help='shorter side of the cached images, '
+                        'unset keeps the original resolution')
+    parser.add_argument('--num_workers', type=int, default=16,
+                        help='num of decoding processes')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opt = parse_option()
+    print(build_cache(opt.data_folder, opt.cache_dir, opt.cache_size,
+                      opt.num_workers))
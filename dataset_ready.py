@@ -0,0 +1,57 @@
+# Fast readiness check for the torchvision datasets
+# CIFAR10/100 verify the MD5 of every batch file on each construction, and
+# once more in download(), which reads the whole dataset at every launch.
+# After a dataset has passed that check once, the size and mtime of its
+# files are recorded in READY_FILE; later runs that find the same files
+# skip the MD5 pass.
+
+from __future__ import print_function
+
+import os
+import json
+
+
+READY_FILE = './save/dataset_ready.json'
+
+
+def _file_manifest(folder):
+    """Sorted [relative path, size, mtime] of every file below `folder`"""
+    entries = []
+    for dirpath, _, filenames in os.walk(folder):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            stat = os.stat(path)
+            entries.append([os.path.relpath(path, folder), stat.st_size,
+                            stat.st_mtime_ns])
+    return sorted(entries)
+
+
+def ready_dataset(cls, root, download=False, **kwargs):
+    """`cls(root, download=download, **kwargs)` for a torchvision dataset
+    class, without the integrity check when its files are unchanged since
+    they last passed it"""
+    if not hasattr(cls, '_check_integrity'):
+        # e.g. MNIST, which only checks that its files exist
+        return cls(root=root, download=download, **kwargs)
+
+    folder = os.path.join(root, cls.base_folder)
+    key = '{} {}'.format(cls.__name__, os.path.abspath(folder))
+    cache = {}
+    if os.path.isfile(READY_FILE):
+        with open(READY_FILE) as f:
+            cache = json.load(f)
+    if os.path.isdir(folder) and cache.get(key) == _file_manifest(folder):
+        dataset = cls.__new__(cls)
+        # shadow the check during __init__ only, the instance stays a plain
+        # (picklable) cls
+        dataset._check_integrity = lambda: True
+        cls.__init__(dataset, root=root, **kwargs)
+        del dataset._check_integrity
+        return dataset
+
+    dataset = cls(root=root, download=download, **kwargs)
+    os.makedirs(os.path.dirname(READY_FILE), exist_ok=True)
+    cache[key] = _file_manifest(folder)
+    with open(READY_FILE, 'w') as f:
+        json.dump(cache, f)
+    return dataset
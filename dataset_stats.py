@@ -0,0 +1,133 @@
+# Per-channel mean and std of 'path' datasets
+# One pass over the images in DataLoader workers: every worker reduces each
+# image to its per-channel (count, mean, M2) and the main process merges them
+# with the pairwise update of Chan et al., which stays accurate in float64
+# over millions of pixels where a naive sum of squares would not. The result
+# is cached per dataset manifest in STATS_FILE, so that runs without --mean
+# and --std only pay for the scan once.
+# Run this file to compute the statistics ahead of training:
+#   python dataset_stats.py --data_folder ./path/train
+
+from __future__ import print_function
+
+import os
+import argparse
+import hashlib
+import json
+
+import torch
+from torchvision import transforms, datasets
+from torchvision.datasets.folder import find_classes
+from torchvision.datasets.folder import make_dataset, IMG_EXTENSIONS
+
+from dataset_cache import _manifest_digest
+from shard_dataset import ShardDataset
+
+
+STATS_FILE = './save/dataset_stats.json'
+
+
+def _moments(image):
+    """[C, 3] float64 (count, mean, M2) of every channel of one image"""
+    pixels = transforms.functional.pil_to_tensor(image.convert('RGB'))
+    pixels = pixels.flatten(1).double().div_(255)
+    mean = pixels.mean(1)
+    m2 = (pixels - mean[:, None]).pow_(2).sum(1)
+    return torch.stack([torch.full_like(mean, pixels.shape[1]), mean, m2], 1)
+
+
+def _merge(a, b):
+    """Chan et al. merge of two [C, 3] (count, mean, M2) moments"""
+    n = a[:, 0] + b[:, 0]
+    delta = b[:, 1] - a[:, 1]
+    mean = a[:, 1] + delta * b[:, 0] / n
+    m2 = a[:, 2] + b[:, 2] + delta.pow(2) * a[:, 0] * b[:, 0] / n
+    return torch.stack([n, mean, m2], 1)
+
+
+def _reduce(batch):
+    """Merge a [B, C, 3] batch of moments into one [C, 3]"""
+    counts, means, m2 = batch.unbind(2)
+    n = counts.sum(0)
+    mean = (counts * means).sum(0) / n
+    m2 = m2.sum(0) + (counts * (means - mean).pow(2)).sum(0)
+    return torch.stack([n, mean, m2], 1)
+
+
+def compute_stats(dataset, num_workers=0, batch_size=64):
+    """(mean, std) tuples of the pixels of `dataset`, whose transform must
+    be `_moments`"""
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size,
+                                         num_workers=num_workers)
+    total = None
+    for moments, _ in loader:
+        moments = _reduce(moments)
+        total = moments if total is None else _merge(total, moments)
+    mean = total[:, 1]
+    std = (total[:, 2] / total[:, 0]).sqrt()
+    return tuple(mean.tolist()), tuple(std.tolist())
+
+
+def dataset_stats(root, num_workers=0):
+    """Cached (mean, std) of the ImageFolder, or the tar shards written by
+    shard_dataset.py, at `root`"""
+    index_file = os.path.join(root, 'index.json')
+    if os.path.isfile(index_file):
+        with open(index_file, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+    else:
+        _, class_to_idx = find_classes(root)
+        digest = _manifest_digest(
+            root, make_dataset(root, class_to_idx, extensions=IMG_EXTENSIONS),
+            None)
+
+    cache = {}
+    if os.path.isfile(STATS_FILE):
+        with open(STATS_FILE) as f:
+            cache = json.load(f)
+    if digest in cache:
+        return tuple(cache[digest]['mean']), tuple(cache[digest]['std'])
+
+    print('==> computing mean and std of {}'.format(root))
+    if os.path.isfile(index_file):
+        dataset = ShardDataset(root, transform=_moments)
+        # a worker without a shard would only idle
+        num_workers = min(num_workers, len(dataset.shards))
+    else:
+        dataset = datasets.ImageFolder(root=root, transform=_moments)
+    mean, std = compute_stats(dataset, num_workers)
+
+    os.makedirs(os.path.dirname(STATS_FILE), exist_ok=True)
+    cache[digest] = {'root': os.path.abspath(root), 'mean': mean, 'std': std}
+    with open(STATS_FILE, 'w') as f:
+        json.dump(cache, f, indent=2)
+    return mean, std
+
+
+def path_normalization(opt, split=None):
+    """(mean, std) of a 'path' dataset: `--mean`/`--std` when given,
+    otherwise the cached statistics of `split` of the shards or folder"""
+    if opt.mean is not None:
+        return eval(opt.mean), eval(opt.std)
+    root = opt.shard_dir if opt.shard_dir is not None else opt.data_folder
+    if split is not None:
+        root = os.path.join(root, split)
+    return dataset_stats(root, num_workers=opt.num_workers
+                         if opt.num_workers >= 0 else os.cpu_count())
+
+
+def parse_option():
+    parser = argparse.ArgumentParser('argument for dataset statistics')
+
+    parser.add_argument('--data_folder', type=str, required=True,
+                        help='ImageFolder root or shard directory')
+    parser.add_argument('--num_workers', type=int, default=16,
+                        help='num of workers to use')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opt = parse_option()
+    mean, std = dataset_stats(opt.data_folder, opt.num_workers)
+    print('--mean "{}" --std "{}"'.format(mean, std))
@@ -4,19 +4,172 @@
 from __future__ import print_function
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 from torchmetrics.functional import pairwise_cosine_similarity
 
 
+def _supcon_tile(anchor_feature, contrast_feature, row_index, temperature,
+                 anchor_labels=None, contrast_labels=None, mask_rows=None):
+    """Mean log-likelihood over positives for a tile of anchor rows.
+
+    Mirrors the dense computation in `SupConLoss.forward` restricted to
+    the rows in `row_index`. The positive mask is rebuilt here from label
+    comparisons (or from the given `mask_rows`) so that only the [tile, N]
+    block ever exists.
+    """
+    # compute logits
+    anchor_dot_contrast = torch.div(
+        torch.matmul(anchor_feature, contrast_feature.T),
+        temperature)
+    # for numerical stability
+    logits_max, _ = torch.max(anchor_dot_contrast, dim=1, keepdim=True)
+    logits = anchor_dot_contrast - logits_max.detach()
+
+    # positives of this tile
+    if mask_rows is None:
+        mask = torch.eq(anchor_labels, contrast_labels).float()
+    else:
+        mask = mask_rows.repeat(
+            1, contrast_feature.shape[0] // mask_rows.shape[1])
+    # mask-out self-contrast cases
+    logits_mask = torch.scatter(
+        torch.ones_like(mask),
+        1,
+        row_index.view(-1, 1),
+        0
+    )
+    mask = mask * logits_mask
+
+    # compute log_prob
+    exp_logits = torch.exp(logits) * logits_mask
+    log_prob = logits - torch.log(exp_logits.sum(1, keepdim=True))
+
+    # compute mean of log-likelihood over positive
+    return (mask * log_prob).sum(1) / mask.sum(1)
+
+
+def _positive_mask(labels, mask, batch_size, anchor_count, contrast_count,
+                   device, dtype=torch.float32):
+    """Tiled [anchor_count * bsz, contrast_count * bsz] positive mask
+    with the self-contrast cases removed, plus the matching logits mask."""
+    if labels is None and mask is None:
+        mask = torch.eye(batch_size, dtype=dtype, device=device)
+    elif labels is not None:
+        mask = torch.eq(labels, labels.T).to(device, dtype)
+    else:
+        mask = mask.to(device, dtype)
+    mask = mask.repeat(anchor_count, contrast_count)
+    logits_mask = torch.scatter(
+        torch.ones_like(mask),
+        1,
+        torch.arange(batch_size * anchor_count, device=device).view(-1, 1),
+        0
+    )
+    return mask * logits_mask, logits_mask
+
+
+def _positive_pairs(anchor_labels, contrast_labels):
+    """Index pairs (row, col) with anchor_labels[row] == contrast_labels[col],
+    self-contrast cases (row == col) excluded.
+
+    Contrast labels are sorted into buckets once; every anchor then expands
+    its own bucket, so the cost is linear in the number of positive pairs
+    rather than in anchor_count * contrast_count.
+    """
+    device = contrast_labels.device
+    sorted_labels, order = torch.sort(contrast_labels)
+    classes, counts = torch.unique_consecutive(sorted_labels,
+                                               return_counts=True)
+    starts = torch.cumsum(counts, 0) - counts
+    bucket = torch.searchsorted(classes, anchor_labels)
+
+    n_pos = counts[bucket]
+    rows = torch.repeat_interleave(
+        torch.arange(anchor_labels.shape[0], device=device), n_pos)
+    row_starts = torch.cumsum(n_pos, 0) - n_pos
+    offset = torch.arange(rows.shape[0], device=device) \
+        - torch.repeat_interleave(row_starts, n_pos)
+    cols = order[torch.repeat_interleave(starts[bucket], n_pos) + offset]
+
+    keep = rows != cols
+    return rows[keep], cols[keep]
+
+
+class FeatureQueue(nn.Module):
+    """Fixed-size FIFO memory of past projected features and their labels.
+
+    Storage is allocated once, on the first enqueue, and then overwritten in
+    place as a ring buffer. The valid entries always form the prefix
+    [:len(queue)], so reading the queue is a view and never a concatenation.
+    """
+
+    def __init__(self, size):
+        super(FeatureQueue, self).__init__()
+        self.size = size
+        self.register_buffer('features', None)
+        self.register_buffer('labels', None)
+        self.ptr = 0
+        self.filled = 0
+
+    def __len__(self):
+        return self.filled
+
+    @torch.no_grad()
+    def enqueue(self, features, labels=None):
+        """Push features [n, D] and optional labels [n], oldest out first."""
+        if self.features is None:
+            self.features = features.new_empty(self.size, features.shape[1])
+            self.labels = torch.full((self.size,), -1, dtype=torch.long,
+                                     device=features.device)
+        n = min(features.shape[0], self.size)
+        features = features.detach()[-n:]
+        if labels is not None:
+            labels = labels.view(-1)[-n:]
+
+        # write up to the end of the buffer, then wrap around
+        head = min(n, self.size - self.ptr)
+        for dst, src in ((slice(self.ptr, self.ptr + head), slice(0, head)),
+                         (slice(0, n - head), slice(head, n))):
+            self.features[dst].copy_(features[src])
+            if labels is None:
+                self.labels[dst].fill_(-1)
+            else:
+                self.labels[dst].copy_(labels[src])
+
+        self.ptr = (self.ptr + n) % self.size
+        self.filled = min(self.filled + n, self.size)
+
+
 class SupConLoss(nn.Module):
     """Supervised Contrastive Learning: https://arxiv.org/pdf/2004.11362.pdf.
     It also supports the unsupervised contrastive loss in SimCLR"""
 
     def __init__(self, temperature=0.07, contrast_mode='all',
-                 base_temperature=0.07):
+                 base_temperature=0.07, chunk_size=None,
+                 positive_mode='dense', queue_size=0):
         super(SupConLoss, self).__init__()
+        if positive_mode not in ('dense', 'sparse'):
+            raise ValueError('Unknown positive mode: {}'.format(positive_mode))
+        if positive_mode == 'sparse' and chunk_size is not None:
+            raise ValueError('`chunk_size` only supports dense positives')
+        if queue_size > 0 and (chunk_size is not None
+                               or positive_mode != 'dense'):
+            raise ValueError('`queue_size` only supports the dense loss')
         self.temperature = temperature
         self.contrast_mode = contrast_mode
         self.base_temperature = base_temperature
+        # number of anchor rows per tile, None computes the dense
+        # [anchor_count * bsz, n_views * bsz] logits in one go
+        self.chunk_size = chunk_size
+        # 'sparse' gathers positive log-probs through label-bucketed index
+        # pairs instead of multiplying a dense [N, N] mask, which pays off
+        # when most labels in a batch are singletons
+        self.positive_mode = positive_mode
+        # memory of past batches contrasted as extra negatives (and, with
+        # labels, extra positives); only the current batch gets gradients
+        self.queue = FeatureQueue(queue_size) if queue_size > 0 else None
+        self.pending = None
 
     def forward(self, features, labels=None, mask=None):
         """Compute loss for model. If both `labels` and `mask` are None,
@@ -30,10 +183,6 @@ class SupConLoss(nn.Module):
         Returns:
             A loss scalar.
         """
-        device = (torch.device('cuda')
-                  if features.is_cuda
-                  else torch.device('cpu'))
-
         if len(features.shape) < 3:
             raise ValueError('`features` needs to be [bsz, n_views, ...],'
                              'at least 3 dimensions are required')
@@ -43,19 +192,21 @@ class SupConLoss(nn.Module):
         batch_size = features.shape[0]
         if labels is not None and mask is not None:
             raise ValueError('Cannot define both `labels` and `mask`')
-        elif labels is None and mask is None:
-            mask = torch.eye(batch_size, dtype=torch.float32).to(device)
         elif labels is not None:
             labels = labels.contiguous().view(-1, 1)
             if labels.shape[0] != batch_size:
                 raise ValueError(
                     'Num of labels does not match num of features')
-            mask = torch.eq(labels, labels.T).float().to(device)
-        else:
-            mask = mask.float().to(device)
 
         contrast_count = features.shape[1]
-        contrast_feature = torch.cat(torch.unbind(features, dim=1), dim=0)
+        if (self.contrast_mode == 'one' and self.queue is None
+                and self.chunk_size is None and self.positive_mode == 'dense'):
+            return self._one_forward(features, batch_size, labels, mask)
+
+        # view-major [n_views * bsz, D], a view when features come from a
+        # transposed [n_views, bsz, D] model output
+        contrast_feature = features.transpose(0, 1).reshape(
+            -1, features.shape[-1])
         if self.contrast_mode == 'one':
             anchor_feature = features[:, 0]
             anchor_count = 1
@@ -65,6 +216,41 @@ class SupConLoss(nn.Module):
         else:
             raise ValueError('Unknown mode: {}'.format(self.contrast_mode))
 
+        if self.queue is not None:
+            if mask is not None:
+                raise ValueError('`mask` cannot be used with a feature queue')
+            # the previous batch is pushed only now: its backward reads the
+            # queue storage, so it cannot be overwritten inside forward
+            if self.pending is not None:
+                self.queue.enqueue(*self.pending)
+            if len(self.queue) > 0:
+                loss = self._queue_forward(anchor_feature, contrast_feature,
+                                           anchor_count, contrast_count,
+                                           batch_size, labels)
+            else:
+                loss = self._dense_forward(anchor_feature, contrast_feature,
+                                           anchor_count, contrast_count,
+                                           batch_size, labels, mask)
+            self.pending = (contrast_feature.detach(), None if labels is None
+                            else labels.repeat(contrast_count, 1))
+            return loss
+
+        if self.chunk_size is not None:
+            return self._chunked_forward(anchor_feature, contrast_feature,
+                                         anchor_count, contrast_count,
+                                         batch_size, labels, mask)
+        if self.positive_mode == 'sparse':
+            return self._sparse_forward(anchor_feature, contrast_feature,
+                                        anchor_count, contrast_count,
+                                        batch_size, labels, mask)
+        return self._dense_forward(anchor_feature, contrast_feature,
+                                   anchor_count, contrast_count, batch_size,
+                                   labels, mask)
+
+    def _dense_forward(self, anchor_feature, contrast_feature, anchor_count,
+                       contrast_count, batch_size, labels, mask):
+        device = anchor_feature.device
+
         # compute logits
         anchor_dot_contrast = torch.div(
             torch.matmul(anchor_feature, contrast_feature.T),
@@ -74,16 +260,10 @@ class SupConLoss(nn.Module):
         logits_max, _ = torch.max(anchor_dot_contrast, dim=1, keepdim=True)
         logits = anchor_dot_contrast - logits_max.detach()
 
-        # tile mask
-        mask = mask.repeat(anchor_count, contrast_count)
-        # mask-out self-contrast cases
-        logits_mask = torch.scatter(
-            torch.ones_like(mask),
-            1,
-            torch.arange(batch_size * anchor_count).view(-1, 1).to(device),
-            0
-        )
-        mask = mask * logits_mask
+        # tile mask and mask-out self-contrast cases
+        mask, logits_mask = _positive_mask(labels, mask, batch_size,
+                                           anchor_count, contrast_count,
+                                           device)
 
         # compute log_prob
         exp_logits = torch.exp(logits) * logits_mask
@@ -97,3 +277,535 @@ class SupConLoss(nn.Module):
         loss = loss.view(anchor_count, batch_size).mean()
 
         return loss
+
+    def _one_forward(self, features, batch_size, labels, mask):
+        """Dense loss for `contrast_mode='one'`, only the [bsz, n_views * bsz]
+        logits block is computed.
+
+        The contrast set is view-major as in the other paths (column
+        v * bsz + j is view v of sample j), a view when features come from a
+        transposed [n_views, bsz, D] model output. The self-contrast case of
+        anchor i is column i, on the diagonal of the first bsz columns, so
+        it is removed with a strided slice instead of a logits mask.
+        """
+        device = features.device
+        contrast_count = features.shape[1]
+        anchor_feature = features[:, 0]
+        contrast_feature = features.transpose(0, 1).reshape(
+            -1, features.shape[-1])
+
+        if labels is None and mask is None:
+            mask = torch.eye(batch_size, dtype=torch.float32, device=device)
+        elif labels is not None:
+            mask = torch.eq(labels, labels.T).float().to(device)
+        else:
+            mask = mask.float().to(device)
+
+        # compute logits
+        anchor_dot_contrast = torch.div(
+            torch.matmul(anchor_feature, contrast_feature.T),
+            self.temperature)
+        logits = anchor_dot_contrast.view(batch_size, contrast_count,
+                                          batch_size)
+
+        # sum of positive logits, self-contrast cases excluded
+        self_mask = mask.diagonal()
+        pos_sum = (mask * logits.sum(1)).sum(1) \
+            - self_mask * logits[:, 0].diagonal()
+        n_pos = mask.sum(1) * contrast_count - self_mask
+
+        # mask-out self-contrast cases
+        anchor_dot_contrast.view(-1)[::contrast_count * batch_size + 1] \
+            .fill_(float('-inf'))
+        log_norm = torch.logsumexp(anchor_dot_contrast, dim=1)
+
+        # compute mean of log-likelihood over positive
+        mean_log_prob_pos = pos_sum / n_pos - log_norm
+
+        # loss
+        loss = - (self.temperature / self.base_temperature) * mean_log_prob_pos
+        loss = loss.mean()
+
+        return loss
+
+    def _chunked_forward(self, anchor_feature, contrast_feature, anchor_count,
+                         contrast_count, batch_size, labels, mask):
+        """Same loss as the dense path, computed `chunk_size` anchor rows at
+        a time. Each tile is checkpointed, so autograd keeps only the tile
+        inputs and peak memory is O(chunk_size x N) instead of O(N x N).
+        A tile spans full contrast rows, so the log-sum-exp of every row
+        is still taken over the exact row maximum.
+        """
+        device = anchor_feature.device
+        n_anchor = anchor_feature.shape[0]
+
+        if mask is None:
+            if labels is None:
+                # SimCLR: every sample is its own class
+                labels = torch.arange(batch_size, device=device)
+            labels = labels.to(device).view(-1)
+            anchor_labels = labels.repeat(anchor_count).view(-1, 1)
+            contrast_labels = labels.repeat(contrast_count).view(1, -1)
+        else:
+            mask = mask.float().to(device)
+            mask_rows = mask.repeat(anchor_count, 1)
+
+        mean_log_prob_pos = []
+        for start in range(0, n_anchor, self.chunk_size):
+            end = min(start + self.chunk_size, n_anchor)
+            row_index = torch.arange(start, end, device=device)
+            if mask is None:
+                tile_args = (anchor_labels[start:end], contrast_labels, None)
+            else:
+                tile_args = (None, None, mask_rows[start:end])
+            mean_log_prob_pos.append(checkpoint(
+                _supcon_tile, anchor_feature[start:end], contrast_feature,
+                row_index, self.temperature, *tile_args,
+                use_reentrant=False))
+        mean_log_prob_pos = torch.cat(mean_log_prob_pos)
+
+        # loss
+        loss = - (self.temperature / self.base_temperature) * mean_log_prob_pos
+        loss = loss.view(anchor_count, batch_size).mean()
+
+        return loss
+
+    def _sparse_forward(self, anchor_feature, contrast_feature, anchor_count,
+                        contrast_count, batch_size, labels, mask):
+        """Same loss as the dense path, with positives given as index pairs.
+
+        No [N, N] mask is built: the positive logits are gathered directly
+        and the self-contrast cases, which sit on the main diagonal of the
+        logits in both contrast modes, are removed in place.
+        """
+        if mask is not None:
+            raise ValueError('`mask` is not supported with sparse positives,'
+                             'pass `labels` instead')
+        device = anchor_feature.device
+        if labels is None:
+            # SimCLR: every sample is its own class
+            labels = torch.arange(batch_size, device=device)
+        labels = labels.to(device).view(-1)
+        rows, cols = _positive_pairs(labels.repeat(anchor_count),
+                                     labels.repeat(contrast_count))
+
+        # compute logits
+        anchor_dot_contrast = torch.div(
+            torch.matmul(anchor_feature, contrast_feature.T),
+            self.temperature)
+        pos_logits = anchor_dot_contrast[rows, cols]
+        # mask-out self-contrast cases
+        anchor_dot_contrast.diagonal().fill_(float('-inf'))
+        log_norm = torch.logsumexp(anchor_dot_contrast, dim=1)
+
+        # compute mean of log-likelihood over positive
+        n_anchor = anchor_feature.shape[0]
+        pos_sum = torch.zeros(n_anchor, dtype=pos_logits.dtype,
+                              device=device).index_add_(0, rows, pos_logits)
+        n_pos = torch.bincount(rows, minlength=n_anchor)
+        mean_log_prob_pos = pos_sum / n_pos - log_norm
+
+        # loss
+        loss = - (self.temperature / self.base_temperature) * mean_log_prob_pos
+        loss = loss.view(anchor_count, batch_size).mean()
+
+        return loss
+
+    def _queue_forward(self, anchor_feature, contrast_feature, anchor_count,
+                       contrast_count, batch_size, labels):
+        """Dense loss with the queued features appended to the contrast set.
+
+        The queue block of the logits is kept separate from the in-batch
+        block and both are reduced together, so the features are never
+        concatenated and autograd only reaches the current batch.
+        """
+        device = anchor_feature.device
+        queue_feature = self.queue.features[:len(self.queue)]
+
+        # compute logits
+        anchor_dot_contrast = torch.div(
+            torch.matmul(anchor_feature, contrast_feature.T),
+            self.temperature)
+        anchor_dot_queue = torch.div(
+            torch.matmul(anchor_feature, queue_feature.T),
+            self.temperature)
+        # for numerical stability
+        logits_max = torch.max(
+            anchor_dot_contrast.max(dim=1, keepdim=True)[0],
+            anchor_dot_queue.max(dim=1, keepdim=True)[0]).detach()
+        logits = anchor_dot_contrast - logits_max
+        queue_logits = anchor_dot_queue - logits_max
+
+        # tile mask and mask-out self-contrast cases
+        mask, logits_mask = _positive_mask(labels, None, batch_size,
+                                           anchor_count, contrast_count,
+                                           device)
+
+        # compute log of the normalizer over batch and queue
+        exp_sum = (torch.exp(logits) * logits_mask).sum(1) \
+            + torch.exp(queue_logits).sum(1)
+
+        # compute mean of log-likelihood over positive
+        pos_sum = (mask * logits).sum(1)
+        n_pos = mask.sum(1)
+        if labels is not None:
+            queue_mask = torch.eq(
+                labels.to(device).repeat(anchor_count, 1),
+                self.queue.labels[:len(self.queue)].view(1, -1)).float()
+            pos_sum = pos_sum + (queue_mask * queue_logits).sum(1)
+            n_pos = n_pos + queue_mask.sum(1)
+        mean_log_prob_pos = pos_sum / n_pos - torch.log(exp_sum)
+
+        # loss
+        loss = - (self.temperature / self.base_temperature) * mean_log_prob_pos
+        loss = loss.view(anchor_count, batch_size).mean()
+
+        return loss
+
+
+class SupConFunction(torch.autograd.Function):
+    """SupCon loss with a closed-form backward.
+
+    Only `features` and the labels (or mask) are saved for backward. With
+    S = anchor . contrast^T / T, the gradient of the loss w.r.t. S is the
+    softmax over the non-self columns minus the positives normalized per
+    row, which is multiplied back through both factors of the Gram matrix.
+    """
+
+    @staticmethod
+    def _logits(features, temperature, contrast_mode):
+        # view-major [n_views * bsz, D], a view when features come from a
+        # transposed [n_views, bsz, D] model output
+        contrast_feature = features.transpose(0, 1).reshape(
+            -1, features.shape[-1])
+        if contrast_mode == 'one':
+            anchor_feature = features[:, 0]
+        elif contrast_mode == 'all':
+            anchor_feature = contrast_feature
+        else:
+            raise ValueError('Unknown mode: {}'.format(contrast_mode))
+        logits = torch.matmul(anchor_feature, contrast_feature.T)
+        logits.div_(temperature)
+        # for numerical stability
+        logits.sub_(logits.max(dim=1, keepdim=True)[0])
+        return anchor_feature, contrast_feature, logits
+
+    @staticmethod
+    def forward(ctx, features, labels, mask, temperature, base_temperature,
+                contrast_mode):
+        batch_size, contrast_count = features.shape[:2]
+        anchor_count = contrast_count if contrast_mode == 'all' else 1
+        _, _, logits = SupConFunction._logits(
+            features, temperature, contrast_mode)
+        pos_mask, logits_mask = _positive_mask(
+            labels, mask, batch_size, anchor_count, contrast_count,
+            features.device, features.dtype)
+
+        log_norm = torch.log((torch.exp(logits) * logits_mask).sum(1))
+        mean_log_prob_pos = (pos_mask * logits).sum(1) / pos_mask.sum(1) \
+            - log_norm
+        loss = - (temperature / base_temperature) * mean_log_prob_pos
+
+        ctx.save_for_backward(features, labels, mask)
+        ctx.temperature = temperature
+        ctx.base_temperature = base_temperature
+        ctx.contrast_mode = contrast_mode
+        return loss.view(anchor_count, batch_size).mean()
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        features, labels, mask = ctx.saved_tensors
+        temperature = ctx.temperature
+        batch_size, contrast_count = features.shape[:2]
+        anchor_count = contrast_count if ctx.contrast_mode == 'all' else 1
+
+        anchor_feature, contrast_feature, logits = SupConFunction._logits(
+            features, temperature, ctx.contrast_mode)
+        pos_mask, logits_mask = _positive_mask(
+            labels, mask, batch_size, anchor_count, contrast_count,
+            features.device, features.dtype)
+
+        # d loss / d logits, reusing the logits buffer
+        prob = logits.exp_().mul_(logits_mask)
+        prob.div_(prob.sum(1, keepdim=True))
+        grad_logits = prob.sub_(pos_mask / pos_mask.sum(1, keepdim=True))
+        grad_logits.mul_(grad_output * (temperature / ctx.base_temperature)
+                         / (anchor_count * batch_size))
+
+        grad_anchor = torch.matmul(grad_logits, contrast_feature)
+        grad_contrast = torch.matmul(grad_logits.T, anchor_feature)
+        if ctx.contrast_mode == 'all':
+            grad_contrast += grad_anchor
+        else:
+            grad_contrast[:batch_size] += grad_anchor
+        grad_contrast.div_(temperature)
+
+        grad_features = grad_contrast.view(
+            contrast_count, batch_size, -1).transpose(0, 1)
+        return grad_features, None, None, None, None, None
+
+
+class FusedSupConLoss(SupConLoss):
+    """`SupConLoss` computed through `SupConFunction`, which keeps no
+    intermediate of the forward pass alive for backward. Only the plain
+    dense loss is fused: tiling, sparse positives and the feature queue
+    are not supported."""
+
+    def __init__(self, temperature=0.07, contrast_mode='all',
+                 base_temperature=0.07, chunk_size=None,
+                 positive_mode='dense', queue_size=0):
+        if chunk_size is not None:
+            raise ValueError('`chunk_size` is not supported by the fused loss')
+        if positive_mode != 'dense':
+            raise ValueError('`positive_mode` {} is not supported by the fused '
+                             'loss'.format(positive_mode))
+        if queue_size > 0:
+            raise ValueError('`queue_size` is not supported by the fused loss')
+        super(FusedSupConLoss, self).__init__(
+            temperature=temperature, contrast_mode=contrast_mode,
+            base_temperature=base_temperature)
+
+    def forward(self, features, labels=None, mask=None):
+        if len(features.shape) < 3:
+            raise ValueError('`features` needs to be [bsz, n_views, ...],'
+                             'at least 3 dimensions are required')
+        if len(features.shape) > 3:
+            features = features.view(features.shape[0], features.shape[1], -1)
+
+        batch_size = features.shape[0]
+        if labels is not None and mask is not None:
+            raise ValueError('Cannot define both `labels` and `mask`')
+        elif labels is not None:
+            labels = labels.contiguous().view(-1, 1)
+            if labels.shape[0] != batch_size:
+                raise ValueError(
+                    'Num of labels does not match num of features')
+
+        return SupConFunction.apply(features, labels, mask, self.temperature,
+                                    self.base_temperature, self.contrast_mode)
+
+
+def _cosine_gram(features, labels):
+    """Cosine similarity of all n_views * bsz samples against each other,
+    with the view-major labels and the same-label (self excluded) mask."""
+    n_views = features.shape[1]
+    features = features.transpose(0, 1).reshape(-1, features.shape[-1])
+    features = F.normalize(features, dim=1)
+    labels = labels.contiguous().view(-1).repeat(n_views)
+
+    sim = torch.matmul(features, features.T)
+    same = torch.eq(labels.view(-1, 1), labels.view(1, -1))
+    pos = same.clone()
+    pos.fill_diagonal_(False)
+    return sim, pos, ~same
+
+
+def _threshold_mean(losses):
+    """Mean over the strictly positive entries of non-negative `losses`,
+    zero if there are none (pytorch_metric_learning's ThresholdReducer with
+    low=0)."""
+    return losses.sum() / (losses > 0).sum().clamp(min=1)
+
+
+class TripletLoss(nn.Module):
+    """Cosine triplet margin loss with in-loss mining.
+
+    All views of the batch are scored in a single Gram matrix, so the crops
+    of one image are positives of each other. The 'easy', 'semihard' and
+    'hard' miners keep the `pytorch_metric_learning` TripletMarginMiner
+    definitions, with m = s(a, p) - s(a, n): 'easy' m > margin, 'semihard'
+    0 < m <= margin and 'hard' every triplet with m <= 0. 'batch_hard' is
+    BatchHardMiner: one triplet per anchor, from its least similar positive
+    and its most similar negative.
+    """
+
+    def __init__(self, margin=0.2, miner='semihard'):
+        super(TripletLoss, self).__init__()
+        if miner not in ('easy', 'hard', 'semihard', 'batch_hard'):
+            raise ValueError('Unknown miner: {}'.format(miner))
+        self.margin = margin
+        self.miner = miner
+
+    def forward(self, features, labels):
+        """Args:
+            features: hidden vector of shape [bsz, n_views, D].
+            labels: ground truth of shape [bsz].
+        Returns:
+            A loss scalar.
+        """
+        sim, pos, neg = _cosine_gram(features, labels)
+
+        if self.miner == 'batch_hard':
+            # hardest positive and hardest negative of every anchor row
+            valid = pos.any(1) & neg.any(1)
+            hardest_pos = sim.masked_fill(~pos, float('inf')).min(1)[0]
+            hardest_neg = sim.masked_fill(~neg, float('-inf')).max(1)[0]
+            losses = F.relu(hardest_neg[valid] - hardest_pos[valid]
+                            + self.margin)
+            return _threshold_mean(losses)
+
+        # mine on one row of candidate negatives per (anchor, positive)
+        # pair, then score only the selected triplets
+        with torch.no_grad():
+            anchor_idx, positive_idx = pos.nonzero(as_tuple=True)
+            triplet_margin = sim[anchor_idx, positive_idx].unsqueeze(1) \
+                - sim[anchor_idx]
+            if self.miner == 'easy':
+                selected = triplet_margin > self.margin
+            elif self.miner == 'hard':
+                selected = triplet_margin <= 0
+            else:
+                selected = (triplet_margin > 0) \
+                    & (triplet_margin <= self.margin)
+            selected &= neg[anchor_idx]
+            pair_idx, negative_idx = selected.nonzero(as_tuple=True)
+            anchor_idx = anchor_idx[pair_idx]
+            positive_idx = positive_idx[pair_idx]
+
+        losses = F.relu(sim[anchor_idx, negative_idx]
+                        - sim[anchor_idx, positive_idx] + self.margin)
+        return _threshold_mean(losses)
+
+
+class PairLoss(nn.Module):
+    """Cosine contrastive (pair) loss with in-loss margin mining.
+
+    Like `TripletLoss`, all views share one Gram matrix. Positive pairs with
+    similarity below `pos_margin` and negative pairs above `neg_margin` are
+    the mined pairs of pytorch_metric_learning's PairMarginMiner, and each
+    side is averaged over its non-zero losses.
+    """
+
+    def __init__(self, pos_margin=0.8, neg_margin=0.2):
+        super(PairLoss, self).__init__()
+        self.pos_margin = pos_margin
+        self.neg_margin = neg_margin
+
+    def forward(self, features, labels):
+        """Args:
+            features: hidden vector of shape [bsz, n_views, D].
+            labels: ground truth of shape [bsz].
+        Returns:
+            A loss scalar.
+        """
+        sim, pos, neg = _cosine_gram(features, labels)
+
+        # the mined pairs are exactly the ones with a non-zero hinge, so
+        # masking the dense hinge matrices is the same as mining first
+        pos_loss = F.relu(self.pos_margin - sim) * pos
+        neg_loss = F.relu(sim - self.neg_margin) * neg
+        return _threshold_mean(pos_loss) + _threshold_mean(neg_loss)
+
+
+class NTXentLoss(nn.Module):
+    """Cosine NT-Xent over all views of the batch.
+
+    Every same-label pair (a, p) among the n_views * bsz samples, including
+    the two crops of one image, is scored against the negatives of `a`:
+    -log(exp(s_ap / T) / (exp(s_ap / T) + sum_n exp(s_an / T))), and the
+    losses are averaged over the non-zero ones, as pytorch_metric_learning's
+    NTXentLoss with ThresholdReducer(low=0). Positives are gathered through
+    index pairs and negatives are masked in place, so only the [N, N] logits
+    are materialized.
+    """
+
+    def __init__(self, temperature=0.07):
+        super(NTXentLoss, self).__init__()
+        self.temperature = temperature
+
+    def forward(self, features, labels=None):
+        """Args:
+            features: hidden vector of shape [bsz, n_views, D].
+            labels: ground truth of shape [bsz], if None every image is its
+                own class as in SimCLR.
+        Returns:
+            A loss scalar.
+        """
+        batch_size, n_views = features.shape[:2]
+        if labels is None:
+            labels = torch.arange(batch_size, device=features.device)
+        labels = labels.contiguous().view(-1).repeat(n_views)
+        features = features.transpose(0, 1).reshape(-1, features.shape[-1])
+        features = F.normalize(features, dim=1)
+
+        logits = torch.matmul(features, features.T).div_(self.temperature)
+        rows, cols = _positive_pairs(labels, labels)
+        pos_logits = logits[rows, cols]
+        # log-sum-exp over the negatives of every anchor
+        logits.masked_fill_(torch.eq(labels.view(-1, 1), labels.view(1, -1)),
+                            float('-inf'))
+        neg_log_norm = torch.logsumexp(logits, dim=1)
+
+        # -log(e^p / (e^p + e^lse)) = softplus(lse - p)
+        losses = F.softplus(neg_log_norm[rows] - pos_logits)
+        return _threshold_mean(losses)
+
+
+class NPairLoss(nn.Module):
+    """Cosine N-pair loss across views.
+
+    Every view-0 feature of the batch is an anchor against all view-1
+    features and vice versa, i.e. both cross-view blocks of the 2B x 2B
+    similarity matrix, which are one [bsz, bsz] product and its transpose.
+    All same-label samples of the other view are positives: the loss of an
+    anchor is its log-sum-exp minus the mean similarity to its positives,
+    which with unique labels is the N-pair cross-entropy on the two crops
+    of each image.
+
+    With `first_per_label`, only view 0 and view 1 of the first sample of
+    each label are kept and only view 0 anchors are scored, the pairs and
+    loss of pytorch_metric_learning's NPairsLoss.
+    """
+
+    def __init__(self, first_per_label=False):
+        super(NPairLoss, self).__init__()
+        self.first_per_label = first_per_label
+
+    def forward(self, features, labels=None):
+        """Args:
+            features: hidden vector of shape [bsz, n_views, D], n_views >= 2.
+            labels: ground truth of shape [bsz], if None every image is its
+                own class.
+        Returns:
+            A loss scalar.
+        """
+        if features.shape[1] < 2:
+            raise ValueError('`features` needs at least 2 views')
+        if self.first_per_label:
+            return self._first_per_label_forward(features, labels)
+
+        anchors = F.normalize(features[:, 0], dim=1)
+        positives = F.normalize(features[:, 1], dim=1)
+        sim = torch.matmul(anchors, positives.T)
+
+        if labels is None:
+            pos = torch.eye(sim.shape[0], dtype=sim.dtype, device=sim.device)
+        else:
+            labels = labels.contiguous().view(-1)
+            pos = torch.eq(labels.view(-1, 1), labels.view(1, -1)) \
+                .to(sim.dtype)
+        # pos is symmetric, so it masks the view-1 anchors of sim.T as well
+        n_pos = pos.sum(1)
+        pos_sim = pos * sim
+        losses = torch.cat([
+            torch.logsumexp(sim, dim=1) - pos_sim.sum(1) / n_pos,
+            torch.logsumexp(sim, dim=0) - pos_sim.sum(0) / n_pos])
+        return _threshold_mean(losses)
+
+    def _first_per_label_forward(self, features, labels):
+        if labels is None:
+            first = torch.arange(features.shape[0], device=features.device)
+        else:
+            # first sample of every label, in batch order
+            sorted_labels, order = torch.sort(labels.contiguous().view(-1),
+                                              stable=True)
+            _, counts = torch.unique_consecutive(sorted_labels,
+                                                 return_counts=True)
+            first = order[torch.cumsum(counts, 0) - counts]
+        anchors = F.normalize(features[first, 0], dim=1)
+        positives = F.normalize(features[first, 1], dim=1)
+
+        sim = torch.matmul(anchors, positives.T)
+        targets = torch.arange(sim.shape[0], device=sim.device)
+        losses = F.cross_entropy(sim, targets, reduction='none')
+        return _threshold_mean(losses)
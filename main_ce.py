@@ -19,14 +19,18 @@ import torch.nn.functional as F
 
 from util import AverageMeter
 from util import adjust_learning_rate, warmup_learning_rate, accuracy
-from util import set_optimizer, save_model
-from resnet import SupCEResNet
+from util import set_optimizer, save_model, make_loader, compile_model
+from augment import BatchAugment, AugmentLoader, decode_transform
+from prefetch import PrefetchLoader
+from shared_dataset import share_dataset
+from dataset_ready import ready_dataset
+from dataset_cache import image_folder
+from batch_dataset import batch_loader
+from shard_dataset import ShardDataset
+from dataset_stats import path_normalization
+from resnet import SupCEResNet, optimize_for_inference
 
-import matplotlib.pyplot as plt
-from matplotlib import colormaps
 import numpy as np
-from sklearn.decomposition import PCA
-from sklearn.manifold import TSNE
 
 
 def parse_option():
@@ -38,8 +42,8 @@ def parse_option():
                         help='save frequency')
     parser.add_argument('--batch_size', type=int, default=256,
                         help='batch_size')
-    parser.add_argument('--num_workers', type=int, default=16,
-                        help='num of workers to use')
+    parser.add_argument('--num_workers', type=int, default=-1,
+                        help='num of workers to use, -1 tunes it')
     parser.add_argument('--epochs', type=int, default=500,
                         help='number of training epochs')
 
@@ -57,8 +61,44 @@ def parse_option():
 
     # model dataset
     parser.add_argument('--model', type=str, default='resnet50')
+    parser.add_argument('--compile', action='store_true',
+                        help='compile the encoder with torch.compile')
+    parser.add_argument('--channels_last', action='store_true',
+                        help='run the encoder in channels_last layout')
     parser.add_argument('--dataset', type=str, default='cifar10',
-                        choices=['cifar10', 'cifar100', 'mnist'], help='dataset')
+                        choices=['cifar10', 'cifar100', 'mnist', 'path'],
+                        help='dataset')
+    parser.add_argument('--mean', type=str,
+                        help='mean of dataset in path in form of str tuple, '
+                        'computed once and cached when unset')
+    parser.add_argument('--std', type=str,
+                        help='std of dataset in path in form of str tuple, '
+                        'computed once and cached when unset')
+    parser.add_argument('--data_folder', type=str, default=None,
+                        help='path to custom dataset with train/ and val/')
+    parser.add_argument('--size', type=int, default=32,
+                        help='parameter for RandomResizedCrop')
+    parser.add_argument('--batch_aug', action='store_true',
+                        help='augment collated uint8 batches in the main '
+                        'process instead of every sample in the workers')
+    parser.add_argument('--prefetch', action='store_true',
+                        help='stage the next batch on the device while the '
+                        'current step runs')
+    parser.add_argument('--shared_dataset', action='store_true',
+                        help='keep images, labels and paths in shared arrays '
+                        'so that forked workers do not copy them')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='decode path datasets once into a memory-mapped '
+                        'cache in this directory')
+    parser.add_argument('--cache_size', type=int, default=None,
+                        help='shorter side of the cached images, '
+                        'unset keeps the original resolution')
+    parser.add_argument('--shard_dir', type=str, default=None,
+                        help='stream the path dataset from the tar shards '
+                        'written by shard_dataset.py into this directory')
+    parser.add_argument('--batch_fetch', action='store_true',
+                        help='gather whole batches from the in-memory '
+                        'dataset array instead of one sample at a time')
 
     # other setting
     parser.add_argument('--cosine', action='store_true',
@@ -72,8 +112,18 @@ def parse_option():
 
     opt = parser.parse_args()
 
+    # check if dataset is path that passed required arguments
+    if opt.dataset == 'path':
+        assert (opt.data_folder is not None or opt.shard_dir is not None) \
+            and (opt.mean is None) == (opt.std is None)
+    assert opt.shard_dir is None or opt.dataset == 'path'
+
+    # only the torchvision datasets are held in memory as one array
+    assert not (opt.batch_fetch and opt.dataset == 'path')
+
     # set the path according to the environment
-    opt.data_folder = './datasets/'
+    if opt.data_folder is None:
+        opt.data_folder = './datasets/'
     opt.model_path = './save/SupCon/{}_models'.format(opt.dataset)
     opt.pic_path = './save/SupCon/{}_pic'.format(opt.dataset)
 
@@ -117,6 +167,12 @@ def parse_option():
         opt.n_cls = 100
     elif opt.dataset == 'mnist':
         opt.n_cls = 10
+    elif opt.dataset == 'path' and opt.shard_dir is not None:
+        opt.n_cls = len(ShardDataset(
+            os.path.join(opt.shard_dir, 'train')).classes)
+    elif opt.dataset == 'path':
+        opt.n_cls = len([entry for entry in os.scandir(
+            os.path.join(opt.data_folder, 'train')) if entry.is_dir()])
     else:
         raise ValueError('dataset not supported: {}'.format(opt.dataset))
     return opt
@@ -133,54 +189,97 @@ def set_loader(opt):
     elif opt.dataset == 'mnist':
         mean = (0.1307,)
         std = (0.3081,)
+    elif opt.dataset == 'path':
+        mean, std = path_normalization(opt, 'train')
     else:
         raise ValueError('dataset not supported: {}'.format(opt.dataset))
     normalize = transforms.Normalize(mean=mean, std=std)
 
-    train_transform = transforms.Compose([
-        transforms.RandomResizedCrop(size=32, scale=(0.2, 1.)),
-        transforms.RandomHorizontalFlip(),
-        transforms.ToTensor(),
-        normalize,
-    ])
+    if opt.batch_aug:
+        # decode only, crop and flip run on the collated batch
+        train_transform = decode_transform(
+            opt.size if opt.dataset == 'path' else None)
+    else:
+        train_transform = transforms.Compose([
+            transforms.RandomResizedCrop(size=opt.size, scale=(0.2, 1.)),
+            transforms.RandomHorizontalFlip(),
+            transforms.ToTensor(),
+            normalize,
+        ])
 
     val_transform = transforms.Compose([
         transforms.ToTensor(),
         normalize,
     ])
+    if opt.dataset == 'path':
+        val_transform = transforms.Compose([
+            transforms.Resize(opt.size),
+            transforms.CenterCrop(opt.size),
+            val_transform,
+        ])
 
     if opt.dataset == 'cifar10':
-        train_dataset = datasets.CIFAR10(root=opt.data_folder,
-                                         transform=train_transform,
-                                         download=True)
-        val_dataset = datasets.CIFAR10(root=opt.data_folder,
-                                       train=False,
-                                       transform=val_transform)
+        train_dataset = ready_dataset(datasets.CIFAR10,
+                                      root=opt.data_folder,
+                                      transform=train_transform,
+                                      download=True)
+        val_dataset = ready_dataset(datasets.CIFAR10,
+                                    root=opt.data_folder,
+                                    train=False,
+                                    transform=val_transform)
     elif opt.dataset == 'cifar100':
-        train_dataset = datasets.CIFAR100(root=opt.data_folder,
-                                          transform=train_transform,
-                                          download=True)
-        val_dataset = datasets.CIFAR100(root=opt.data_folder,
-                                        train=False,
-                                        transform=val_transform)
+        train_dataset = ready_dataset(datasets.CIFAR100,
+                                      root=opt.data_folder,
+                                      transform=train_transform,
+                                      download=True)
+        val_dataset = ready_dataset(datasets.CIFAR100,
+                                    root=opt.data_folder,
+                                    train=False,
+                                    transform=val_transform)
     elif opt.dataset == 'mnist':
-        train_dataset = datasets.MNIST(root=opt.data_folder,
-                                       transform=train_transform,
-                                       download=True)
-        val_dataset = datasets.MNIST(root=opt.data_folder,
-                                     train=False,
-                                     transform=val_transform)
+        train_dataset = ready_dataset(datasets.MNIST,
+                                      root=opt.data_folder,
+                                      transform=train_transform,
+                                      download=True)
+        val_dataset = ready_dataset(datasets.MNIST,
+                                    root=opt.data_folder,
+                                    train=False,
+                                    transform=val_transform)
+    elif opt.dataset == 'path' and opt.shard_dir is not None:
+        train_dataset = ShardDataset(os.path.join(opt.shard_dir, 'train'),
+                                     transform=train_transform)
+        val_dataset = ShardDataset(os.path.join(opt.shard_dir, 'val'),
+                                   transform=val_transform)
+    elif opt.dataset == 'path':
+        train_dataset = image_folder(
+            opt, os.path.join(opt.data_folder, 'train'), train_transform)
+        val_dataset = image_folder(
+            opt, os.path.join(opt.data_folder, 'val'), val_transform)
     else:
         raise ValueError(opt.dataset)
 
-    train_sampler = None
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=opt.batch_size, shuffle=(
-            train_sampler is None),
-        num_workers=opt.num_workers, pin_memory=True, sampler=train_sampler)
-    val_loader = torch.utils.data.DataLoader(
-        val_dataset, batch_size=256, shuffle=False,
-        num_workers=2, pin_memory=True)
+    if opt.shared_dataset:
+        train_dataset = share_dataset(train_dataset)
+        val_dataset = share_dataset(val_dataset)
+
+    if opt.batch_fetch:
+        # the transform runs on whole batches gathered from dataset.data
+        train_loader = batch_loader(
+            train_dataset, opt,
+            transform=None if opt.batch_aug else train_transform)
+    else:
+        train_sampler = None
+        train_loader = make_loader(
+            train_dataset, opt, batch_size=opt.batch_size, shuffle=(
+                train_sampler is None), sampler=train_sampler)
+    if opt.prefetch:
+        train_loader = PrefetchLoader(train_loader)
+    if opt.batch_aug:
+        train_loader = AugmentLoader(train_loader, BatchAugment(
+            opt.size, mean, std, scale=(0.2, 1.), jitter_p=0.,
+            grayscale_p=0.))
+    val_loader = make_loader(
+        val_dataset, opt, batch_size=256, shuffle=False, num_workers=2)
 
     return train_loader, val_loader
 
@@ -196,6 +295,8 @@ def set_model(opt):
         criterion = criterion.cuda()
         cudnn.benchmark = True
 
+    model = compile_model(model, opt)
+
     return model, criterion
 
 
@@ -343,6 +444,10 @@ def main():
     print('best accuracy: {:.2f}'.format(best_acc))
 
     # save learning curves
+    # plotting is imported here, not at module level, so that importing
+    # this module (e.g. for set_loader) stays fast
+    import matplotlib.pyplot as plt
+
     if torch.cuda.is_available():
         avg_train_acc_history = [x.cpu() for x in avg_train_acc_history]
         avg_val_acc_history = [x.cpu() for x in avg_val_acc_history]
@@ -369,14 +474,18 @@ def main():
 
     # visualize the embedding
     if opt.visualize:
+        from matplotlib import colormaps
+        from sklearn.decomposition import PCA
+        from sklearn.manifold import TSNE
+
         # shape only works for resnet50 and resnet101!
         embeddings = np.zeros(shape=(0, 2048))
         labels = np.zeros(shape=(0))
-        model.eval()
+        encoder = optimize_for_inference(model)
         with torch.no_grad():
             for image, label in iter(val_loader):
                 image = image.float().cuda()
-                emb = F.normalize(model.encoder(image), dim=1)
+                emb = F.normalize(encoder(image), dim=1)
                 labels = np.concatenate((labels, label.numpy().ravel()))
                 embeddings = np.concatenate(
                     [embeddings, emb.detach().cpu().numpy()], axis=0)
@@ -18,17 +18,14 @@ import torch.backends.cudnn as cudnn
 import torch.nn.functional as F
 
 from main_ce import set_loader
+from shard_dataset import ShardDataset
 from util import AverageMeter
 from util import adjust_learning_rate, warmup_learning_rate, accuracy
-from util import set_optimizer
-from resnet import SupConResNet, LinearClassifier
+from util import set_optimizer, compile_model
+from resnet import SupConResNet, LinearClassifier, optimize_for_inference
 
 
-import matplotlib.pyplot as plt
-from matplotlib import colormaps
 import numpy as np
-from sklearn.decomposition import PCA
-from sklearn.manifold import TSNE
 
 
 def parse_option():
@@ -40,8 +37,8 @@ def parse_option():
                         help='save frequency')
     parser.add_argument('--batch_size', type=int, default=256,
                         help='batch_size')
-    parser.add_argument('--num_workers', type=int, default=16,
-                        help='num of workers to use')
+    parser.add_argument('--num_workers', type=int, default=-1,
+                        help='num of workers to use, -1 tunes it')
     parser.add_argument('--epochs', type=int, default=100,
                         help='number of training epochs')
 
@@ -59,8 +56,47 @@ def parse_option():
 
     # model dataset
     parser.add_argument('--model', type=str, default='resnet50')
+    parser.add_argument('--compile', action='store_true',
+                        help='compile the encoder with torch.compile')
+    parser.add_argument('--channels_last', action='store_true',
+                        help='run the encoder in channels_last layout')
+    parser.add_argument('--fold_bn', action='store_true',
+                        help='fold BatchNorm into the convs of the frozen '
+                        'encoder')
     parser.add_argument('--dataset', type=str, default='cifar10',
-                        choices=['cifar10', 'cifar100', 'mnist'], help='dataset')
+                        choices=['cifar10', 'cifar100', 'mnist', 'path'],
+                        help='dataset')
+    parser.add_argument('--mean', type=str,
+                        help='mean of dataset in path in form of str tuple, '
+                        'computed once and cached when unset')
+    parser.add_argument('--std', type=str,
+                        help='std of dataset in path in form of str tuple, '
+                        'computed once and cached when unset')
+    parser.add_argument('--data_folder', type=str, default=None,
+                        help='path to custom dataset with train/ and val/')
+    parser.add_argument('--size', type=int, default=32,
+                        help='parameter for RandomResizedCrop')
+    parser.add_argument('--batch_aug', action='store_true',
+                        help='augment collated uint8 batches in the main '
+                        'process instead of every sample in the workers')
+    parser.add_argument('--prefetch', action='store_true',
+                        help='stage the next batch on the device while the '
+                        'current step runs')
+    parser.add_argument('--shared_dataset', action='store_true',
+                        help='keep images, labels and paths in shared arrays '
+                        'so that forked workers do not copy them')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='decode path datasets once into a memory-mapped '
+                        'cache in this directory')
+    parser.add_argument('--cache_size', type=int, default=None,
+                        help='shorter side of the cached images, '
+                        'unset keeps the original resolution')
+    parser.add_argument('--shard_dir', type=str, default=None,
+                        help='stream the path dataset from the tar shards '
+                        'written by shard_dataset.py into this directory')
+    parser.add_argument('--batch_fetch', action='store_true',
+                        help='gather whole batches from the in-memory '
+                        'dataset array instead of one sample at a time')
 
     # other setting
     parser.add_argument('--cosine', action='store_true',
@@ -75,8 +111,18 @@ def parse_option():
 
     opt = parser.parse_args()
 
+    # check if dataset is path that passed required arguments
+    if opt.dataset == 'path':
+        assert (opt.data_folder is not None or opt.shard_dir is not None) \
+            and (opt.mean is None) == (opt.std is None)
+    assert opt.shard_dir is None or opt.dataset == 'path'
+
+    # only the torchvision datasets are held in memory as one array
+    assert not (opt.batch_fetch and opt.dataset == 'path')
+
     # set the path according to the environment
-    opt.data_folder = './datasets/'
+    if opt.data_folder is None:
+        opt.data_folder = './datasets/'
     opt.pic_path = './save/SupCon/{}_pic'.format(opt.dataset)
 
     iterations = opt.lr_decay_epochs.split(',')
@@ -113,6 +159,12 @@ def parse_option():
         opt.n_cls = 100
     elif opt.dataset == 'mnist':
         opt.n_cls = 10
+    elif opt.dataset == 'path' and opt.shard_dir is not None:
+        opt.n_cls = len(ShardDataset(
+            os.path.join(opt.shard_dir, 'train')).classes)
+    elif opt.dataset == 'path':
+        opt.n_cls = len([entry for entry in os.scandir(
+            os.path.join(opt.data_folder, 'train')) if entry.is_dir()])
     else:
         raise ValueError('dataset not supported: {}'.format(opt.dataset))
 
@@ -144,6 +196,15 @@ def set_model(opt):
 
         model.load_state_dict(state_dict)
 
+    if opt.fold_bn:
+        # the encoder only runs frozen, in eval mode
+        encoder = optimize_for_inference(model)
+        if isinstance(model.encoder, torch.nn.DataParallel):
+            encoder = torch.nn.DataParallel(encoder)
+        model.encoder = encoder
+
+    model = compile_model(model, opt)
+
     return model, classifier, criterion
 
 
@@ -285,6 +346,9 @@ def main():
     print('best accuracy: {:.2f}'.format(best_acc))
 
     # save learning curves
+    # matplotlib is only imported once there is something to plot
+    import matplotlib.pyplot as plt
+
     if torch.cuda.is_available():
         avg_train_acc_history = [x.cpu() for x in avg_train_acc_history]
         avg_val_acc_history = [x.cpu() for x in avg_val_acc_history]
@@ -311,6 +375,10 @@ def main():
 
     # visualize the embedding
     if opt.visualize:
+        from matplotlib import colormaps
+        from sklearn.decomposition import PCA
+        from sklearn.manifold import TSNE
+
         # shape only works for resnet50 and resnet101!
         embeddings = np.zeros(shape=(0, 2048))
         labels = np.zeros(shape=(0))
@@ -16,7 +16,7 @@ import torch.backends.cudnn as cudnn
 from main_ce import set_loader
 from util import AverageMeter
 from util import adjust_learning_rate, warmup_learning_rate, accuracy
-from util import set_optimizer
+from util import set_optimizer, compile_model
 from resnet import SupConResNet, LinearClassifier
 
 
@@ -29,8 +29,8 @@ def parse_option():
                         help='save frequency')
     parser.add_argument('--batch_size', type=int, default=256,
                         help='batch_size')
-    parser.add_argument('--num_workers', type=int, default=16,
-                        help='num of workers to use')
+    parser.add_argument('--num_workers', type=int, default=-1,
+                        help='num of workers to use, -1 tunes it')
     parser.add_argument('--epochs', type=int, default=100,
                         help='number of training epochs')
 
@@ -48,8 +48,26 @@ def parse_option():
 
     # model dataset
     parser.add_argument('--model', type=str, default='resnet50')
+    parser.add_argument('--compile', action='store_true',
+                        help='compile the encoder with torch.compile')
+    parser.add_argument('--channels_last', action='store_true',
+                        help='run the encoder in channels_last layout')
     parser.add_argument('--dataset', type=str, default='cifar10',
                         choices=['cifar10', 'cifar100'], help='dataset')
+    parser.add_argument('--size', type=int, default=32,
+                        help='parameter for RandomResizedCrop')
+    parser.add_argument('--batch_aug', action='store_true',
+                        help='augment collated uint8 batches in the main '
+                        'process instead of every sample in the workers')
+    parser.add_argument('--prefetch', action='store_true',
+                        help='stage the next batch on the device while the '
+                        'current step runs')
+    parser.add_argument('--shared_dataset', action='store_true',
+                        help='keep images, labels and paths in shared arrays '
+                        'so that forked workers do not copy them')
+    parser.add_argument('--batch_fetch', action='store_true',
+                        help='gather whole batches from the in-memory '
+                        'dataset array instead of one sample at a time')
 
     # other setting
     parser.add_argument('--cosine', action='store_true',
@@ -129,6 +147,8 @@ def set_model(opt):
 
         model.load_state_dict(state_dict)
 
+    model = compile_model(model, opt)
+
     return model, classifier, criterion
 
 
@@ -1,6 +1,7 @@
 # Adapted from https://github.com/HobbitLong/SupContrast/blob/master/main_supcon.py
 # Removed syncBN related parts
 # Removed tensorboard_logger parts for compatibility with Colab, instead added python lists to record accuracies and losses
+# Replaced the per-view pytorch_metric_learning loss with the cross-view loss in losses.py, the former is kept behind --pml
 
 from __future__ import print_function
 
@@ -14,17 +15,17 @@ import torch
 import torch.backends.cudnn as cudnn
 from torchvision import transforms, datasets
 
-from util import TwoCropTransform, AverageMeter
+from util import TwoCropTransform, AverageMeter, cat_views
 from util import adjust_learning_rate, warmup_learning_rate
-from util import set_optimizer, save_model
+from util import set_optimizer, save_model, make_loader, compile_model
+from util import parse_checkpoint_segments
+from augment import BatchAugment, AugmentLoader, decode_transform
+from prefetch import PrefetchLoader
+from shared_dataset import share_dataset
+from dataset_ready import ready_dataset
+from sampler import MPerClassSampler
 from resnet import SupConResNet
-from losses import SupConLoss
-
-#from pytorch_metric_learning import distances, losses, miners, reducers, testers
-from pytorch_metric_learning.losses import NPairsLoss
-from pytorch_metric_learning.distances import CosineSimilarity
-from pytorch_metric_learning.reducers import ThresholdReducer
-from pytorch_metric_learning.miners import TripletMarginMiner
+from losses import SupConLoss, NPairLoss
 
 
 
@@ -38,8 +39,8 @@ def parse_option():
                         help='save frequency')
     parser.add_argument('--batch_size', type=int, default=256,
                         help='batch_size')
-    parser.add_argument('--num_workers', type=int, default=16,
-                        help='num of workers to use')
+    parser.add_argument('--num_workers', type=int, default=-1,
+                        help='num of workers to use, -1 tunes it')
     parser.add_argument('--epochs', type=int, default=1000,
                         help='number of training epochs')
 
@@ -57,6 +58,13 @@ def parse_option():
 
     # model dataset
     parser.add_argument('--model', type=str, default='resnet50')
+    parser.add_argument('--compile', action='store_true',
+                        help='compile the encoder with torch.compile')
+    parser.add_argument('--channels_last', action='store_true',
+                        help='run the encoder in channels_last layout')
+    parser.add_argument('--checkpoint_segments', type=str, default=None,
+                        help='activation checkpointing segments per ResNet '
+                        'stage, e.g. 2,2,2,0, or one value for all stages')
     parser.add_argument('--dataset', type=str, default='cifar10',
                         choices=['cifar10', 'cifar100', 'path'], help='dataset')
     parser.add_argument('--mean', type=str,
@@ -67,6 +75,18 @@ def parse_option():
                         default=None, help='path to custom dataset')
     parser.add_argument('--size', type=int, default=32,
                         help='parameter for RandomResizedCrop')
+    parser.add_argument('--batch_aug', action='store_true',
+                        help='augment collated uint8 batches in the main '
+                        'process instead of every sample in the workers')
+    parser.add_argument('--prefetch', action='store_true',
+                        help='stage the next batch on the device while the '
+                        'current step runs')
+    parser.add_argument('--shared_dataset', action='store_true',
+                        help='keep images, labels and paths in shared arrays '
+                        'so that forked workers do not copy them')
+    parser.add_argument('--m_per_class', type=int, default=0,
+                        help='build batches of batch_size / m_per_class '
+                        'classes with m_per_class samples each, 0 shuffles')
 
     # method
     parser.add_argument('--method', type=str, default='SupCon',
@@ -75,6 +95,8 @@ def parse_option():
     # temperature
     parser.add_argument('--temp', type=float, default=0.07,
                         help='temperature for loss function')
+    parser.add_argument('--pml', action='store_true',
+                        help='use the per-view pytorch_metric_learning loss')
 
     # other setting
     parser.add_argument('--cosine', action='store_true',
@@ -103,6 +125,9 @@ def parse_option():
     for it in iterations:
         opt.lr_decay_epochs.append(int(it))
 
+    opt.checkpoint_segments = parse_checkpoint_segments(
+        parser, opt.checkpoint_segments)
+
     opt.model_name = '{}_{}_{}_lr_{}_decay_{}_bsz_{}_temp_{}_trial_{}'.\
         format(opt.method, opt.dataset, opt.model, opt.learning_rate,
                opt.weight_decay, opt.batch_size, opt.temp, opt.trial)
@@ -110,6 +135,10 @@ def parse_option():
     if opt.cosine:
         opt.model_name = '{}_cosine'.format(opt.model_name)
 
+    if opt.m_per_class > 0:
+        opt.model_name = '{}_m_per_class_{}'.format(opt.model_name,
+                                                    opt.m_per_class)
+
     # warm-up for large-batch training,
     if opt.batch_size > 256:
         opt.warm = True
@@ -150,48 +179,73 @@ def set_loader(opt):
         raise ValueError('dataset not supported: {}'.format(opt.dataset))
     normalize = transforms.Normalize(mean=mean, std=std)
 
-    train_transform = transforms.Compose([
-        transforms.RandomResizedCrop(size=opt.size, scale=(0.2, 1.)),
-        transforms.RandomHorizontalFlip(),
-        transforms.RandomApply([
-            transforms.ColorJitter(0.4, 0.4, 0.4, 0.1)
-        ], p=0.8),
-        transforms.RandomGrayscale(p=0.2),
-        transforms.ToTensor(),
-        normalize,
-    ])
+    if opt.batch_aug:
+        # decode only, both views are drawn from the collated batch
+        train_transform = decode_transform(
+            opt.size if opt.dataset == 'path' else None)
+    else:
+        train_transform = TwoCropTransform(transforms.Compose([
+            transforms.RandomResizedCrop(size=opt.size, scale=(0.2, 1.)),
+            transforms.RandomHorizontalFlip(),
+            transforms.RandomApply([
+                transforms.ColorJitter(0.4, 0.4, 0.4, 0.1)
+            ], p=0.8),
+            transforms.RandomGrayscale(p=0.2),
+            transforms.ToTensor(),
+            normalize,
+        ]))
 
     if opt.dataset == 'cifar10':
-        train_dataset = datasets.CIFAR10(root=opt.data_folder,
-                                         transform=TwoCropTransform(
-                                             train_transform),
-                                         download=True)
+        train_dataset = ready_dataset(datasets.CIFAR10,
+                                      root=opt.data_folder,
+                                      transform=train_transform,
+                                      download=True)
     elif opt.dataset == 'cifar100':
-        train_dataset = datasets.CIFAR100(root=opt.data_folder,
-                                          transform=TwoCropTransform(
-                                              train_transform),
-                                          download=True)
+        train_dataset = ready_dataset(datasets.CIFAR100,
+                                      root=opt.data_folder,
+                                      transform=train_transform,
+                                      download=True)
     elif opt.dataset == 'path':
         train_dataset = datasets.ImageFolder(root=opt.data_folder,
-                                             transform=TwoCropTransform(train_transform))
+                                             transform=train_transform)
     else:
         raise ValueError(opt.dataset)
 
-    train_sampler = None
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=opt.batch_size, shuffle=(
-            train_sampler is None),
-        num_workers=opt.num_workers, pin_memory=True, sampler=train_sampler)
+    if opt.shared_dataset:
+        train_dataset = share_dataset(train_dataset)
+
+    if opt.m_per_class > 0:
+        train_loader = make_loader(train_dataset, opt, batch_sampler=(
+            MPerClassSampler(train_dataset.targets, opt.m_per_class,
+                             opt.batch_size)))
+    else:
+        train_sampler = None
+        train_loader = make_loader(
+            train_dataset, opt, batch_size=opt.batch_size, shuffle=(
+                train_sampler is None), sampler=train_sampler)
+    if opt.prefetch:
+        train_loader = PrefetchLoader(train_loader)
+    if opt.batch_aug:
+        train_loader = AugmentLoader(train_loader, TwoCropTransform(
+            BatchAugment(opt.size, mean, std, scale=(0.2, 1.))))
 
     return train_loader
 
 
 def set_model(opt):
-    model = SupConResNet(name=opt.model)
+    model = SupConResNet(name=opt.model,
+                         checkpoint_segments=opt.checkpoint_segments)
     #criterion = SupConLoss(temperature=opt.temp)
-    distance = CosineSimilarity()
-    reducer = ThresholdReducer(low=0)
-    criterion = NPairsLoss(reducer=reducer, distance=distance)
+    if opt.pml:
+        # per-view loss from the optional pytorch_metric_learning package
+        from pytorch_metric_learning.losses import NPairsLoss
+        from pytorch_metric_learning.distances import CosineSimilarity
+        from pytorch_metric_learning.reducers import ThresholdReducer
+        distance = CosineSimilarity()
+        reducer = ThresholdReducer(low=0)
+        criterion = NPairsLoss(reducer=reducer, distance=distance)
+    else:
+        criterion = NPairLoss()
 
     if torch.cuda.is_available():
         if torch.cuda.device_count() > 1:
@@ -200,6 +254,8 @@ def set_model(opt):
         criterion = criterion.cuda()
         cudnn.benchmark = True
 
+    model = compile_model(model, opt)
+
     return model, criterion
 
 
@@ -215,7 +271,7 @@ def train(train_loader, model, criterion, optimizer, epoch, opt):
     for idx, (images, labels) in enumerate(train_loader):
         data_time.update(time.time() - end)
 
-        images = torch.cat([images[0], images[1]], dim=0)
+        images = cat_views(images)
         if torch.cuda.is_available():
             images = images.cuda(non_blocking=True)
             labels = labels.cuda(non_blocking=True)
@@ -226,15 +282,18 @@ def train(train_loader, model, criterion, optimizer, epoch, opt):
 
         # compute loss
         features_m = model(images)
-        f1, f2 = torch.split(features_m, [bsz, bsz], dim=0)
-        features = torch.cat([f1.unsqueeze(1), f2.unsqueeze(1)], dim=1)
-        #print(features_m.shape, f1.shape, f2.shape, features.shape, labels.shape)
+        # [2 * bsz, D] -> [bsz, 2, D] without a copy
+        features = features_m.view(2, bsz, -1).transpose(0, 1)
         if opt.method == 'SupCon':
             loss = criterion(features, labels)
         elif opt.method == 'SimCLR':
             loss = criterion(features)
         elif opt.method == 'NPair':
-            loss = criterion(f1, labels) + criterion(f2, labels)
+            if opt.pml:
+                loss = criterion(features[:, 0], labels) \
+                    + criterion(features[:, 1], labels)
+            else:
+                loss = criterion(features, labels)
         else:
             raise ValueError('contrastive method not supported: {}'.
                              format(opt.method))
@@ -14,11 +14,23 @@ import torch
 import torch.backends.cudnn as cudnn
 from torchvision import transforms, datasets
 
-from util import TwoCropTransform, AverageMeter
+from util import MultiCropTransform, AverageMeter, forward_views
+from util import grad_cache_backward
 from util import adjust_learning_rate, warmup_learning_rate
-from util import set_optimizer, save_model
+from util import set_optimizer, save_model, make_loader, compile_model
+from util import parse_checkpoint_segments
+from augment import BatchAugment, AugmentLoader, decode_transform
+from prefetch import PrefetchLoader
+from shared_dataset import share_dataset
+from dataset_ready import ready_dataset
+from dataset_cache import image_folder
+from batch_dataset import batch_loader
+from shard_dataset import ShardDataset
+from dataset_stats import path_normalization
+from sampler import MPerClassSampler
+from view_store import build_view_store, ViewStoreDataset
 from resnet import SupConResNet
-from losses import SupConLoss
+from losses import SupConLoss, FusedSupConLoss
 
 
 def parse_option():
@@ -30,8 +42,8 @@ def parse_option():
                         help='save frequency')
     parser.add_argument('--batch_size', type=int, default=256,
                         help='batch_size')
-    parser.add_argument('--num_workers', type=int, default=16,
-                        help='num of workers to use')
+    parser.add_argument('--num_workers', type=int, default=-1,
+                        help='num of workers to use, -1 tunes it')
     parser.add_argument('--epochs', type=int, default=1000,
                         help='number of training epochs')
 
@@ -49,16 +61,61 @@ def parse_option():
 
     # model dataset
     parser.add_argument('--model', type=str, default='resnet50')
+    parser.add_argument('--compile', action='store_true',
+                        help='compile the encoder with torch.compile')
+    parser.add_argument('--channels_last', action='store_true',
+                        help='run the encoder in channels_last layout')
+    parser.add_argument('--checkpoint_segments', type=str, default=None,
+                        help='activation checkpointing segments per ResNet '
+                        'stage, e.g. 2,2,2,0, or one value for all stages')
     parser.add_argument('--dataset', type=str, default='cifar10',
                         choices=['cifar10', 'cifar100', 'path'], help='dataset')
     parser.add_argument('--mean', type=str,
-                        help='mean of dataset in path in form of str tuple')
+                        help='mean of dataset in path in form of str tuple, '
+                        'computed once and cached when unset')
     parser.add_argument('--std', type=str,
-                        help='std of dataset in path in form of str tuple')
+                        help='std of dataset in path in form of str tuple, '
+                        'computed once and cached when unset')
     parser.add_argument('--data_folder', type=str,
                         default=None, help='path to custom dataset')
     parser.add_argument('--size', type=int, default=32,
                         help='parameter for RandomResizedCrop')
+    parser.add_argument('--n_views', type=int, default=2,
+                        help='number of crops per image at --size')
+    parser.add_argument('--small_views', type=int, default=0,
+                        help='number of extra low-resolution crops per image')
+    parser.add_argument('--small_size', type=int, default=16,
+                        help='RandomResizedCrop size of the extra crops')
+    parser.add_argument('--batch_aug', action='store_true',
+                        help='augment collated uint8 batches in the main '
+                        'process instead of every sample in the workers')
+    parser.add_argument('--prefetch', action='store_true',
+                        help='stage the next batch on the device while the '
+                        'current step runs')
+    parser.add_argument('--shared_dataset', action='store_true',
+                        help='keep images, labels and paths in shared arrays '
+                        'so that forked workers do not copy them')
+    parser.add_argument('--m_per_class', type=int, default=0,
+                        help='build batches of batch_size / m_per_class '
+                        'classes with m_per_class samples each, 0 shuffles')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='decode path datasets once into a memory-mapped '
+                        'cache in this directory')
+    parser.add_argument('--cache_size', type=int, default=None,
+                        help='shorter side of the cached images, '
+                        'unset keeps the original resolution')
+    parser.add_argument('--shard_dir', type=str, default=None,
+                        help='stream the path dataset from the tar shards '
+                        'written by shard_dataset.py into this directory')
+    parser.add_argument('--batch_fetch', action='store_true',
+                        help='gather whole batches from the in-memory '
+                        'dataset array instead of one sample at a time')
+    parser.add_argument('--view_store', type=str, default=None,
+                        help='render augmented views once into this '
+                        'directory and sample n_views of them per epoch')
+    parser.add_argument('--store_views', type=int, default=8,
+                        help='views stored per image, more trade build time '
+                        'and disk for diversity')
 
     # method
     parser.add_argument('--method', type=str, default='SupCon',
@@ -67,6 +124,24 @@ def parse_option():
     # temperature
     parser.add_argument('--temp', type=float, default=0.07,
                         help='temperature for loss function')
+    parser.add_argument('--contrast_mode', type=str, default='all',
+                        choices=['all', 'one'],
+                        help='anchor all views or only the first view')
+    parser.add_argument('--chunk_size', type=int, default=None,
+                        help='anchor rows per SupConLoss tile, '
+                        'unset computes the dense loss')
+    parser.add_argument('--positive_mode', type=str, default='dense',
+                        choices=['dense', 'sparse'],
+                        help='how SupConLoss collects positive pairs')
+    parser.add_argument('--fused_loss', action='store_true',
+                        help='use the SupConLoss with a hand-written backward')
+    parser.add_argument('--queue_size', type=int, default=0,
+                        help='number of past features kept as extra '
+                        'contrast samples, 0 disables the queue')
+
+    parser.add_argument('--grad_cache', type=int, default=0,
+                        help='samples per encoder pass in GradCache mode, '
+                        '0 runs the whole batch at once')
 
     # other setting
     parser.add_argument('--cosine', action='store_true',
@@ -80,9 +155,23 @@ def parse_option():
 
     # check if dataset is path that passed required arguments
     if opt.dataset == 'path':
-        assert opt.data_folder is not None \
-            and opt.mean is not None \
-            and opt.std is not None
+        assert (opt.data_folder is not None or opt.shard_dir is not None) \
+            and (opt.mean is None) == (opt.std is None)
+    assert opt.shard_dir is None or opt.dataset == 'path'
+
+    # only the torchvision datasets are held in memory as one array
+    assert not (opt.batch_fetch and opt.dataset == 'path')
+
+    # the feature queue is only implemented for the dense autograd loss
+    assert not (opt.fused_loss and opt.queue_size > 0)
+
+    # shards are streamed, they have no random access and no label array
+    assert opt.shard_dir is None or not (
+        opt.m_per_class > 0 or opt.view_store is not None)
+
+    # stored views are already augmented, at a single size
+    assert opt.view_store is None or not (
+        opt.batch_aug or opt.batch_fetch or opt.small_views > 0)
 
     # set the path according to the environment
     if opt.data_folder is None:
@@ -95,6 +184,9 @@ def parse_option():
     for it in iterations:
         opt.lr_decay_epochs.append(int(it))
 
+    opt.checkpoint_segments = parse_checkpoint_segments(
+        parser, opt.checkpoint_segments)
+
     opt.model_name = '{}_{}_{}_lr_{}_decay_{}_bsz_{}_temp_{}_trial_{}'.\
         format(opt.method, opt.dataset, opt.model, opt.learning_rate,
                opt.weight_decay, opt.batch_size, opt.temp, opt.trial)
@@ -102,6 +194,25 @@ def parse_option():
     if opt.cosine:
         opt.model_name = '{}_cosine'.format(opt.model_name)
 
+    if opt.m_per_class > 0:
+        opt.model_name = '{}_m_per_class_{}'.format(opt.model_name,
+                                                    opt.m_per_class)
+
+    if opt.view_store is not None:
+        opt.model_name = '{}_store_{}'.format(opt.model_name,
+                                              opt.store_views)
+
+    if opt.contrast_mode != 'all':
+        opt.model_name = '{}_{}'.format(opt.model_name, opt.contrast_mode)
+
+    if opt.queue_size > 0:
+        opt.model_name = '{}_queue_{}'.format(opt.model_name, opt.queue_size)
+
+    if opt.n_views != 2 or opt.small_views > 0:
+        opt.model_name = '{}_views_{}x{}_{}x{}'.format(
+            opt.model_name, opt.n_views, opt.size,
+            opt.small_views, opt.small_size)
+
     # warm-up for large-batch training,
     if opt.batch_size > 256:
         opt.warm = True
@@ -136,51 +247,116 @@ def set_loader(opt):
         mean = (0.5071, 0.4867, 0.4408)
         std = (0.2675, 0.2565, 0.2761)
     elif opt.dataset == 'path':
-        mean = eval(opt.mean)
-        std = eval(opt.std)
+        mean, std = path_normalization(opt)
     else:
         raise ValueError('dataset not supported: {}'.format(opt.dataset))
     normalize = transforms.Normalize(mean=mean, std=std)
 
-    train_transform = transforms.Compose([
-        transforms.RandomResizedCrop(size=opt.size, scale=(0.2, 1.)),
-        transforms.RandomHorizontalFlip(),
-        transforms.RandomApply([
-            transforms.ColorJitter(0.4, 0.4, 0.4, 0.1)
-        ], p=0.8),
-        transforms.RandomGrayscale(p=0.2),
-        transforms.ToTensor(),
-        normalize,
-    ])
+    def view_transform(size, scale):
+        return [
+            transforms.RandomResizedCrop(size=size, scale=scale),
+            transforms.RandomHorizontalFlip(),
+            transforms.RandomApply([
+                transforms.ColorJitter(0.4, 0.4, 0.4, 0.1)
+            ], p=0.8),
+            transforms.RandomGrayscale(p=0.2),
+        ]
+
+    def crop_transform(size, scale):
+        return transforms.Compose(view_transform(size, scale) + [
+            transforms.ToTensor(),
+            normalize,
+        ])
+
+    if opt.view_store is not None:
+        # the augmentation runs offline, see view_store.py
+        train_transform = None
+    elif opt.batch_aug:
+        # decode only, the views are drawn from the collated batch
+        train_transform = decode_transform(
+            opt.size if opt.dataset == 'path' else None)
+    else:
+        train_transform = MultiCropTransform(
+            [crop_transform(opt.size, (0.2, 1.))] * opt.n_views
+            + [crop_transform(opt.small_size, (0.05, 0.4))]
+            * opt.small_views)
 
     if opt.dataset == 'cifar10':
-        train_dataset = datasets.CIFAR10(root=opt.data_folder,
-                                         transform=TwoCropTransform(
-                                             train_transform),
-                                         download=True)
+        train_dataset = ready_dataset(datasets.CIFAR10,
+                                      root=opt.data_folder,
+                                      transform=train_transform,
+                                      download=True)
     elif opt.dataset == 'cifar100':
-        train_dataset = datasets.CIFAR100(root=opt.data_folder,
-                                          transform=TwoCropTransform(
-                                              train_transform),
-                                          download=True)
+        train_dataset = ready_dataset(datasets.CIFAR100,
+                                      root=opt.data_folder,
+                                      transform=train_transform,
+                                      download=True)
+    elif opt.dataset == 'path' and opt.shard_dir is not None:
+        train_dataset = ShardDataset(opt.shard_dir, transform=train_transform)
     elif opt.dataset == 'path':
-        train_dataset = datasets.ImageFolder(root=opt.data_folder,
-                                             transform=TwoCropTransform(train_transform))
+        train_dataset = image_folder(opt, opt.data_folder, train_transform)
     else:
         raise ValueError(opt.dataset)
 
-    train_sampler = None
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=opt.batch_size, shuffle=(
-            train_sampler is None),
-        num_workers=opt.num_workers, pin_memory=True, sampler=train_sampler)
+    if opt.view_store is not None:
+        folder = build_view_store(
+            train_dataset, transforms.Compose(view_transform(opt.size,
+                                                             (0.2, 1.))),
+            opt.view_store, opt.store_views,
+            source='{} {} {}'.format(opt.dataset,
+                                     os.path.abspath(opt.data_folder),
+                                     opt.cache_size),
+            num_workers=opt.num_workers if opt.num_workers >= 0
+            else os.cpu_count())
+        train_dataset = ViewStoreDataset(
+            folder, opt.n_views,
+            transform=transforms.Compose([transforms.ToTensor(), normalize]))
+
+    if opt.shared_dataset:
+        train_dataset = share_dataset(train_dataset)
+
+    batch_sampler = None
+    if opt.m_per_class > 0:
+        batch_sampler = MPerClassSampler(train_dataset.targets,
+                                         opt.m_per_class, opt.batch_size)
+    if opt.batch_fetch:
+        # the transform runs on whole batches gathered from dataset.data
+        train_loader = batch_loader(
+            train_dataset, opt,
+            transform=None if opt.batch_aug else train_transform,
+            batch_sampler=batch_sampler)
+    elif batch_sampler is not None:
+        train_loader = make_loader(train_dataset, opt,
+                                   batch_sampler=batch_sampler)
+    else:
+        train_sampler = None
+        train_loader = make_loader(
+            train_dataset, opt, batch_size=opt.batch_size, shuffle=(
+                train_sampler is None), sampler=train_sampler)
+    if opt.prefetch:
+        train_loader = PrefetchLoader(train_loader)
+    if opt.batch_aug:
+        train_loader = AugmentLoader(train_loader, MultiCropTransform(
+            [BatchAugment(opt.size, mean, std, scale=(0.2, 1.))]
+            * opt.n_views
+            + [BatchAugment(opt.small_size, mean, std, scale=(0.05, 0.4))]
+            * opt.small_views))
 
     return train_loader
 
 
 def set_model(opt):
-    model = SupConResNet(name=opt.model)
-    criterion = SupConLoss(temperature=opt.temp)
+    model = SupConResNet(name=opt.model,
+                         checkpoint_segments=opt.checkpoint_segments)
+    if opt.fused_loss:
+        criterion = FusedSupConLoss(temperature=opt.temp,
+                                    contrast_mode=opt.contrast_mode)
+    else:
+        criterion = SupConLoss(temperature=opt.temp,
+                               contrast_mode=opt.contrast_mode,
+                               chunk_size=opt.chunk_size,
+                               positive_mode=opt.positive_mode,
+                               queue_size=opt.queue_size)
 
     if torch.cuda.is_available():
         if torch.cuda.device_count() > 1:
@@ -189,9 +365,21 @@ def set_model(opt):
         criterion = criterion.cuda()
         cudnn.benchmark = True
 
+    model = compile_model(model, opt)
+
     return model, criterion
 
 
+def compute_loss(criterion, features, labels, opt):
+    if opt.method == 'SupCon':
+        return criterion(features, labels)
+    elif opt.method == 'SimCLR':
+        return criterion(features)
+    else:
+        raise ValueError('contrastive method not supported: {}'.
+                         format(opt.method))
+
+
 def train(train_loader, model, criterion, optimizer, epoch, opt):
     """one epoch training"""
     model.train()
@@ -204,33 +392,34 @@ def train(train_loader, model, criterion, optimizer, epoch, opt):
     for idx, (images, labels) in enumerate(train_loader):
         data_time.update(time.time() - end)
 
-        images = torch.cat([images[0], images[1]], dim=0)
+        n_views = len(images)
         if torch.cuda.is_available():
-            images = images.cuda(non_blocking=True)
+            images = [view.cuda(non_blocking=True) for view in images]
             labels = labels.cuda(non_blocking=True)
         bsz = labels.shape[0]
 
         # warm-up learning rate
         warmup_learning_rate(opt, epoch, idx, len(train_loader), optimizer)
 
-        # compute loss
-        features = model(images)
-        f1, f2 = torch.split(features, [bsz, bsz], dim=0)
-        features = torch.cat([f1.unsqueeze(1), f2.unsqueeze(1)], dim=1)
-        if opt.method == 'SupCon':
-            loss = criterion(features, labels)
-        elif opt.method == 'SimCLR':
-            loss = criterion(features)
+        # compute loss and gradients
+        optimizer.zero_grad()
+        if opt.grad_cache > 0:
+            loss = grad_cache_backward(
+                model, images,
+                lambda features: compute_loss(criterion, features, labels,
+                                              opt),
+                opt.grad_cache)
         else:
-            raise ValueError('contrastive method not supported: {}'.
-                             format(opt.method))
+            features = forward_views(model, images)
+            # [n_views * bsz, D] -> [bsz, n_views, D] without a copy
+            features = features.view(n_views, bsz, -1).transpose(0, 1)
+            loss = compute_loss(criterion, features, labels, opt)
+            loss.backward()
 
         # update metric
         losses.update(loss.item(), bsz)
 
         # SGD
-        optimizer.zero_grad()
-        loss.backward()
         optimizer.step()
 
         # measure elapsed time
@@ -19,7 +19,11 @@ import torch.nn.functional as F
 
 from util import TwoCropTransform, AverageMeter
 from util import adjust_learning_rate, warmup_learning_rate
-from util import set_optimizer, save_model
+from util import set_optimizer, save_model, make_loader, compile_model
+from util import parse_checkpoint_segments
+from prefetch import PrefetchLoader
+from shared_dataset import share_dataset
+from dataset_ready import ready_dataset
 from resnet import SupConResNet
 #from losses import SupConLoss
 from pytorch_metric_learning import losses
@@ -34,8 +38,8 @@ def parse_option():
                         help='save frequency')
     parser.add_argument('--batch_size', type=int, default=256,
                         help='batch_size')
-    parser.add_argument('--num_workers', type=int, default=16,
-                        help='num of workers to use')
+    parser.add_argument('--num_workers', type=int, default=-1,
+                        help='num of workers to use, -1 tunes it')
     parser.add_argument('--epochs', type=int, default=1000,
                         help='number of training epochs')
 
@@ -53,6 +57,13 @@ def parse_option():
 
     # model dataset
     parser.add_argument('--model', type=str, default='resnet50')
+    parser.add_argument('--compile', action='store_true',
+                        help='compile the encoder with torch.compile')
+    parser.add_argument('--channels_last', action='store_true',
+                        help='run the encoder in channels_last layout')
+    parser.add_argument('--checkpoint_segments', type=str, default=None,
+                        help='activation checkpointing segments per ResNet '
+                        'stage, e.g. 2,2,2,0, or one value for all stages')
     parser.add_argument('--dataset', type=str, default='cifar10',
                         choices=['cifar10', 'cifar100', 'path', 'mnist'], help='dataset')
     parser.add_argument('--mean', type=str,
@@ -63,6 +74,12 @@ def parse_option():
                         default=None, help='path to custom dataset')
     parser.add_argument('--size', type=int, default=32,
                         help='parameter for RandomResizedCrop')
+    parser.add_argument('--prefetch', action='store_true',
+                        help='stage the next batch on the device while the '
+                        'current step runs')
+    parser.add_argument('--shared_dataset', action='store_true',
+                        help='keep images, labels and paths in shared arrays '
+                        'so that forked workers do not copy them')
 
     # method
     parser.add_argument('--method', type=str, default='SupCon',
@@ -99,6 +116,9 @@ def parse_option():
     for it in iterations:
         opt.lr_decay_epochs.append(int(it))
 
+    opt.checkpoint_segments = parse_checkpoint_segments(
+        parser, opt.checkpoint_segments)
+
     opt.model_name = '{}_{}_{}_lr_{}_decay_{}_bsz_{}_temp_{}_trial_{}'.\
         format(opt.method, opt.dataset, opt.model, opt.learning_rate,
                opt.weight_decay, opt.batch_size, opt.temp, opt.trial)
@@ -161,40 +181,48 @@ def set_loader(opt):
     ])
 
     if opt.dataset == 'cifar10':
-        train_dataset = datasets.CIFAR10(root=opt.data_folder,
-                                         #  transform=TwoCropTransform(
-                                         #      train_transform),
-                                         transform=train_transform,
-                                         download=True)
+        train_dataset = ready_dataset(datasets.CIFAR10,
+                                      root=opt.data_folder,
+                                      #  transform=TwoCropTransform(
+                                      #      train_transform),
+                                      transform=train_transform,
+                                      download=True)
     elif opt.dataset == 'cifar100':
-        train_dataset = datasets.CIFAR100(root=opt.data_folder,
-                                          #   transform=TwoCropTransform(
-                                          #       train_transform),
-                                          transform=train_transform,
-                                          download=True)
+        train_dataset = ready_dataset(datasets.CIFAR100,
+                                      root=opt.data_folder,
+                                      #   transform=TwoCropTransform(
+                                      #       train_transform),
+                                      transform=train_transform,
+                                      download=True)
     elif opt.dataset == 'path':
         train_dataset = datasets.ImageFolder(root=opt.data_folder,
                                              transform=TwoCropTransform(train_transform))
     elif opt.dataset == 'mnist':
-        train_dataset = datasets.MNIST(root=opt.data_folder,
-                                       #    transform=TwoCropTransform(
-                                       #        train_transform),
-                                       transform=train_transform,
-                                       download=True)
+        train_dataset = ready_dataset(datasets.MNIST,
+                                      root=opt.data_folder,
+                                      #    transform=TwoCropTransform(
+                                      #        train_transform),
+                                      transform=train_transform,
+                                      download=True)
     else:
         raise ValueError(opt.dataset)
 
+    if opt.shared_dataset:
+        train_dataset = share_dataset(train_dataset)
+
     train_sampler = None
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=opt.batch_size, shuffle=(
-            train_sampler is None),
-        num_workers=opt.num_workers, pin_memory=True, sampler=train_sampler)
+    train_loader = make_loader(
+        train_dataset, opt, batch_size=opt.batch_size, shuffle=(
+            train_sampler is None), sampler=train_sampler)
+    if opt.prefetch:
+        train_loader = PrefetchLoader(train_loader)
 
     return train_loader
 
 
 def set_model(opt):
-    model = SupConResNet(name=opt.model)
+    model = SupConResNet(name=opt.model,
+                         checkpoint_segments=opt.checkpoint_segments)
     #criterion = SupConLoss(temperature=opt.temp)
     criterion = losses.SupConLoss(temperature=opt.temp)
 
@@ -205,6 +233,8 @@ def set_model(opt):
         criterion = criterion.cuda()
         cudnn.benchmark = True
 
+    model = compile_model(model, opt)
+
     return model, criterion
 
 
@@ -2,6 +2,7 @@
 # Removed syncBN related parts
 # Removed tensorboard_logger parts for compatibility with Colab, instead added python lists to record accuracies and losses
 # Added triplet loss, pair loss (contrastive loss)
+# Replaced pytorch_metric_learning losses and miners with the single Gram matrix losses in losses.py
 
 from __future__ import print_function
 
@@ -15,16 +16,17 @@ import torch
 import torch.backends.cudnn as cudnn
 from torchvision import transforms, datasets
 
-from util import TwoCropTransform, AverageMeter
+from util import TwoCropTransform, AverageMeter, cat_views
 from util import adjust_learning_rate, warmup_learning_rate
-from util import set_optimizer, save_model
+from util import set_optimizer, save_model, make_loader, compile_model
+from util import parse_checkpoint_segments
+from augment import BatchAugment, AugmentLoader, decode_transform
+from prefetch import PrefetchLoader
+from shared_dataset import share_dataset
+from dataset_ready import ready_dataset
+from sampler import MPerClassSampler
 from resnet import SupConResNet
-from losses import SupConLoss
-
-from pytorch_metric_learning.losses import TripletMarginLoss, ContrastiveLoss
-from pytorch_metric_learning.distances import CosineSimilarity
-from pytorch_metric_learning.reducers import ThresholdReducer
-from pytorch_metric_learning.miners import TripletMarginMiner, PairMarginMiner
+from losses import SupConLoss, TripletLoss, PairLoss
 
 
 def parse_option():
@@ -36,8 +38,8 @@ def parse_option():
                         help='save frequency')
     parser.add_argument('--batch_size', type=int, default=256,
                         help='batch_size')
-    parser.add_argument('--num_workers', type=int, default=16,
-                        help='num of workers to use')
+    parser.add_argument('--num_workers', type=int, default=-1,
+                        help='num of workers to use, -1 tunes it')
     parser.add_argument('--epochs', type=int, default=1000,
                         help='number of training epochs')
 
@@ -55,6 +57,13 @@ def parse_option():
 
     # model dataset
     parser.add_argument('--model', type=str, default='resnet50')
+    parser.add_argument('--compile', action='store_true',
+                        help='compile the encoder with torch.compile')
+    parser.add_argument('--channels_last', action='store_true',
+                        help='run the encoder in channels_last layout')
+    parser.add_argument('--checkpoint_segments', type=str, default=None,
+                        help='activation checkpointing segments per ResNet '
+                        'stage, e.g. 2,2,2,0, or one value for all stages')
     parser.add_argument('--dataset', type=str, default='cifar10',
                         choices=['cifar10', 'cifar100', 'path'], help='dataset')
     parser.add_argument('--mean', type=str,
@@ -65,12 +74,28 @@ def parse_option():
                         default=None, help='path to custom dataset')
     parser.add_argument('--size', type=int, default=32,
                         help='parameter for RandomResizedCrop')
+    parser.add_argument('--batch_aug', action='store_true',
+                        help='augment collated uint8 batches in the main '
+                        'process instead of every sample in the workers')
+    parser.add_argument('--prefetch', action='store_true',
+                        help='stage the next batch on the device while the '
+                        'current step runs')
+    parser.add_argument('--shared_dataset', action='store_true',
+                        help='keep images, labels and paths in shared arrays '
+                        'so that forked workers do not copy them')
+    parser.add_argument('--m_per_class', type=int, default=0,
+                        help='build batches of batch_size / m_per_class '
+                        'classes with m_per_class samples each, 0 shuffles')
 
     # method
     parser.add_argument('--method', type=str, default='SupCon',
                         choices=['SupCon', 'SimCLR', 'Triplet', 'Pair'], help='choose method')
     parser.add_argument('--miner', type=str, default='semihard',
-                        choices=['easy', 'hard', 'semihard'], help='choose miner')
+                        choices=['easy', 'hard', 'semihard', 'batch_hard'],
+                        help='choose miner, hard keeps every triplet with a '
+                        'negative at least as similar as the positive, '
+                        'batch_hard only the hardest positive and negative '
+                        'of each anchor')
 
     # temperature
     parser.add_argument('--temp', type=float, default=0.07,
@@ -103,6 +128,9 @@ def parse_option():
     for it in iterations:
         opt.lr_decay_epochs.append(int(it))
 
+    opt.checkpoint_segments = parse_checkpoint_segments(
+        parser, opt.checkpoint_segments)
+
     opt.model_name = '{}_{}_{}_lr_{}_decay_{}_bsz_{}_temp_{}_trial_{}'.\
         format(opt.method, opt.dataset, opt.model, opt.learning_rate,
                opt.weight_decay, opt.batch_size, opt.temp, opt.trial)
@@ -110,6 +138,10 @@ def parse_option():
     if opt.cosine:
         opt.model_name = '{}_cosine'.format(opt.model_name)
 
+    if opt.m_per_class > 0:
+        opt.model_name = '{}_m_per_class_{}'.format(opt.model_name,
+                                                    opt.m_per_class)
+
     # warm-up for large-batch training,
     if opt.batch_size > 256:
         opt.warm = True
@@ -150,58 +182,67 @@ def set_loader(opt):
         raise ValueError('dataset not supported: {}'.format(opt.dataset))
     normalize = transforms.Normalize(mean=mean, std=std)
 
-    train_transform = transforms.Compose([
-        transforms.RandomResizedCrop(size=opt.size, scale=(0.2, 1.)),
-        transforms.RandomHorizontalFlip(),
-        transforms.RandomApply([
-            transforms.ColorJitter(0.4, 0.4, 0.4, 0.1)
-        ], p=0.8),
-        transforms.RandomGrayscale(p=0.2),
-        transforms.ToTensor(),
-        normalize,
-    ])
+    if opt.batch_aug:
+        # decode only, both views are drawn from the collated batch
+        train_transform = decode_transform(
+            opt.size if opt.dataset == 'path' else None)
+    else:
+        train_transform = TwoCropTransform(transforms.Compose([
+            transforms.RandomResizedCrop(size=opt.size, scale=(0.2, 1.)),
+            transforms.RandomHorizontalFlip(),
+            transforms.RandomApply([
+                transforms.ColorJitter(0.4, 0.4, 0.4, 0.1)
+            ], p=0.8),
+            transforms.RandomGrayscale(p=0.2),
+            transforms.ToTensor(),
+            normalize,
+        ]))
 
     if opt.dataset == 'cifar10':
-        train_dataset = datasets.CIFAR10(root=opt.data_folder,
-                                         transform=TwoCropTransform(
-                                             train_transform),
-                                         download=True)
+        train_dataset = ready_dataset(datasets.CIFAR10,
+                                      root=opt.data_folder,
+                                      transform=train_transform,
+                                      download=True)
     elif opt.dataset == 'cifar100':
-        train_dataset = datasets.CIFAR100(root=opt.data_folder,
-                                          transform=TwoCropTransform(
-                                              train_transform),
-                                          download=True)
+        train_dataset = ready_dataset(datasets.CIFAR100,
+                                      root=opt.data_folder,
+                                      transform=train_transform,
+                                      download=True)
     elif opt.dataset == 'path':
         train_dataset = datasets.ImageFolder(root=opt.data_folder,
-                                             transform=TwoCropTransform(train_transform))
+                                             transform=train_transform)
     else:
         raise ValueError(opt.dataset)
 
-    train_sampler = None
-    train_loader = torch.utils.data.DataLoader(
-        train_dataset, batch_size=opt.batch_size, shuffle=(
-            train_sampler is None),
-        num_workers=opt.num_workers, pin_memory=True, sampler=train_sampler)
+    if opt.shared_dataset:
+        train_dataset = share_dataset(train_dataset)
+
+    if opt.m_per_class > 0:
+        train_loader = make_loader(train_dataset, opt, batch_sampler=(
+            MPerClassSampler(train_dataset.targets, opt.m_per_class,
+                             opt.batch_size)))
+    else:
+        train_sampler = None
+        train_loader = make_loader(
+            train_dataset, opt, batch_size=opt.batch_size, shuffle=(
+                train_sampler is None), sampler=train_sampler)
+    if opt.prefetch:
+        train_loader = PrefetchLoader(train_loader)
+    if opt.batch_aug:
+        train_loader = AugmentLoader(train_loader, TwoCropTransform(
+            BatchAugment(opt.size, mean, std, scale=(0.2, 1.))))
 
     return train_loader
 
 
 def set_model(opt):
-    model = SupConResNet(name=opt.model)
+    model = SupConResNet(name=opt.model,
+                         checkpoint_segments=opt.checkpoint_segments)
 
-    distance = CosineSimilarity()
-    reducer = ThresholdReducer(low=0)
     if opt.method == 'Triplet':
-        criterion = TripletMarginLoss(
-            margin=0.2, distance=distance, reducer=reducer)
-        mining_func = TripletMarginMiner(
-            margin=0.2, distance=distance, type_of_triplets=opt.miner
-        )
+        criterion = TripletLoss(margin=0.2, miner=opt.miner)
     elif opt.method == 'Pair':
-        criterion = ContrastiveLoss(
-            pos_margin=0.8, neg_margin=0.2, distance=distance, reducer=reducer)
-        mining_func = PairMarginMiner(
-            pos_margin=0.8, neg_margin=0.2, distance=distance)
+        criterion = PairLoss(pos_margin=0.8, neg_margin=0.2)
 
     if torch.cuda.is_available():
         if torch.cuda.device_count() > 1:
@@ -210,10 +251,12 @@ def set_model(opt):
         criterion = criterion.cuda()
         cudnn.benchmark = True
 
-    return model, criterion, mining_func
+    model = compile_model(model, opt)
 
+    return model, criterion
 
-def train(train_loader, model, criterion, mining_func, optimizer, epoch, opt):
+
+def train(train_loader, model, criterion, optimizer, epoch, opt):
     """one epoch training"""
     model.train()
 
@@ -225,7 +268,7 @@ def train(train_loader, model, criterion, mining_func, optimizer, epoch, opt):
     for idx, (images, labels) in enumerate(train_loader):
         data_time.update(time.time() - end)
 
-        images = torch.cat([images[0], images[1]], dim=0)
+        images = cat_views(images)
         if torch.cuda.is_available():
             images = images.cuda(non_blocking=True)
             labels = labels.cuda(non_blocking=True)
@@ -236,23 +279,14 @@ def train(train_loader, model, criterion, mining_func, optimizer, epoch, opt):
 
         # compute loss
         features_m = model(images)
-        f1, f2 = torch.split(features_m, [bsz, bsz], dim=0)
-        features = torch.cat([f1.unsqueeze(1), f2.unsqueeze(1)], dim=1)
-        #print(features_m.shape, f1.shape, f2.shape, features.shape, labels.shape)
+        # [2 * bsz, D] -> [bsz, 2, D] without a copy
+        features = features_m.view(2, bsz, -1).transpose(0, 1)
         if opt.method == 'SupCon':
             loss = criterion(features, labels)
         elif opt.method == 'SimCLR':
             loss = criterion(features)
-        elif opt.method == 'Triplet':
-            indices_tuple1 = mining_func(f1, labels)
-            indices_tuple2 = mining_func(f2, labels)
-            loss = criterion(f1, labels, indices_tuple1) + \
-                criterion(f2, labels, indices_tuple2)
-        elif opt.method == 'Pair':
-            indices_tuple1 = mining_func(f1, labels)
-            indices_tuple2 = mining_func(f2, labels)
-            loss = criterion(f1, labels, indices_tuple1) + \
-                criterion(f2, labels, indices_tuple2)
+        elif opt.method in ('Triplet', 'Pair'):
+            loss = criterion(features, labels)
         else:
             raise ValueError('contrastive method not supported: {}'.
                              format(opt.method))
@@ -289,7 +323,7 @@ def main():
     train_loader = set_loader(opt)
 
     # build model and criterion
-    model, criterion, mining_func = set_model(opt)
+    model, criterion = set_model(opt)
 
     # build optimizer
     optimizer = set_optimizer(opt, model)
@@ -301,8 +335,7 @@ def main():
 
         # train for one epoch
         time1 = time.time()
-        loss = train(train_loader, model, criterion,
-                     mining_func, optimizer, epoch, opt)
+        loss = train(train_loader, model, criterion, optimizer, epoch, opt)
         time2 = time.time()
         print('epoch {}, total time {:.2f}'.format(epoch, time2 - time1))
 
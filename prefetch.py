@@ -0,0 +1,197 @@
+# Host-to-device prefetching for the training loops
+# The next batch is staged while the current step runs: on a GPU host it is
+# packed into a pinned ring buffer and copied on a side stream; on a CPU-only
+# host a background thread loads it ahead. In both cases all views of a batch
+# end up back to back in one buffer, so `util.cat_views` merges them without
+# a copy.
+
+from __future__ import print_function
+
+import queue
+import threading
+
+import torch
+
+
+def _leaves(batch):
+    """Tensors of an (images, labels) batch, images either one tensor or a
+    list of views, in a fixed order"""
+    images, labels = batch
+    if torch.is_tensor(images):
+        return [images, labels]
+    return list(images) + [labels]
+
+
+def _rebuild(batch, leaves):
+    images, _ = batch
+    if torch.is_tensor(images):
+        return leaves[0], leaves[1]
+    return leaves[:-1], leaves[-1]
+
+
+def _pack(leaves, buffers, device=None, pin_memory=False):
+    """Copy `leaves` back to back into one flat buffer per dtype, growing
+    `buffers` when needed. Returns the packed views of the leaves."""
+    sizes = {}
+    for leaf in leaves:
+        sizes[leaf.dtype] = sizes.get(leaf.dtype, 0) + leaf.numel()
+    for dtype, numel in sizes.items():
+        if dtype not in buffers or buffers[dtype].numel() < numel:
+            buffers[dtype] = torch.empty(numel, dtype=dtype, device=device,
+                                         pin_memory=pin_memory)
+    offsets = dict.fromkeys(sizes, 0)
+    packed = []
+    for leaf in leaves:
+        start = offsets[leaf.dtype]
+        view = buffers[leaf.dtype][start:start + leaf.numel()].view(
+            leaf.shape)
+        view.copy_(leaf)
+        packed.append(view)
+        offsets[leaf.dtype] = start + leaf.numel()
+    return packed
+
+
+class _Slot(object):
+    """One entry of the ring: pinned host buffers, their device copies and
+    the events ordering their reuse"""
+
+    def __init__(self):
+        self.host = {}
+        self.device = {}
+        self.copied = None
+        self.released = None
+
+
+class PrefetchLoader(object):
+    """Wraps a loader of (images, labels) batches and yields them already on
+    `device`, one step ahead of the consumer.
+
+    On CUDA every batch is packed into the pinned buffers of one of `depth`
+    ring slots and copied to the device on a side stream, so the transfer
+    overlaps the previous step. A slot is refilled only after its previous
+    copy finished and after the step that used its device buffers was
+    enqueued. On CPU a background thread keeps up to `depth` packed batches
+    ready.
+    """
+
+    def __init__(self, loader, device=None, depth=2):
+        if device is None:
+            device = torch.device('cuda' if torch.cuda.is_available()
+                                  else 'cpu')
+        self.loader = loader
+        self.device = torch.device(device)
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device.type == 'cuda':
+            return self._cuda_iter()
+        return self._thread_iter()
+
+    def _cuda_iter(self):
+        current = torch.cuda.current_stream(self.device)
+        stream = torch.cuda.Stream(device=self.device)
+        slots = [_Slot() for _ in range(self.depth)]
+
+        def stage(batch, slot):
+            # the copy of the previous batch in this slot still reads host
+            if slot.copied is not None:
+                slot.copied.synchronize()
+            leaves = _pack(_leaves(batch), slot.host, pin_memory=True)
+            used = {}
+            for leaf in leaves:
+                used[leaf.dtype] = used.get(leaf.dtype, 0) + leaf.numel()
+            for dtype, host in slot.host.items():
+                if dtype not in slot.device \
+                        or slot.device[dtype].numel() < host.numel():
+                    slot.device[dtype] = torch.empty(
+                        host.numel(), dtype=dtype, device=self.device)
+            with torch.cuda.stream(stream):
+                # the step that last read this slot must be done with it
+                if slot.released is not None:
+                    stream.wait_event(slot.released)
+                for dtype, numel in used.items():
+                    slot.device[dtype][:numel].copy_(
+                        slot.host[dtype][:numel], non_blocking=True)
+                slot.copied = torch.cuda.Event()
+                slot.copied.record(stream)
+
+            offsets = dict.fromkeys(used, 0)
+            device_leaves = []
+            for leaf in leaves:
+                start = offsets[leaf.dtype]
+                device_leaves.append(
+                    slot.device[leaf.dtype][start:start + leaf.numel()]
+                    .view(leaf.shape))
+                offsets[leaf.dtype] = start + leaf.numel()
+            return _rebuild(batch, device_leaves)
+
+        iterator = iter(self.loader)
+        pending = []
+        n_staged = 0
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < self.depth:
+                batch = next(iterator, None)
+                if batch is None:
+                    exhausted = True
+                    break
+                slot = slots[n_staged % self.depth]
+                pending.append((stage(batch, slot), slot))
+                n_staged += 1
+            if not pending:
+                return
+            batch, slot = pending.pop(0)
+            current.wait_event(slot.copied)
+            yield batch
+            # the consumer is back for the next batch, so all of its work on
+            # this one is enqueued
+            slot.released = torch.cuda.Event()
+            slot.released.record(current)
+
+    def _thread_iter(self):
+        ready = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+        done = object()
+
+        def put(item):
+            # never block for good: the consumer may have stopped iterating
+            while not stop.is_set():
+                try:
+                    ready.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker():
+            try:
+                for batch in self.loader:
+                    if not put(_rebuild(batch, _pack(_leaves(batch), {}))):
+                        return
+                put(done)
+            except Exception as e:
+                put(e)
+
+        thread = threading.Thread(target=worker, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = ready.get()
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # runs on exhaustion, on an exception in the consumer and when
+            # an abandoned iterator is closed; the queued batches are
+            # dropped so that their buffers are freed with it
+            stop.set()
+            while True:
+                try:
+                    ready.get_nowait()
+                except queue.Empty:
+                    break
@@ -0,0 +1,243 @@
+# INT8 post-training quantization of a trained encoder for CPU serving
+# The encoder of a SupCon/SupCE checkpoint (the model class and head are
+# read from its keys) is BN-folded and conv+ReLU fused by
+# resnet.optimize_for_inference, observed on a sample of training
+# batches, converted to int8 with eager-mode static quantization and saved
+# as TorchScript. The report compares fp32 and int8 embeddings by kNN and
+# linear-probe accuracy on the validation set, and by CPU throughput.
+#   python quantize.py --ckpt ./save/SupCon/.../last.pth --model resnet50
+
+from __future__ import print_function
+
+import os
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao import quantization
+from torchvision import transforms, datasets
+
+from util import make_loader
+from dataset_ready import ready_dataset
+from dataset_cache import image_folder
+from dataset_stats import path_normalization
+from resnet import SupConResNet, SupCEResNet, optimize_for_inference
+
+
+def parse_option():
+    parser = argparse.ArgumentParser('argument for quantization')
+
+    parser.add_argument('--ckpt', type=str, required=True,
+                        help='path to pre-trained model')
+    parser.add_argument('--model', type=str, default='resnet50')
+    parser.add_argument('--dataset', type=str, default='cifar10',
+                        choices=['cifar10', 'cifar100', 'path'],
+                        help='dataset')
+    parser.add_argument('--mean', type=str,
+                        help='mean of dataset in path in form of str tuple, '
+                        'computed once and cached when unset')
+    parser.add_argument('--std', type=str,
+                        help='std of dataset in path in form of str tuple, '
+                        'computed once and cached when unset')
+    parser.add_argument('--data_folder', type=str, default='./datasets/',
+                        help='path to custom dataset')
+    parser.add_argument('--size', type=int, default=32,
+                        help='parameter for RandomResizedCrop')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='decode path datasets once into a memory-mapped '
+                        'cache in this directory')
+    parser.add_argument('--cache_size', type=int, default=None,
+                        help='shorter side of the cached images, '
+                        'unset keeps the original resolution')
+    parser.add_argument('--batch_size', type=int, default=256,
+                        help='batch_size')
+    parser.add_argument('--num_workers', type=int, default=-1,
+                        help='num of workers to use, -1 tunes it')
+    parser.add_argument('--backend', type=str, default='x86',
+                        choices=['x86', 'fbgemm', 'qnnpack'],
+                        help='quantized engine')
+    parser.add_argument('--calib_batches', type=int, default=32,
+                        help='training batches observed for calibration')
+    parser.add_argument('--knn_k', type=int, default=200,
+                        help='neighbours of the kNN classifier')
+    parser.add_argument('--probe_epochs', type=int, default=30,
+                        help='epochs of the linear probe')
+    parser.add_argument('--output', type=str, default=None,
+                        help='int8 TorchScript file, next to the checkpoint '
+                        'by default')
+
+    opt = parser.parse_args()
+    # image folders only, shards have no random access for the probes
+    opt.shard_dir = None
+    if opt.output is None:
+        opt.output = os.path.join(os.path.dirname(opt.ckpt),
+                                  'encoder_int8.pt')
+    return opt
+
+
+def set_loader(opt):
+    """Train and validation loaders with the evaluation transform, the
+    train loader shuffled so that its first batches are a sample"""
+    if opt.dataset == 'cifar10':
+        mean = (0.4914, 0.4822, 0.4465)
+        std = (0.2023, 0.1994, 0.2010)
+    elif opt.dataset == 'cifar100':
+        mean = (0.5071, 0.4867, 0.4408)
+        std = (0.2675, 0.2565, 0.2761)
+    else:
+        mean, std = path_normalization(opt, 'train')
+    transform = transforms.Compose([
+        transforms.ToTensor(),
+        transforms.Normalize(mean=mean, std=std),
+    ])
+
+    if opt.dataset == 'path':
+        transform = transforms.Compose([
+            transforms.Resize(opt.size),
+            transforms.CenterCrop(opt.size),
+            transform,
+        ])
+        train_dataset = image_folder(
+            opt, os.path.join(opt.data_folder, 'train'), transform)
+        val_dataset = image_folder(
+            opt, os.path.join(opt.data_folder, 'val'), transform)
+    else:
+        cls = datasets.CIFAR10 if opt.dataset == 'cifar10' \
+            else datasets.CIFAR100
+        train_dataset = ready_dataset(cls, root=opt.data_folder,
+                                      transform=transform,
+                                      download=True)
+        val_dataset = ready_dataset(cls, root=opt.data_folder,
+                                    train=False,
+                                    transform=transform)
+
+    train_loader = make_loader(train_dataset, opt, batch_size=opt.batch_size,
+                               shuffle=True, pin_memory=False)
+    val_loader = make_loader(val_dataset, opt, batch_size=opt.batch_size,
+                             shuffle=False, pin_memory=False)
+    return train_loader, val_loader
+
+
+def load_model(opt):
+    """SupCEResNet for a checkpoint with a `fc` classifier, SupConResNet
+    with the matching projection head otherwise"""
+    state_dict = torch.load(opt.ckpt, map_location='cpu')['model']
+    state_dict = {k.replace('module.', ''): v for k, v in state_dict.items()}
+    if 'fc.weight' in state_dict:
+        model = SupCEResNet(name=opt.model,
+                            num_classes=state_dict['fc.weight'].shape[0])
+    elif 'head.weight' in state_dict:
+        model = SupConResNet(name=opt.model, head='linear',
+                             feat_dim=state_dict['head.weight'].shape[0])
+    else:
+        model = SupConResNet(name=opt.model, head='mlp',
+                             feat_dim=state_dict['head.2.weight'].shape[0])
+    model.load_state_dict(state_dict)
+    return model.eval()
+
+
+def quantize_encoder(model, loader, n_batches, backend='x86'):
+    """int8 copy of the encoder of `model`, calibrated on the first
+    `n_batches` batches of `loader`"""
+    torch.backends.quantized.engine = backend
+    encoder = nn.Sequential(quantization.QuantStub(),
+                            optimize_for_inference(model),
+                            quantization.DeQuantStub()).eval()
+    encoder.qconfig = quantization.get_default_qconfig(backend)
+    quantization.prepare(encoder, inplace=True)
+    with torch.no_grad():
+        for idx, (images, _) in enumerate(loader):
+            if idx == n_batches:
+                break
+            encoder(images)
+    quantization.convert(encoder, inplace=True)
+    return encoder
+
+
+def extract(encoder, loader):
+    features, labels = [], []
+    with torch.no_grad():
+        for images, targets in loader:
+            features.append(encoder(images))
+            labels.append(targets)
+    return torch.cat(features), torch.cat(labels)
+
+
+def knn_accuracy(train_features, train_labels, val_features, val_labels, k,
+                 temperature=0.07, chunk=1024):
+    """Accuracy of a cosine kNN with similarity-weighted votes"""
+    train_features = F.normalize(train_features, dim=1)
+    n_cls = int(train_labels.max()) + 1
+    correct = 0
+    for start in range(0, len(val_features), chunk):
+        query = F.normalize(val_features[start:start + chunk], dim=1)
+        sim, idx = (query @ train_features.t()).topk(k, dim=1)
+        votes = torch.zeros(len(query), n_cls)
+        votes.scatter_add_(1, train_labels[idx], (sim / temperature).exp())
+        correct += (votes.argmax(1) == val_labels[start:start + chunk]).sum()
+    return 100. * float(correct) / len(val_features)
+
+
+def probe_accuracy(train_features, train_labels, val_features, val_labels,
+                   epochs, batch_size=256):
+    """Accuracy of a linear classifier trained on the frozen features"""
+    torch.manual_seed(0)
+    n_cls = int(train_labels.max()) + 1
+    classifier = nn.Linear(train_features.shape[1], n_cls)
+    optimizer = torch.optim.Adam(classifier.parameters(), lr=1e-3)
+    for _ in range(epochs):
+        for idx in torch.randperm(len(train_features)).split(batch_size):
+            loss = F.cross_entropy(classifier(train_features[idx]),
+                                   train_labels[idx])
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+    with torch.no_grad():
+        predictions = classifier(val_features).argmax(1)
+    return 100. * float((predictions == val_labels).sum()) / len(val_labels)
+
+
+def throughput(encoder, images, steps=10):
+    with torch.inference_mode():
+        encoder(images)
+        start = time.perf_counter()
+        for _ in range(steps):
+            encoder(images)
+    return steps * len(images) / (time.perf_counter() - start)
+
+
+def main():
+    opt = parse_option()
+    train_loader, val_loader = set_loader(opt)
+    model = load_model(opt)
+
+    int8 = quantize_encoder(model, train_loader, opt.calib_batches,
+                            opt.backend)
+    images = next(iter(val_loader))[0]
+    int8 = torch.jit.freeze(torch.jit.trace(int8, images))
+    torch.jit.save(int8, opt.output)
+    print('==> int8 encoder saved to {}'.format(opt.output))
+
+    fp32 = model.encoder
+    print('encoder\tkNN acc\tprobe acc\timg/s')
+    results = {}
+    for name, encoder in (('fp32', fp32), ('int8', int8)):
+        train_features, train_labels = extract(encoder, train_loader)
+        val_features, val_labels = extract(encoder, val_loader)
+        knn = knn_accuracy(train_features, train_labels, val_features,
+                           val_labels, opt.knn_k)
+        probe = probe_accuracy(train_features, train_labels, val_features,
+                               val_labels, opt.probe_epochs)
+        speed = throughput(encoder, images)
+        results[name] = knn, probe, speed
+        print('{}\t{:.2f}\t{:.2f}\t\t{:.1f}'.format(name, knn, probe, speed))
+    print('int8 - fp32: kNN {:+.2f}, probe {:+.2f}, speed x{:.2f}'.format(
+        results['int8'][0] - results['fp32'][0],
+        results['int8'][1] - results['fp32'][1],
+        results['int8'][2] / results['fp32'][2]))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,16 @@
 # Adapted from https://github.com/HobbitLong/SupContrast/blob/master/networks/resnet_big.py
 # Removed class LinearBatchNorm for SyncBN purpose
 
+from contextlib import contextmanager, nullcontext
+from functools import partial
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
+from torch.ao.nn.intrinsic import ConvReLU2d
+from torch.ao.nn.quantized import FloatFunctional
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 
 class BasicBlock(nn.Module):
@@ -26,11 +33,13 @@ class BasicBlock(nn.Module):
                           kernel_size=1, stride=stride, bias=False),
                 nn.BatchNorm2d(self.expansion * planes)
             )
+        # the residual add as a module, so that quantization can observe it
+        self.skip_add = FloatFunctional()
 
     def forward(self, x):
         out = F.relu(self.bn1(self.conv1(x)))
         out = self.bn2(self.conv2(out))
-        out += self.shortcut(x)
+        out = self.skip_add.add(out, self.shortcut(x))
         preact = out
         out = F.relu(out)
         if self.is_last:
@@ -61,12 +70,14 @@ class Bottleneck(nn.Module):
                           kernel_size=1, stride=stride, bias=False),
                 nn.BatchNorm2d(self.expansion * planes)
             )
+        # the residual add as a module, so that quantization can observe it
+        self.skip_add = FloatFunctional()
 
     def forward(self, x):
         out = F.relu(self.bn1(self.conv1(x)))
         out = F.relu(self.bn2(self.conv2(out)))
         out = self.bn3(self.conv3(out))
-        out += self.shortcut(x)
+        out = self.skip_add.add(out, self.shortcut(x))
         preact = out
         out = F.relu(out)
         if self.is_last:
@@ -75,18 +86,77 @@ class Bottleneck(nn.Module):
             return out
 
 
+@contextmanager
+def frozen_batch_norms(module):
+    """Context in which the forward passes of `module` leave the running
+    statistics and `num_batches_tracked` of its BatchNorm layers unchanged,
+    while still normalizing with the batch statistics in training mode."""
+    batch_norms = [m for m in module.modules()
+                   if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    momentum = [m.momentum for m in batch_norms]
+    tracked = [None if m.num_batches_tracked is None
+               else m.num_batches_tracked.clone() for m in batch_norms]
+    for m in batch_norms:
+        m.momentum = 0.
+    try:
+        yield
+    finally:
+        for m, value, count in zip(batch_norms, momentum, tracked):
+            m.momentum = value
+            if count is not None:
+                m.num_batches_tracked.copy_(count)
+
+
+class _CheckpointedStage(nn.Sequential):
+    """Stage of residual blocks that, in training with autograd on, runs as
+    `segments` checkpointed chunks: only the input of each chunk is kept
+    and the activations inside are recomputed in backward. The
+    recomputation runs under `frozen_batch_norms`, so the running statistics
+    are updated once per step as without checkpointing."""
+
+    def __init__(self, blocks, segments):
+        super(_CheckpointedStage, self).__init__(*blocks)
+        self.segments = min(segments, len(blocks))
+
+    def _context(self):
+        return nullcontext(), frozen_batch_norms(self)
+
+    def _run(self, start, end, x):
+        for block in list(self)[start:end]:
+            x = block(x)
+        return x
+
+    def forward(self, x):
+        if not (self.training and torch.is_grad_enabled()):
+            return super(_CheckpointedStage, self).forward(x)
+        bounds = [len(self) * i // self.segments
+                  for i in range(self.segments + 1)]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            x = checkpoint(partial(self._run, start, end), x,
+                           use_reentrant=False, context_fn=self._context)
+        return x
+
+
 class ResNet(nn.Module):
-    def __init__(self, block, num_blocks, in_channel=3, zero_init_residual=False):
+    def __init__(self, block, num_blocks, in_channel=3, zero_init_residual=False,
+                 checkpoint_segments=None):
+        """`checkpoint_segments` gives, per stage, the number of activation
+        checkpointing segments; 0 or None keeps the stage as is"""
         super(ResNet, self).__init__()
         self.in_planes = 64
+        segments = checkpoint_segments or [0] * 4
 
         self.conv1 = nn.Conv2d(in_channel, 64, kernel_size=3, stride=1, padding=1,
                                bias=False)
         self.bn1 = nn.BatchNorm2d(64)
-        self.layer1 = self._make_layer(block, 64, num_blocks[0], stride=1)
-        self.layer2 = self._make_layer(block, 128, num_blocks[1], stride=2)
-        self.layer3 = self._make_layer(block, 256, num_blocks[2], stride=2)
-        self.layer4 = self._make_layer(block, 512, num_blocks[3], stride=2)
+        self.layer1 = self._make_layer(block, 64, num_blocks[0], stride=1,
+                                       segments=segments[0])
+        self.layer2 = self._make_layer(block, 128, num_blocks[1], stride=2,
+                                       segments=segments[1])
+        self.layer3 = self._make_layer(block, 256, num_blocks[2], stride=2,
+                                       segments=segments[2])
+        self.layer4 = self._make_layer(block, 512, num_blocks[3], stride=2,
+                                       segments=segments[3])
         self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
 
         for m in self.modules():
@@ -108,13 +178,15 @@ class ResNet(nn.Module):
                 elif isinstance(m, BasicBlock):
                     nn.init.constant_(m.bn2.weight, 0)
 
-    def _make_layer(self, block, planes, num_blocks, stride):
+    def _make_layer(self, block, planes, num_blocks, stride, segments=0):
         strides = [stride] + [1] * (num_blocks - 1)
         layers = []
         for i in range(num_blocks):
             stride = strides[i]
             layers.append(block(self.in_planes, planes, stride))
             self.in_planes = planes * block.expansion
+        if segments:
+            return _CheckpointedStage(layers, segments)
         return nn.Sequential(*layers)
 
     def forward(self, x, layer=100):
@@ -144,6 +216,71 @@ def resnet101(**kwargs):
     return ResNet(Bottleneck, [3, 4, 23, 3], **kwargs)
 
 
+class _FoldedBlock(nn.Module):
+    """BasicBlock or Bottleneck with every BatchNorm folded into the
+    preceding conv, the ReLUs inside the residual branch fused with their
+    conv and the final ReLU fused with the residual add"""
+
+    def __init__(self, block):
+        super(_FoldedBlock, self).__init__()
+        if isinstance(block, Bottleneck):
+            pairs = [(block.conv1, block.bn1), (block.conv2, block.bn2),
+                     (block.conv3, block.bn3)]
+        else:
+            pairs = [(block.conv1, block.bn1), (block.conv2, block.bn2)]
+        convs = [fuse_conv_bn_eval(conv, bn) for conv, bn in pairs]
+        self.branch = nn.Sequential(
+            *[ConvReLU2d(conv, nn.ReLU(inplace=True)) for conv in convs[:-1]],
+            convs[-1])
+        if len(block.shortcut) > 0:
+            self.shortcut = fuse_conv_bn_eval(block.shortcut[0],
+                                              block.shortcut[1])
+        else:
+            self.shortcut = nn.Identity()
+        self.skip_add = FloatFunctional()
+
+    def forward(self, x):
+        return self.skip_add.add_relu(self.branch(x), self.shortcut(x))
+
+
+class InferenceResNet(nn.Module):
+    """Eval-only ResNet encoder built by `optimize_for_inference`"""
+
+    def __init__(self, encoder):
+        super(InferenceResNet, self).__init__()
+        self.stem = ConvReLU2d(fuse_conv_bn_eval(encoder.conv1, encoder.bn1),
+                               nn.ReLU(inplace=True))
+        self.layers = nn.Sequential(*[
+            _FoldedBlock(block)
+            for layer in (encoder.layer1, encoder.layer2, encoder.layer3,
+                          encoder.layer4)
+            for block in layer])
+        self.avgpool = nn.AdaptiveAvgPool2d((1, 1))
+
+    def forward(self, x):
+        out = self.layers(self.stem(x))
+        out = self.avgpool(out)
+        return torch.flatten(out, 1)
+
+
+def optimize_for_inference(model):
+    """Frozen copy of the encoder of `model` (SupConResNet, SupCEResNet or
+    a bare ResNet) for embedding extraction: BatchNorm is folded into the
+    conv weights with the running statistics, conv+ReLU pairs are fused,
+    and the projection head or classifier is dropped. `model` itself is
+    left unchanged."""
+    encoder = getattr(model, 'encoder', model)
+    if isinstance(encoder, nn.DataParallel):
+        encoder = encoder.module
+    training = encoder.training
+    encoder.eval()
+    folded = InferenceResNet(encoder).eval()
+    encoder.train(training)
+    for param in folded.parameters():
+        param.requires_grad_(False)
+    return folded
+
+
 model_dict = {
     'resnet18': [resnet18, 512],
     'resnet34': [resnet34, 512],
@@ -155,10 +292,11 @@ model_dict = {
 class SupConResNet(nn.Module):
     """backbone + projection head"""
 
-    def __init__(self, name='resnet50', head='mlp', feat_dim=128):
+    def __init__(self, name='resnet50', head='mlp', feat_dim=128,
+                 checkpoint_segments=None):
         super(SupConResNet, self).__init__()
         model_fun, dim_in = model_dict[name]
-        self.encoder = model_fun()
+        self.encoder = model_fun(checkpoint_segments=checkpoint_segments)
         if head == 'linear':
             self.head = nn.Linear(dim_in, feat_dim)
         elif head == 'mlp':
@@ -0,0 +1,62 @@
+# Class-balanced batch sampling
+# Batches of P classes x M samples, so that every anchor has same-class
+# partners for SupConLoss and the triplet/pair miners.
+
+from __future__ import print_function
+
+import numpy as np
+import torch
+import torch.utils.data as data
+
+
+class MPerClassSampler(data.Sampler):
+    """Batch sampler yielding index lists of `batch_size // m` distinct
+    classes with `m` samples each.
+
+    The indices of every class are kept in a shuffled pool with a cursor;
+    a batch draws its classes and then takes the next `m` entries of each
+    pool, reshuffling a pool when it runs out. The cost of a batch is
+    therefore linear in its size and independent of the dataset. Classes
+    with fewer than `m` samples are drawn with replacement.
+    """
+
+    def __init__(self, labels, m, batch_size, length=None):
+        labels = np.asarray(labels.tolist() if torch.is_tensor(labels)
+                            else labels)
+        if batch_size % m != 0:
+            raise ValueError('batch_size {} is not a multiple of m {}'
+                             .format(batch_size, m))
+        self.classes = np.unique(labels)
+        self.pools = [np.flatnonzero(labels == c) for c in self.classes]
+        self.m = m
+        self.n_classes = batch_size // m
+        if self.n_classes > len(self.classes):
+            raise ValueError('{} classes per batch requested, the dataset '
+                             'has {}'.format(self.n_classes,
+                                             len(self.classes)))
+        self.batch_size = batch_size
+        # as many batches as a plain epoch over the dataset
+        self.length = length if length is not None \
+            else len(labels) // batch_size
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        rng = np.random.default_rng(
+            torch.randint(2 ** 62, (1,)).item())
+        pools = [rng.permutation(pool) for pool in self.pools]
+        cursors = [0] * len(pools)
+        for _ in range(self.length):
+            batch = []
+            for c in rng.choice(len(pools), self.n_classes, replace=False):
+                pool = pools[c]
+                if len(pool) < self.m:
+                    batch.extend(rng.choice(pool, self.m).tolist())
+                    continue
+                if cursors[c] + self.m > len(pool):
+                    pools[c] = pool = rng.permutation(pool)
+                    cursors[c] = 0
+                batch.extend(pool[cursors[c]:cursors[c] + self.m].tolist())
+                cursors[c] += self.m
+            yield batch
@@ -0,0 +1,177 @@
+# Sharded tar archives for 'path' datasets larger than RAM
+# `datasets.ImageFolder` walks the whole tree at startup and then reads one
+# small file per sample at random. Here the folder is walked once, offline,
+# and its files are written in shuffled order into tar shards of
+# `shard_size` samples (the encoded bytes, not decoded pixels) plus a small
+# index. Training streams whole shards sequentially: startup only reads the
+# index, the workers split the shards between them and a shuffle buffer
+# mixes the samples within each worker.
+# Run this file to write the shards ahead of training:
+#   python shard_dataset.py --data_folder ./path/train --shard_dir ./shards/train
+
+from __future__ import print_function
+
+import io
+import os
+import argparse
+import json
+import multiprocessing
+import random
+import shutil
+import tarfile
+import tempfile
+
+import torch
+import torch.utils.data as data
+from PIL import Image
+from torchvision.datasets.folder import find_classes
+from torchvision.datasets.folder import make_dataset, IMG_EXTENSIONS
+
+
+def _write_shard(args):
+    path, samples = args
+    with tarfile.open(path, 'w') as tar:
+        for key, (image_path, label) in samples:
+            tar.add(image_path, arcname=key + os.path.splitext(
+                image_path)[1].lower())
+            # the label follows its image, so a reader pairs them on the fly
+            payload = str(label).encode()
+            info = tarfile.TarInfo(key + '.cls')
+            info.size = len(payload)
+            tar.addfile(info, io.BytesIO(payload))
+    return len(samples)
+
+
+def write_shards(root, shard_dir, shard_size=1000, num_workers=0, seed=0):
+    """Write the ImageFolder at `root` into tar shards of `shard_size`
+    samples in `shard_dir`, in a fixed random order so that every shard
+    mixes all classes. Returns `shard_dir`."""
+    classes, class_to_idx = find_classes(root)
+    samples = make_dataset(root, class_to_idx, extensions=IMG_EXTENSIONS)
+    order = list(range(len(samples)))
+    random.Random(seed).shuffle(order)
+
+    print('==> writing {} images of {} into {}'.format(
+        len(samples), root, shard_dir))
+    parent = os.path.dirname(os.path.abspath(shard_dir))
+    os.makedirs(parent, exist_ok=True)
+    # write next to the final location and rename it in one step, so that
+    # readers never see a partial set of shards
+    tmp_folder = tempfile.mkdtemp(dir=parent)
+    jobs = []
+    for start in range(0, len(order), shard_size):
+        name = 'shard-{:06d}.tar'.format(len(jobs))
+        jobs.append((os.path.join(tmp_folder, name),
+                     [('{:09d}'.format(i), samples[i])
+                      for i in order[start:start + shard_size]]))
+    pool = multiprocessing.Pool(num_workers) if num_workers > 0 else None
+    try:
+        counts = list(pool.imap(_write_shard, jobs) if pool
+                      else map(_write_shard, jobs))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    with open(os.path.join(tmp_folder, 'index.json'), 'w') as f:
+        json.dump({'root': os.path.abspath(root), 'classes': classes,
+                   'shards': [[os.path.basename(path), count] for
+                              (path, _), count in zip(jobs, counts)]}, f)
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    os.rename(tmp_folder, shard_dir)
+    return shard_dir
+
+
+class ShardDataset(data.IterableDataset):
+    """Streams the samples of the tar shards written by `write_shards`.
+
+    Every epoch the shards are put in a new order, shared by all DataLoader
+    workers, and worker `w` of `n` reads shards `w, w + n, ...`. Each worker
+    passes its encoded samples through a buffer of `shuffle_buffer` entries
+    and decodes them only when they leave it. Use at most as many workers as
+    there are shards.
+    """
+
+    def __init__(self, shard_dir, transform=None, target_transform=None,
+                 shuffle_buffer=1000):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, 'index.json')) as f:
+            index = json.load(f)
+        self.classes = index['classes']
+        self.class_to_idx = {c: i for i, c in enumerate(self.classes)}
+        self.shards = [name for name, _ in index['shards']]
+        self.length = sum(count for _, count in index['shards'])
+        self.transform = transform
+        self.target_transform = target_transform
+        self.shuffle_buffer = shuffle_buffer
+        # drawn once, so that every worker copy agrees on the shard order
+        self.seed = torch.randint(2 ** 31, (1,)).item()
+        self.epoch = 0
+
+    def __len__(self):
+        return self.length
+
+    def _samples(self, shards):
+        """(encoded image, label) pairs of `shards`, in file order"""
+        for name in shards:
+            with tarfile.open(os.path.join(self.shard_dir, name),
+                              mode='r|') as tar:
+                image = None
+                for member in tar:
+                    payload = tar.extractfile(member).read()
+                    if member.name.endswith('.cls'):
+                        yield image, int(payload)
+                    else:
+                        image = payload
+
+    def __iter__(self):
+        info = data.get_worker_info()
+        worker, n_workers = (0, 1) if info is None \
+            else (info.id, info.num_workers)
+        epoch = self.epoch
+        self.epoch += 1
+        shards = list(self.shards)
+        random.Random(self.seed + epoch).shuffle(shards)
+        rng = random.Random((self.seed + epoch) * n_workers + worker)
+
+        buffer = []
+        for sample in self._samples(shards[worker::n_workers]):
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            i = rng.randrange(len(buffer))
+            buffer[i], sample = sample, buffer[i]
+            yield self._decode(sample)
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield self._decode(sample)
+
+    def _decode(self, sample):
+        image, target = sample
+        image = Image.open(io.BytesIO(image)).convert('RGB')
+        if self.transform is not None:
+            image = self.transform(image)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return image, target
+
+
+def parse_option():
+    parser = argparse.ArgumentParser('argument for sharding')
+
+    parser.add_argument('--data_folder', type=str, required=True,
+                        help='ImageFolder root to shard')
+    parser.add_argument('--shard_dir', type=str, required=True,
+                        help='directory to write the shards to')
+    parser.add_argument('--shard_size', type=int, default=1000,
+                        help='samples per shard')
+    parser.add_argument('--num_workers', type=int, default=16,
+                        help='num of writing processes')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    opt = parse_option()
+    print(write_shards(opt.data_folder, opt.shard_dir, opt.shard_size,
+                       opt.num_workers))
@@ -0,0 +1,90 @@
+# Dataset wrappers without per-sample Python objects
+# Forked DataLoader workers share the parent's memory copy-on-write, but
+# every access to a Python int, str or tuple updates its refcount and so
+# dirties the page it lives on. With lists of labels or (path, label)
+# tuples, each worker slowly copies them all. The wrappers below keep images
+# in shared memory and labels and paths in flat arrays instead.
+
+from __future__ import print_function
+
+import numpy as np
+import torch
+import torch.utils.data as data
+from PIL import Image
+
+
+class SharedArrayDataset(data.Dataset):
+    """In-memory torchvision dataset (CIFAR10/100, MNIST) with `data` and
+    `targets` moved into shared-memory tensors."""
+
+    def __init__(self, dataset):
+        images = dataset.data
+        if not torch.is_tensor(images):
+            images = torch.from_numpy(np.ascontiguousarray(images))
+        self.data = images.share_memory_()
+        self.targets = torch.as_tensor(dataset.targets,
+                                       dtype=torch.long).share_memory_()
+        self.transform = dataset.transform
+        self.target_transform = dataset.target_transform
+        self.classes = getattr(dataset, 'classes', None)
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, index):
+        image = self.data[index].numpy()
+        if image.ndim == 2:
+            image = Image.fromarray(image, mode='L')
+        else:
+            image = Image.fromarray(image)
+        target = int(self.targets[index])
+        if self.transform is not None:
+            image = self.transform(image)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return image, target
+
+
+class PackedImageFolder(data.Dataset):
+    """`datasets.ImageFolder` whose `samples` list is replaced by the paths
+    packed into one uint8 array with int64 offsets, and an int64 array of
+    labels."""
+
+    def __init__(self, dataset):
+        paths = [path.encode('utf-8') for path, _ in dataset.samples]
+        self.offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+        np.cumsum([len(path) for path in paths], out=self.offsets[1:])
+        self.paths = np.frombuffer(b''.join(paths), dtype=np.uint8)
+        self.targets = np.array([label for _, label in dataset.samples],
+                                dtype=np.int64)
+        self.loader = dataset.loader
+        self.transform = dataset.transform
+        self.target_transform = dataset.target_transform
+        self.classes = dataset.classes
+        self.class_to_idx = dataset.class_to_idx
+
+    def __len__(self):
+        return len(self.targets)
+
+    def path(self, index):
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.paths[start:end].tobytes().decode('utf-8')
+
+    def __getitem__(self, index):
+        image = self.loader(self.path(index))
+        target = int(self.targets[index])
+        if self.transform is not None:
+            image = self.transform(image)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return image, target
+
+
+def share_dataset(dataset):
+    """Wrap `dataset` so that forked workers do not duplicate its samples.
+    Datasets that already keep their samples in arrays are returned as is."""
+    if hasattr(dataset, 'samples'):
+        return PackedImageFolder(dataset)
+    if hasattr(dataset, 'data') and hasattr(dataset, 'targets'):
+        return SharedArrayDataset(dataset)
+    return dataset
@@ -2,11 +2,20 @@
 # line 52 changed view to reshape
 
 from __future__ import print_function
+import hashlib
+import json
 import math
+import os
+import socket
+import sys
+import tempfile
+import time
 import numpy as np
 import torch
 import torch.optim as optim
 
+from resnet import frozen_batch_norms
+
 
 class TwoCropTransform:
     """Create two crops of the same image"""
@@ -17,6 +26,211 @@ class TwoCropTransform:
     def __call__(self, x):
         return [self.transform(x), self.transform(x)]
 
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.transform)
+
+
+class MultiCropTransform:
+    """Create several crops of the same image. `transform` is either one
+    transform applied `n_views` times or a list with one transform per view,
+    e.g. crops at different resolutions."""
+
+    def __init__(self, transform, n_views=2):
+        if isinstance(transform, (list, tuple)):
+            self.transforms = list(transform)
+        else:
+            self.transforms = [transform] * n_views
+
+    def __call__(self, x):
+        return [transform(x) for transform in self.transforms]
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self.transforms)
+
+
+def cat_views(views):
+    """`torch.cat(views, dim=0)`, but without a copy when the views already
+    lie back to back in one contiguous storage, as `PrefetchLoader` packs
+    them."""
+    first = views[0]
+    end = first.data_ptr()
+    merged = first.is_contiguous()
+    for view in views:
+        merged = merged and view.is_contiguous() \
+            and view.shape[1:] == first.shape[1:] \
+            and view.dtype == first.dtype \
+            and view.untyped_storage().data_ptr() \
+            == first.untyped_storage().data_ptr() \
+            and view.data_ptr() == end
+        end += view.numel() * view.element_size()
+    if not merged:
+        return torch.cat(views, dim=0)
+    shape = (sum(view.shape[0] for view in views),) + tuple(first.shape[1:])
+    stride, step = [], 1
+    for size in reversed(shape):
+        stride.insert(0, step)
+        step *= size
+    return first.as_strided(shape, stride)
+
+
+def forward_views(model, images):
+    """Run `model` on a list of per-view image batches and return the
+    outputs stacked view-major, [n_views * bsz, ...]. Consecutive views of
+    the same resolution share one forward pass."""
+    outputs = []
+    start = 0
+    while start < len(images):
+        end = start + 1
+        while end < len(images) and images[end].shape == images[start].shape:
+            end += 1
+        outputs.append(model(cat_views(images[start:end])))
+        start = end
+    if len(outputs) == 1:
+        return outputs[0]
+    return torch.cat(outputs, dim=0)
+
+
+def grad_cache_backward(model, images, loss_fn, chunk_size):
+    """Backpropagate `loss_fn` over a batch whose encoder activations do not
+    fit in memory (GradCache, https://arxiv.org/abs/2101.06983).
+
+    The model first runs without grad on `chunk_size` samples at a time to
+    collect the features [bsz, n_views, D]. The loss and its gradient w.r.t.
+    those features are computed once on the full batch, then every chunk is
+    re-run with grad and backpropagated with its slice of the cached
+    gradient. Parameter gradients equal those of a single backward through
+    the same chunked forward passes. BatchNorm running statistics and
+    `num_batches_tracked` are only updated by the second pass.
+
+    Args:
+        model: maps an image batch to features [n, D].
+        images: list of per-view image batches, each of shape [bsz, ...].
+        loss_fn: maps features [bsz, n_views, D] to a loss scalar.
+        chunk_size: number of samples per encoder pass.
+    Returns:
+        The detached loss.
+    """
+    n_views = len(images)
+    bsz = images[0].shape[0]
+    chunks = [(start, min(start + chunk_size, bsz))
+              for start in range(0, bsz, chunk_size)]
+
+    # features of the whole batch, without keeping activations
+    with torch.no_grad(), frozen_batch_norms(model):
+        features = torch.cat([
+            forward_views(model, [view[start:end] for view in images])
+            .view(n_views, end - start, -1) for start, end in chunks], dim=1)
+
+    # loss and its gradient w.r.t. the [n_views, bsz, D] features
+    features.requires_grad_()
+    loss = loss_fn(features.transpose(0, 1))
+    feature_grad, = torch.autograd.grad(loss, features)
+
+    # replay every chunk with grad and push the cached gradient through it
+    for start, end in chunks:
+        chunk_features = forward_views(
+            model, [view[start:end] for view in images])
+        chunk_features.view(n_views, end - start, -1).backward(
+            feature_grad[:, start:end])
+
+    return loss.detach()
+
+
+LOADER_TUNING_FILE = './save/loader_tuning.json'
+
+
+def _loader_key(dataset, opt, kwargs):
+    """Tuning cache key: host, script, dataset and its transform, batch"""
+    transform = getattr(dataset, 'transform', None)
+    desc = '\t'.join(str(v) for v in (
+        os.path.basename(sys.argv[0]), opt.dataset,
+        os.path.abspath(getattr(opt, 'data_folder', None) or '.'),
+        type(dataset).__name__, repr(transform),
+        opt.batch_size, kwargs.get('batch_size'),
+        kwargs.get('sampler') is not None))
+    return '{}/{}cpu/{}'.format(socket.gethostname(), os.cpu_count(),
+                                hashlib.sha1(desc.encode()).hexdigest()[:16])
+
+
+def _loader_throughput(dataset, kwargs, num_workers, prefetch_factor,
+                       n_batches):
+    """samples/sec of the first `n_batches` batches after the first one"""
+    if num_workers > 0:
+        kwargs = dict(kwargs, prefetch_factor=prefetch_factor)
+    loader = torch.utils.data.DataLoader(dataset, num_workers=num_workers,
+                                         **kwargs)
+    iterator = iter(loader)
+    next(iterator)
+    n_samples, start = 0, time.perf_counter()
+    for _, (_, labels) in zip(range(n_batches), iterator):
+        n_samples += len(labels)
+    elapsed = time.perf_counter() - start
+    del iterator
+    return n_samples / elapsed if n_samples > 0 else 0.
+
+
+def tune_loader(dataset, opt, kwargs, n_batches=10):
+    """Pick (num_workers, prefetch_factor) for `dataset` by measuring the
+    loader throughput of a few candidate settings. The choice is cached
+    per host and dataset in `LOADER_TUNING_FILE`."""
+    key = _loader_key(dataset, opt, kwargs)
+    cache = {}
+    if os.path.isfile(LOADER_TUNING_FILE):
+        with open(LOADER_TUNING_FILE) as f:
+            try:
+                cache = json.load(f)
+            except ValueError:
+                # truncated by an older in-place write, tune again
+                cache = {}
+    if key in cache:
+        return tuple(cache[key])
+
+    n_cpu = os.cpu_count() or 1
+    workers = sorted({0, n_cpu} | {2 ** i for i in range(8) if 2 ** i < n_cpu})
+    candidates = [(0, 2)] + [(w, p) for w in workers if w > 0 for p in (2, 4)]
+    best, best_speed = candidates[0], -1.
+    for num_workers, prefetch_factor in candidates:
+        speed = _loader_throughput(dataset, kwargs, num_workers,
+                                   prefetch_factor, n_batches)
+        print('==> loader tuning: {} workers, prefetch {}: {:.0f} samples/s'
+              .format(num_workers, prefetch_factor, speed))
+        if speed > best_speed:
+            best, best_speed = (num_workers, prefetch_factor), speed
+
+    # write next to the cache and replace it in one step, so that a crash
+    # or a concurrent run never leaves a truncated file behind
+    cache_dir = os.path.dirname(LOADER_TUNING_FILE)
+    os.makedirs(cache_dir, exist_ok=True)
+    cache[key] = list(best)
+    fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.json')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_file, LOADER_TUNING_FILE)
+    except BaseException:
+        os.remove(tmp_file)
+        raise
+    return best
+
+
+def make_loader(dataset, opt, **kwargs):
+    """DataLoader whose workers stay alive across epochs. With
+    `opt.num_workers < 0`, num_workers and prefetch_factor are picked by
+    `tune_loader`; an explicit `num_workers` keyword wins over `opt`.
+    Iterable datasets shuffle themselves, `shuffle` is ignored for them."""
+    kwargs.setdefault('pin_memory', True)
+    if isinstance(dataset, torch.utils.data.IterableDataset):
+        kwargs.pop('shuffle', None)
+    num_workers = kwargs.pop('num_workers', opt.num_workers)
+    prefetch_factor = 2
+    if num_workers < 0:
+        num_workers, prefetch_factor = tune_loader(dataset, opt, kwargs)
+    if num_workers > 0:
+        kwargs.update(prefetch_factor=prefetch_factor,
+                      persistent_workers=True)
+    return torch.utils.data.DataLoader(dataset, num_workers=num_workers,
+                                       **kwargs)
+
 
 class AverageMeter(object):
     """Computes and stores the average and current value"""
@@ -79,6 +293,53 @@ def warmup_learning_rate(args, epoch, batch_id, total_batches, optimizer):
             param_group['lr'] = lr
 
 
+def parse_checkpoint_segments(parser, value):
+    """`--checkpoint_segments` as one segment count per ResNet stage, a
+    single value applying to all four stages. Anything else ends the run
+    through `parser.error`."""
+    if value is None:
+        return None
+    try:
+        segments = [int(s) for s in value.split(',')]
+    except ValueError:
+        parser.error('--checkpoint_segments takes integers, got {}'
+                     .format(value))
+    if len(segments) not in (1, 4) or min(segments) < 0:
+        parser.error('--checkpoint_segments takes 1 or 4 non-negative '
+                     'values, one per ResNet stage, got {}'.format(value))
+    return segments * 4 if len(segments) == 1 else segments
+
+
+INDUCTOR_CACHE_DIR = './save/inductor_cache'
+
+
+def _channels_last_input(module, args):
+    return tuple(arg.contiguous(memory_format=torch.channels_last)
+                 if torch.is_tensor(arg) and arg.dim() == 4 else arg
+                 for arg in args)
+
+
+def compile_model(model, opt):
+    """Apply `--channels_last` and `--compile` to `model.encoder`.
+
+    channels_last converts the conv weights and, through a forward
+    pre-hook, every image batch entering the encoder. `--compile` compiles
+    the encoder in place with inductor, so that the state_dict keys stay
+    unchanged; inductor's graph cache lives in INDUCTOR_CACHE_DIR so that
+    later runs skip most of the compilation.
+    """
+    if opt.channels_last:
+        model.to(memory_format=torch.channels_last)
+        model.encoder.register_forward_pre_hook(_channels_last_input)
+    if opt.compile:
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR',
+                              os.path.abspath(INDUCTOR_CACHE_DIR))
+        import torch._inductor.config as inductor_config
+        inductor_config.fx_graph_cache = True
+        model.encoder.compile(backend='inductor')
+    return model
+
+
 def set_optimizer(opt, model):
     optimizer = optim.SGD(model.parameters(),
                           lr=opt.learning_rate,
@@ -0,0 +1,164 @@
+# Offline store of pre-augmented views
+# On hosts with few cores the random crops and color jitter of every view,
+# every epoch, can cost more than the training step. Here the augmentation
+# runs once, in a process pool: `k` views of every image are rendered into
+# one memory-mapped uint8 file, and training draws `n_views` distinct stored
+# views per image each epoch. A larger `k` buys diversity with build time
+# and disk (N * k * H * W * 3 bytes); only ToTensor and normalization remain
+# per epoch.
+
+from __future__ import print_function
+
+import os
+import hashlib
+import json
+import multiprocessing
+import random
+import shutil
+import tempfile
+
+import numpy as np
+import torch
+import torch.utils.data as data
+from PIL import Image
+
+
+STORE_VERSION = 1
+
+# state of the rendering processes, set by _init_render
+_render_state = {}
+
+
+def store_folder(store_dir, source, transform, k):
+    """Directory of the `k` views per image of `source` under `transform`
+    inside `store_dir`"""
+    key = hashlib.sha1('{}\t{}\t{!r}\t{}'.format(
+        STORE_VERSION, source, transform, k).encode()).hexdigest()[:16]
+    return os.path.join(store_dir, 'views_{}_{}'.format(k, key))
+
+
+def _init_render(dataset, transform, path, shape):
+    _render_state.update(dataset=dataset, transform=transform, path=path,
+                         shape=shape)
+
+
+def _render(job):
+    start, end, seed = job
+    dataset = _render_state['dataset']
+    transform = _render_state['transform']
+    shape = _render_state['shape']
+    # torchvision draws from both generators
+    random.seed(seed)
+    torch.manual_seed(seed)
+    views = np.memmap(_render_state['path'], dtype=np.uint8, mode='r+',
+                      shape=shape)
+    for i in range(start, end):
+        image, _ = dataset[i]
+        for j in range(shape[1]):
+            views[i, j] = np.asarray(transform(image).convert('RGB'),
+                                     dtype=np.uint8)
+    views.flush()
+    return end - start
+
+
+def build_view_store(dataset, transform, store_dir, k, source,
+                     num_workers=0, chunk=256):
+    """Render `k` views of every image of `dataset` with `transform` into
+    their store directory, unless the store is already there. Returns the
+    store directory.
+
+    `dataset` must return untransformed PIL images, and `transform` must
+    produce images of one fixed size (e.g. end in a RandomResizedCrop).
+    `source` names the dataset in the store key. The views are stored as
+    `views.u8`, a [N, k, H, W, 3] uint8 array, next to `labels.npy`.
+    """
+    folder = store_folder(store_dir, source, transform, k)
+    if os.path.isfile(os.path.join(folder, 'manifest.json')):
+        return folder
+
+    width, height = transform(dataset[0][0]).size
+    shape = (len(dataset), k, height, width, 3)
+    print('==> rendering {} views of {} images into {}'.format(
+        k, len(dataset), folder))
+    os.makedirs(store_dir, exist_ok=True)
+    # build next to the final location and rename it in one step, so that
+    # concurrent runs never see a partial store
+    tmp_folder = tempfile.mkdtemp(dir=store_dir)
+    path = os.path.join(tmp_folder, 'views.u8')
+    np.memmap(path, dtype=np.uint8, mode='w+', shape=shape).flush()
+
+    seed = torch.randint(2 ** 31, (1,)).item()
+    jobs = [(start, min(start + chunk, len(dataset)), seed + start)
+            for start in range(0, len(dataset), chunk)]
+    if num_workers > 0:
+        pool = multiprocessing.Pool(num_workers, initializer=_init_render,
+                                    initargs=(dataset, transform, path,
+                                              shape))
+        try:
+            for _ in pool.imap_unordered(_render, jobs):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_render(dataset, transform, path, shape)
+        for job in jobs:
+            _render(job)
+
+    np.save(os.path.join(tmp_folder, 'labels.npy'),
+            np.asarray(dataset.targets, dtype=np.int64))
+    with open(os.path.join(tmp_folder, 'manifest.json'), 'w') as f:
+        json.dump({'source': source, 'transform': repr(transform),
+                   'shape': shape}, f)
+    try:
+        os.rename(tmp_folder, folder)
+    except OSError:
+        # another run finished the same store first
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+    return folder
+
+
+class ViewStoreDataset(data.Dataset):
+    """Samples `n_views` distinct stored views of every image.
+
+    Returns the list of views, each passed through `transform`, like
+    `MultiCropTransform`, and the label. The store is memory-mapped lazily,
+    so the dataset pickles cheaply into DataLoader workers.
+    """
+
+    def __init__(self, folder, n_views=2, transform=None,
+                 target_transform=None):
+        self.folder = folder
+        with open(os.path.join(folder, 'manifest.json')) as f:
+            self.shape = tuple(json.load(f)['shape'])
+        if n_views > self.shape[1]:
+            raise ValueError('{} views requested, the store has {}'.format(
+                n_views, self.shape[1]))
+        self.n_views = n_views
+        self.transform = transform
+        self.target_transform = target_transform
+        self.targets = np.load(os.path.join(folder, 'labels.npy'))
+        self.views = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['views'] = None
+        return state
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        if self.views is None:
+            self.views = np.memmap(os.path.join(self.folder, 'views.u8'),
+                                   dtype=np.uint8, mode='r',
+                                   shape=self.shape)
+        picks = torch.randperm(self.shape[1])[:self.n_views].tolist()
+        views = [Image.fromarray(np.asarray(self.views[index, j]))
+                 for j in picks]
+        if self.transform is not None:
+            views = [self.transform(view) for view in views]
+        target = int(self.targets[index])
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return views, target